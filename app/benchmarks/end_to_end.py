@@ -0,0 +1,211 @@
+"""
+End-to-end benchmark of the chat engine against stub models, runnable offline (e.g., in CI).
+A synthetic catalog is ingested through BuildNodes into a temporary Chroma store, then a mix of
+conversations is replayed through load_chat_engine by concurrent sessions, as the Chainlit handler does.
+The settings are read from .env and can be overridden by environment variables, as in the application.
+
+    python app/benchmarks/end_to_end.py --assets 5000 --sessions 50 --concurrency 8 --llm-latency 0.2
+"""
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from collections import defaultdict
+import numpy as np
+import resource
+import tempfile
+import argparse
+import asyncio
+import random
+import json
+import time
+import os
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.stubs import StubLLM, StubEmbedding, install_stub_models
+
+# Conversations replayed by the sessions, covering all the tools
+QUERY_MIX = [
+    ["Dove trovo il codice cliente?", "E in quale schema si trova quella tabella?", "Quali altre colonne contiene?"],
+    ["Quali colonne contiene la tabella dei prodotti?", "C'è anche il tasso di interesse?"],
+    ["In quale tabella è salvata la data di apertura del conto?", "E l'importo?"],
+    ["Qual è il significato del campo saldo delle carte?"],
+    ["Ciao, cosa puoi fare?"],
+    ["Voglio segnalare un errore nella descrizione della colonna saldo."],
+    ["Che tempo fa oggi a Milano?"],
+]
+
+DOMAINS = ["clienti", "prodotti", "conti", "carte", "prestiti", "filiali", "transazioni", "mutui"]
+COLUMNS = [
+    ("codice", "Codice identificativo univoco"), ("nome", "Nome"), ("descrizione", "Descrizione testuale"),
+    ("data_apertura", "Data di apertura"), ("data_nascita", "Data di nascita"), ("importo", "Importo in euro"),
+    ("saldo", "Saldo contabile"), ("tasso_interesse", "Tasso di interesse annuo"), ("stato", "Stato corrente"),
+    ("tipo", "Tipologia"), ("email", "Indirizzo email"), ("numero_telefono", "Numero di telefono"),
+]
+PERCENTILES = (50, 95, 99)
+
+
+def synthetic_catalog(n_assets: int, seed: int = 0):
+    """
+    Build a catalog of `n_assets` schemas, tables and columns, in the format of the catalog exports.
+    """
+    import pandas as pd
+
+    rng = random.Random(seed)
+    rows = []
+    table_index = 0
+    while len(rows) < n_assets:
+        domain = DOMAINS[table_index % len(DOMAINS)]
+        schema = f"anagrafica {domain}"
+        schema_description = f"Schema che contiene le informazioni su {domain} della banca."
+        if table_index < len(DOMAINS):
+            rows.append({"nome asset": schema, "tipo asset": "schema", "descrizione asset": schema_description,
+                         "schema di appartenenza": "", "descrizione schema": "", "tabella di appartenenza": "", "descrizione tabella di appartenenza": ""})
+
+        table = f"{domain}_{table_index // len(DOMAINS)}"
+        table_description = f"Tabella contenente i dati principali di {domain}. Ogni riga rappresenta un record di {domain}."
+        rows.append({"nome asset": table, "tipo asset": "tabella", "descrizione asset": table_description,
+                     "schema di appartenenza": schema, "descrizione schema": schema_description, "tabella di appartenenza": "", "descrizione tabella di appartenenza": ""})
+
+        for column, description in rng.sample(COLUMNS, k=rng.randint(4, len(COLUMNS))):
+            rows.append({"nome asset": f"{column}_{domain}", "tipo asset": "colonna", "descrizione asset": f"{description} di {domain}, nella tabella {table}.",
+                         "schema di appartenenza": schema, "descrizione schema": schema_description, "tabella di appartenenza": table, "descrizione tabella di appartenenza": table_description})
+        table_index += 1
+
+    return pd.DataFrame(rows[:n_assets])
+
+
+def percentiles(values):
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES} if values else {f"p{p}": float("nan") for p in PERCENTILES}
+
+
+async def replay_session(load_chat_engine, conversation, turns):
+    chat_engine = load_chat_engine()
+    memory = []
+    for message in conversation:
+        start_time = time.perf_counter()
+        first_token_time = None
+        response = await chat_engine.astream_chat(message=message, chat_history=memory)
+        async for token in response.async_response_gen():
+            if first_token_time is None and token:
+                first_token_time = time.perf_counter()
+        end_time = time.perf_counter()
+
+        turns.append({"latency": end_time - start_time, "first_token": (first_token_time or end_time) - start_time})
+        memory += [ChatMessage(role=MessageRole.USER, content=message), ChatMessage(role=MessageRole.ASSISTANT, content=response.response)]
+
+
+async def replay(load_chat_engine, conversations, concurrency):
+    turns = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(conversation):
+        async with semaphore:
+            await replay_session(load_chat_engine, conversation, turns)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run(conversation) for conversation in conversations])
+    return turns, time.perf_counter() - start_time
+
+
+def stage_percentiles(trace_path):
+    latencies = defaultdict(list)
+    with open(trace_path) as f:
+        for line in f:
+            record = json.loads(line)
+            latencies[record["stage"]].append(record["latency"])
+    return {stage: {"count": len(values), **percentiles(values)} for stage, values in sorted(latencies.items())}
+
+
+def start_retrieval_service(socket_path):
+    """
+    Start the retrieval service in a background thread, and point the chat engine to it.
+    """
+    from serving.retrieval_service import load_retrieval_app
+    import threading
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(load_retrieval_app(), uds=socket_path, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True, name="RetrievalService").start()
+    while not server.started:
+        time.sleep(0.05)
+    os.environ["RETRIEVAL_SERVICE_URL"] = f"unix://{socket_path}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat engine end to end against stub models.")
+    parser.add_argument("--assets", type=int, default=2000, help="Number of assets of the synthetic catalog.")
+    parser.add_argument("--sessions", type=int, default=20, help="Number of replayed chat sessions.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of sessions served at the same time.")
+    parser.add_argument("--queries", help="JSON Lines file with one conversation (list of messages) per line, defaults to the built-in mix.")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Simulated latency of each LLM call, in seconds.")
+    parser.add_argument("--token-rate", type=float, default=200, help="Simulated streaming rate of the LLM, in tokens per second (0 streams at once).")
+    parser.add_argument("--embedding-latency", type=float, default=0.02, help="Simulated latency of each embedding call, in seconds.")
+    parser.add_argument("--retrieval-service", action="store_true", help="Search the collections through the retrieval service, started on a local Unix socket.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic catalog and of the session order.")
+    parser.add_argument("--output", help="JSON file the results are written to.")
+    args = parser.parse_args()
+
+    # Temporary stores, so that the benchmark does not touch the application ones
+    work_dir = tempfile.mkdtemp(prefix="chatbot_benchmark_")
+    os.environ["CHROMA_PATH"] = os.path.join(work_dir, "chroma")
+    os.environ["BM25_PATH"] = os.path.join(work_dir, "chroma", "bm25")
+    os.environ["EMBEDDING_CACHE_PATH"] = ""
+    os.environ["METRICS_ENABLED"] = "true"
+    os.environ["METRICS_TRACE_PATH"] = os.path.join(work_dir, "trace.jsonl")
+
+    llm = StubLLM(latency=args.llm_latency, token_rate=args.token_rate)
+    install_stub_models(llm, StubEmbedding(latency=args.embedding_latency))
+
+    # Imported after the stubs are installed
+    from ingest import BuildNodes
+    from ingestion.catalog_sources import DataFrameSource
+    from chat_engine.load_chat_engine import load_chat_engine, load_shared_query_engine
+    from llama_index.core import Settings
+
+    start_time = time.perf_counter()
+    BuildNodes(DataFrameSource(synthetic_catalog(args.assets, args.seed)), embed_model=Settings.embed_model).run_builder()
+    ingestion_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if args.retrieval_service:
+        start_retrieval_service(os.path.join(work_dir, "retrieval.sock"))
+    load_shared_query_engine()
+    startup_time = time.perf_counter() - start_time
+
+    if args.queries:
+        with open(args.queries) as f:
+            query_mix = [json.loads(line) for line in f if line.strip()]
+    else:
+        query_mix = QUERY_MIX
+    conversations = [query_mix[i % len(query_mix)] for i in range(args.sessions)]
+    random.Random(args.seed).shuffle(conversations)
+
+    llm_calls = llm.calls
+    turns, elapsed_time = asyncio.run(replay(load_chat_engine, conversations, args.concurrency))
+
+    results = {
+        "assets": args.assets,
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "retrieval service": args.retrieval_service,
+        "turns": len(turns),
+        "ingestion (s)": ingestion_time,
+        "startup (s)": startup_time,
+        "QPS": len(turns) / elapsed_time,
+        "LLM calls per turn": (llm.calls - llm_calls) / max(len(turns), 1),
+        "turn latency (s)": percentiles([t["latency"] for t in turns]),
+        "first token latency (s)": percentiles([t["first_token"] for t in turns]),
+        "stage latency (s)": stage_percentiles(os.environ["METRICS_TRACE_PATH"]),
+        # On Linux, ru_maxrss is in kilobytes
+        "peak RSS (MB)": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+    print("\n" + json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Import-time profile of the application modules, measured in a fresh interpreter as at a cold start.
+It reports the import time and the slowest imported packages (from `python -X importtime`), and fails if the
+import exceeds the budget or loads the Vertex SDK, which must only be loaded by the model factories at their first use.
+
+    python app/benchmarks/import_time.py --budget 8 --top 15
+"""
+from pathlib import Path
+import subprocess
+import tempfile
+import argparse
+import json
+import sys
+import re
+import os
+
+APP_DIR = Path(__file__).resolve().parents[1]
+
+# Modules imported at the startup of the application and of the ingestion
+STARTUP_MODULES = ["chat_engine.load_chat_engine", "models.models", "ingest"]
+# Modules that must not be imported before the models are used
+DEFERRED_MODULES = ["vertexai", "google.cloud.aiplatform", "llama_index.embeddings.vertex", "llama_index.llms.vertex"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed_time = time.perf_counter() - start_time
+print(json.dumps({{"elapsed": elapsed_time, "deferred": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+# Lines of `python -X importtime`: "import time: self [us] | cumulative | imported package"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s*(\S+)")
+
+
+def profile_imports(modules):
+    """
+    Import the modules in a fresh interpreter, without GCP credentials.
+
+    Returns:
+        - the import time in seconds;
+        - the deferred modules that were imported anyway;
+        - the (seconds, package) of each top-level package, summing the import time of all its modules.
+    """
+    env = dict(os.environ, PYTHONPATH=str(APP_DIR), GCP_KEY_PATH="")
+    # Chainlit writes its default configuration in the working directory at import time
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT.format(modules=modules, deferred=DEFERRED_MODULES)],
+            cwd=work_dir, env=env, capture_output=True, text=True,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"The import failed:\n{result.stderr[-2000:]}")
+
+    packages = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            package = match.group(3).split(".")[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1e6
+
+    output = json.loads(result.stdout.strip().splitlines()[-1])
+    return output["elapsed"], output["deferred"], sorted([(seconds, package) for package, seconds in packages.items()], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the cold-start import time of the application.")
+    parser.add_argument("--budget", type=float, default=8.0, help="Maximum import time, in seconds.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest packages to show.")
+    parser.add_argument("--modules", nargs="+", default=STARTUP_MODULES, help="Modules to import.")
+    args = parser.parse_args()
+
+    elapsed_time, deferred, packages = profile_imports(args.modules)
+
+    print(f"Import of {', '.join(args.modules)}: {elapsed_time:.2f}s (budget {args.budget:.2f}s)")
+    print("Slowest packages:")
+    for seconds, package in packages[:args.top]:
+        print(f"  {seconds:7.3f}s  {package}")
+
+    failed = False
+    if deferred:
+        print(f"Imported at startup instead of at the first use of the models: {', '.join(deferred)}")
+        failed = True
+    if elapsed_time > args.budget:
+        print("The import time exceeds the budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
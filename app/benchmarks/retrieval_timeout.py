@@ -0,0 +1,160 @@
+"""
+Check that the hybrid retrieval degrades to BM25 when the vector search hangs.
+More queries than the worker threads of the retrievers run at once against a vector search that never returns:
+each of them must still get the BM25 nodes within the vector timeout, on the sync, async and batched paths.
+On the async path, the blocking query must not hold the event loop, or the timeouts could not fire.
+The retrieval service must also degrade to BM25 for a query whose embedding request fails, without failing
+the other queries of its micro-batch.
+It exits with an error otherwise.
+
+    python app/benchmarks/retrieval_timeout.py --timeout 0.5
+"""
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+import argparse
+import asyncio
+import time
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from chat_engine.SemanticSearchQE.HybridRetriever import HybridRetriever, RETRIEVER_WORKERS
+from chat_engine.LogHandler.shell import shell_colors
+from models.embedding_cache import CachedEmbedding, EmbeddingCache
+from serving.retrieval_service import QueryBatcher
+from benchmarks.stubs import StubEmbedding
+
+
+class StubBM25Retriever:
+    def retrieve(self, query_str):
+        return [NodeWithScore(node=TextNode(id_=f"bm25-{query_str}", text=query_str), score=1.0)]
+
+    def retrieve_batch(self, query_strs):
+        return [self.retrieve(query_str) for query_str in query_strs]
+
+
+class HungVectorRetriever:
+    """
+    Vector retriever whose queries block until `release` is set, like a Chroma query stuck on a lock or on the network.
+    The async path embeds the query, then runs the same blocking query in a worker thread.
+    """
+    similarity_top_k = 10
+
+    def __init__(self) -> None:
+        self.release = Event()
+        self._embed_model = StubEmbedding()
+
+    def retrieve(self, query_bundle):
+        self.release.wait()
+        return []
+
+    def search(self, query_embeddings, top_k):
+        self.release.wait()
+        return [[] for _ in query_embeddings]
+
+
+class FailingEmbedding(StubEmbedding):
+    """
+    Embedding model whose requests fail for the queries starting with "fail", like a Vertex 503.
+    """
+
+    async def _aget_query_embedding(self, query: str):
+        if query.startswith("fail"):
+            raise RuntimeError("vertex 503")
+        return await super()._aget_query_embedding(query)
+
+
+def stub_vector_search(query_embeddings, top_k):
+    return [[NodeWithScore(node=TextNode(id_="vector", text="vector"), score=1.0)] for _ in query_embeddings]
+
+
+def check_failed_embedding(name, embed_model):
+    """
+    One query of a micro-batch fails to embed: it must get the BM25 nodes only, and the others the vector nodes as well.
+    """
+    retriever = HybridRetriever(HungVectorRetriever(), StubBM25Retriever(), vector_timeout=None, bm25_timeout=None, vector_search=stub_vector_search)
+    batcher = QueryBatcher({"collection": retriever}, embed_model, max_wait=0.05)
+    queries = ["query0", "fail1", "query2"]
+
+    async def run_batch():
+        return await asyncio.gather(*[batcher.retrieve("collection", query) for query in queries], return_exceptions=True)
+
+    results = asyncio.run(run_batch())
+    expected = [{f"bm25-{query}"} | (set() if query.startswith("fail") else {"vector"}) for query in queries]
+    ok = all(not isinstance(nodes, Exception) and {n.node.node_id for n in nodes} == ids for nodes, ids in zip(results, expected))
+    color = shell_colors["OKGREEN"] if ok else shell_colors["FAIL"]
+    print(f"{color}{name}: {len(queries)} queries, 1 failed embedding, {'BM25 only for it' if ok else f'results {results}'}{shell_colors['ENDC']}")
+    return ok
+
+
+def check(name, latencies, results, expected_ids, deadline):
+    missing = [i for i, nodes in enumerate(results) if [n.node.node_id for n in nodes] != expected_ids[i]]
+    slowest = max(latencies)
+    ok = not missing and slowest <= deadline
+    color = shell_colors["OKGREEN"] if ok else shell_colors["FAIL"]
+    print(f"{color}{name}: {len(results)} queries, slowest {slowest:.2f}s (deadline {deadline:.2f}s), {len(missing)} without the BM25 nodes{shell_colors['ENDC']}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the hybrid retrieval degrades to BM25 when the vector search hangs.")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Vector retrieval timeout in seconds.")
+    parser.add_argument("--queries", type=int, default=2 * RETRIEVER_WORKERS, help="Concurrent queries, more than the worker threads by default.")
+    parser.add_argument("--slack", type=float, default=0.5, help="Seconds allowed on top of the timeout.")
+    args = parser.parse_args()
+
+    vector_retriever = HungVectorRetriever()
+    retriever = HybridRetriever(
+        vector_retriever,
+        StubBM25Retriever(),
+        vector_timeout=args.timeout,
+        bm25_timeout=None,
+        vector_search=vector_retriever.search,
+    )
+    queries = [f"query{i}" for i in range(args.queries)]
+    expected_ids = [[f"bm25-{query}"] for query in queries]
+    deadline = args.timeout + args.slack
+
+    def timed_retrieve(query):
+        start_time = time.perf_counter()
+        nodes = retriever.retrieve(QueryBundle(query))
+        return time.perf_counter() - start_time, nodes
+
+    ok = True
+    try:
+        # Sync path, from as many caller threads as queries
+        with ThreadPoolExecutor(max_workers=args.queries) as callers:
+            timed = list(callers.map(timed_retrieve, queries))
+        ok &= check("sync", [t for t, _ in timed], [nodes for _, nodes in timed], expected_ids, deadline)
+
+        # Async path, on a single event loop
+        async def timed_aretrieve(query):
+            start_time = time.perf_counter()
+            nodes = await retriever.aretrieve(QueryBundle(query))
+            return time.perf_counter() - start_time, nodes
+
+        async def run_async():
+            return await asyncio.gather(*[timed_aretrieve(query) for query in queries])
+
+        timed = asyncio.run(run_async())
+        ok &= check("async", [t for t, _ in timed], [nodes for _, nodes in timed], expected_ids, deadline)
+
+        # Batched path, as in the retrieval service
+        start_time = time.perf_counter()
+        results = retriever.retrieve_batch(queries, [[0.0] for _ in queries])
+        ok &= check("batch", [time.perf_counter() - start_time], results, expected_ids, deadline)
+    finally:
+        vector_retriever.release.set()
+
+    # Failed query embeddings in the retrieval service, with and without the embedding cache
+    ok &= check_failed_embedding("failed embedding", FailingEmbedding())
+    ok &= check_failed_embedding("failed embedding (cached)", CachedEmbedding(FailingEmbedding(), EmbeddingCache()))
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
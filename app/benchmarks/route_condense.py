@@ -0,0 +1,99 @@
+"""
+Compare the latency of the condense -> select chain with the combined route-and-condense call,
+replaying a conversation against stub models that simulate the latency of each LLM call.
+
+    python app/benchmarks/route_condense.py --turns 5 --latency 0.5
+"""
+from llama_index.core import Settings, PromptTemplate
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.base.response.schema import StreamingResponse
+from llama_index.core.chat_engine import CondenseQuestionChatEngine
+from llama_index.core.query_engine import CustomQueryEngine
+from llama_index.core.query_engine.router_query_engine import RouterQueryEngine
+from llama_index.core.selectors.llm_selectors import LLMSingleSelector
+from llama_index.core.tools import QueryEngineTool
+import statistics
+import argparse
+import time
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.stubs import StubLLM
+from chat_engine.ChatEngines.RouteCondenseChatEngine import RouteCondenseChatEngine
+from chat_engine.Router.PreselectedSelector import PreselectedSelector
+from common.prompts_templates.PromptTemplates import SINGLE_SELECT_PROMPT, CONDENSE_QUESTION_PROMPT, TOOL_DESCRIPTIONS
+
+CONVERSATION = [
+    "Dove trovo il codice cliente?",
+    "E in quale schema si trova quella tabella?",
+    "Quali altre colonne contiene?",
+    "C'è anche la data di nascita?",
+    "Come è formattata?",
+]
+
+
+class StubToolQueryEngine(CustomQueryEngine):
+    """
+    Tool answering with a single streamed LLM call, standing in for retrieval, reranking and synthesis.
+    """
+
+    def custom_query(self, query_str: str):
+        return StreamingResponse(response_gen=(r.delta for r in Settings.llm.stream_complete(query_str)))
+
+
+def build_router() -> RouterQueryEngine:
+    tools = [
+        QueryEngineTool.from_defaults(query_engine=StubToolQueryEngine(), name=name, description=description.format(key_name="Demo"))
+        for name, description in TOOL_DESCRIPTIONS.items() if name != "asset_mapping"
+    ]
+    return RouterQueryEngine.from_defaults(
+        selector=PreselectedSelector(LLMSingleSelector.from_defaults(prompt_template_str=SINGLE_SELECT_PROMPT)),
+        query_engine_tools=tools,
+    )
+
+
+def run(mode: str, turns: int) -> dict:
+    router = build_router()
+    chat_engine_cls = RouteCondenseChatEngine if mode == "route_condense" else CondenseQuestionChatEngine
+    kwargs = {"tool_metadatas": router._metadatas} if mode == "route_condense" else {}
+    chat_engine = chat_engine_cls.from_defaults(query_engine=router, condense_question_prompt=PromptTemplate(CONDENSE_QUESTION_PROMPT), **kwargs)
+
+    memory, latencies, calls = [], [], []
+    for message in (CONVERSATION * turns)[:turns]:
+        calls_before = Settings.llm.calls
+        start_time = time.perf_counter()
+        response = chat_engine.stream_chat(message, chat_history=memory)
+        answer = "".join(response.response_gen)
+        latencies.append(time.perf_counter() - start_time)
+        calls.append(Settings.llm.calls - calls_before)
+
+        memory += [ChatMessage(role=MessageRole.USER, content=message), ChatMessage(role=MessageRole.ASSISTANT, content=answer)]
+
+    # The first turn has no history to condense in both modes
+    return {
+        "mode": mode,
+        "mean turn latency (s)": statistics.mean(latencies),
+        "mean follow-up latency (s)": statistics.mean(latencies[1:]) if turns > 1 else float("nan"),
+        "LLM calls": sum(calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the combined route-and-condense call against the condense -> select chain.")
+    parser.add_argument("--turns", type=int, default=5, help="Number of turns of the replayed conversation.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated latency of each LLM call, in seconds.")
+    args = parser.parse_args()
+
+    Settings.llm = StubLLM(latency=args.latency)
+    results = [run(mode, args.turns) for mode in ("condense", "route_condense")]
+
+    for result in results:
+        print(" | ".join([f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}" for k, v in result.items()]))
+    saved = results[0]["mean follow-up latency (s)"] - results[1]["mean follow-up latency (s)"]
+    print(f"Route-and-condense saves {saved:.3f}s per follow-up turn ({results[0]['LLM calls'] - results[1]['LLM calls']} LLM calls over {args.turns} turns)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Throughput of the multi-process serving (`app/serve.py`) as the number of workers grows.
+Each worker is a uvicorn server whose requests hold the GIL for `--work-ms`, like the retrieval and the JSON parsing
+of a Chainlit worker, and the workers are reached through the StickyProxy, run in its own process as in serve.py.
+Concurrent browsers, each with its own cookie jar and keep-alive connection, send requests for `--duration` seconds.
+For each number of workers it reports the requests per second, the speedup over the first run, the p50/p95/p99
+latency and the requests served by each worker connection (1 when every request opens a new connection).
+
+    python app/benchmarks/serve_throughput.py --workers 1 2 4 --concurrency 32 --work-ms 5
+"""
+from multiprocessing import Process
+import numpy as np
+import argparse
+import asyncio
+import httpx
+import json
+import time
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from serving.sticky_proxy import StickyProxy, STICKY_COOKIE
+from serve import wait_for_workers
+
+PERCENTILES = (50, 95, 99)
+
+
+def run_worker(port: int, work: float) -> None:
+    import uvicorn
+
+    connections = set()
+
+    async def app(scope, receive, send):
+        # Each client address is a connection opened by the proxy
+        connections.add(tuple(scope["client"]))
+        while (await receive()).get("more_body"):
+            pass
+        deadline = time.perf_counter() + work
+        while time.perf_counter() < deadline:
+            pass
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain"), (b"x-worker-connections", str(len(connections)).encode())]})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+
+
+def run_proxy(worker_ports, port: int) -> None:
+    asyncio.run(StickyProxy(worker_ports).serve("127.0.0.1", port))
+
+
+async def browse(url: str, deadline: float, latencies: list, connections: dict) -> None:
+    """
+    A browser sending one request after the other, on the keep-alive connection of its client.
+    """
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            start_time = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - start_time)
+            worker = client.cookies.get(STICKY_COOKIE)
+            connections[worker] = max(connections.get(worker, 0), int(response.headers["x-worker-connections"]))
+
+
+async def load(url: str, concurrency: int, duration: float):
+    latencies, connections = [], {}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[browse(url, deadline, latencies, connections) for _ in range(concurrency)])
+    return latencies, connections
+
+
+def run(workers: int, args) -> dict:
+    worker_ports = [args.port + 1 + i for i in range(workers)]
+    processes = [Process(target=run_worker, args=(port, args.work_ms / 1000), daemon=True) for port in worker_ports]
+    processes.append(Process(target=run_proxy, args=(worker_ports, args.port), daemon=True))
+    for process in processes:
+        process.start()
+    try:
+        wait_for_workers(worker_ports + [args.port])
+        latencies, connections = asyncio.run(load(f"http://127.0.0.1:{args.port}/", args.concurrency, args.duration))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "requests/s": len(latencies) / args.duration,
+        **{f"p{p} latency (ms)": float(np.percentile(latencies, p)) * 1000 for p in PERCENTILES},
+        "requests per connection": len(latencies) / max(sum(connections.values()), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the multi-process serving as the number of workers grows.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of worker processes.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent browsers.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load for each number of workers.")
+    parser.add_argument("--work-ms", type=float, default=5, help="Milliseconds each request holds the GIL of its worker.")
+    parser.add_argument("--port", type=int, default=8100, help="Port of the proxy, the workers use the following ones.")
+    parser.add_argument("--output", help="JSON file the results are written to.")
+    args = parser.parse_args()
+
+    results = [run(workers, args) for workers in args.workers]
+
+    print(f"{'workers':>7} {'req/s':>8} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/conn':>9}")
+    for r in results:
+        r["speedup"] = r["requests/s"] / results[0]["requests/s"]
+        print(f"{r['workers']:>7} {r['requests/s']:>8.0f} {r['speedup']:>8.2f} {r['p50 latency (ms)']:>8.2f} {r['p95 latency (ms)']:>8.2f} {r['p99 latency (ms)']:>8.2f} {r['requests per connection']:>9.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
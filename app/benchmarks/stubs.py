@@ -0,0 +1,189 @@
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.llms import CustomLLM, CompletionResponse, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from threading import Lock
+from typing import Any, List
+import numpy as np
+import asyncio
+import hashlib
+import types
+import json
+import re
+import time
+
+
+class StubLLM(CustomLLM):
+    """
+    Deterministic stand-in for Gemini, for the offline benchmarks.
+    Each call sleeps for `latency` seconds (without blocking the event loop on the async path), then answers
+    according to the prompt it receives: condensation, tool selection, combined route-and-condense,
+    reranking, or a fixed synthesized answer. Streamed answers emit `token_rate` tokens per second (0 emits them at once).
+    """
+    latency: float = 0.0
+    token_rate: float = 0.0
+    choice: int = 1
+    answer: str = "Il codice cliente si trova nella tabella clienti dello schema anagrafica clienti."
+    calls: int = 0
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._lock = Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="stub")
+
+    @staticmethod
+    def _section(prompt: str, start: str, end: str) -> str:
+        match = re.search(re.escape(start) + r"\s*(.*?)\s*(" + re.escape(end) + r"|$)", prompt, flags=re.S)
+        return match.group(1) if match else ""
+
+    def respond(self, prompt: str) -> str:
+        if "<Output>" in prompt and "<Follow Up Message>" in prompt:
+            question = self._section(prompt, "<Follow Up Message>", "<Output>")
+            return json.dumps({"question": question, "choice": self.choice})
+        if "<Standalone question>" in prompt:
+            return self._section(prompt, "<Follow Up Message>", "<Standalone question>")
+        if "return 1 and ONLY 1 choice" in prompt:
+            return json.dumps([{"choice": self.choice, "reason": "stub selection"}])
+        if prompt.startswith("A list of documents is shown below"):
+            # Keep the documents in their order, with decreasing relevance
+            documents = re.findall(r"^Document (\d+):", prompt, flags=re.M)
+            return "\n".join([f"Doc: {doc}, Relevance: {max(10 - i, 1)}" for i, doc in enumerate(documents)])
+        return self.answer
+
+    def _call(self, prompt: str) -> str:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return self.respond(prompt)
+
+    async def _acall(self, prompt: str) -> str:
+        with self._lock:
+            self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.respond(prompt)
+
+    @staticmethod
+    def _tokens(text: str):
+        streamed = ""
+        for token in re.findall(r"\S+\s*", text):
+            streamed += token
+            yield CompletionResponse(text=streamed, delta=token)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text=self._call(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        text = self._call(prompt)
+
+        def gen():
+            for response in self._tokens(text):
+                if self.token_rate:
+                    time.sleep(1 / self.token_rate)
+                yield response
+
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text=await self._acall(prompt))
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        text = await self._acall(prompt)
+
+        async def gen():
+            for response in self._tokens(text):
+                if self.token_rate:
+                    await asyncio.sleep(1 / self.token_rate)
+                yield response
+
+        return gen()
+
+
+class StubEmbedding(BaseEmbedding):
+    """
+    Deterministic stand-in for the Vertex embedding model, for the offline benchmarks.
+    Texts are embedded by hashing their lowercase words into `embed_dim` signed buckets, so that
+    texts sharing words are similar; each call sleeps for `latency` seconds.
+    """
+    embed_dim: int = 256
+    latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubEmbedding"
+
+    def _embed(self, text: str) -> Embedding:
+        embedding = np.zeros(self.embed_dim, dtype=np.float32)
+        for word in re.findall(r"[^\W_]+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            embedding[int.from_bytes(digest[:4], "little") % self.embed_dim] += 1.0 if digest[4] % 2 else -1.0
+        norm = np.linalg.norm(embedding)
+        return (embedding / norm if norm > 0 else embedding).tolist()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        time.sleep(self.latency)
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        await asyncio.sleep(self.latency)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        # A batch costs a single call, like the Vertex batch requests
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+
+class StubGenerativeModel:
+    """
+    Stand-in for the Vertex GenerativeModel used by the auxiliary tools.
+    """
+
+    def __init__(self, llm: StubLLM) -> None:
+        self.llm = llm
+
+    def generate_content(self, contents: str, **kwargs: Any):
+        return types.SimpleNamespace(text=self.llm.complete(contents).text)
+
+    async def generate_content_async(self, contents: str, **kwargs: Any):
+        return types.SimpleNamespace(text=(await self.llm.acomplete(contents)).text)
+
+
+def install_stub_models(llm: StubLLM, embed_model: StubEmbedding) -> None:
+    """
+    Replace the Vertex models with the stand-ins, before the chat engine is imported.
+    The model factories of `models.models` return the stand-ins, so neither the GCP client nor the Vertex SDK is loaded;
+    the tokenizer, which LlamaIndex otherwise downloads, becomes a whitespace split.
+    """
+    import models.models as models
+
+    generative_model = StubGenerativeModel(llm)
+    models.load_index_models = lambda: None
+    models.get_gemini_assistant = lambda: generative_model
+    models.get_generation_config = lambda temperature=None: None
+
+    Settings.llm = llm
+    Settings.embed_model = embed_model
+    Settings.tokenizer = str.split
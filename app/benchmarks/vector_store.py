@@ -0,0 +1,128 @@
+"""
+Benchmark of the NumPy vector store against the Chroma HNSW index, on synthetic clustered embeddings.
+For each backend it reports the recall@k against the exact float32 search, the latency of single queries,
+the throughput of a batch of queries and the size of the index in memory.
+
+    python app/benchmarks/vector_store.py --size 100000 --dim 768 --queries 200
+"""
+import numpy as np
+import tempfile
+import argparse
+import json
+import time
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from chat_engine.LoadIndex.numpy_vector_store import VectorMatrix
+
+PERCENTILES = (50, 95, 99)
+
+
+def synthetic_embeddings(size, dim, clusters, seed=0):
+    """
+    Embeddings grouped around random topics, as the descriptions of the columns of the same tables,
+    and queries close to random embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    embeddings = centers[rng.integers(clusters, size=size)] + 0.5 * rng.normal(size=(size, dim)).astype(np.float32)
+    return embeddings, rng
+
+
+def build_chroma(embeddings, ids, path):
+    import chromadb
+    from chromadb.config import Settings
+
+    client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+    collection = client.create_collection("benchmark", metadata={"hnsw:space": "cosine"})
+    batch_size = client.get_max_batch_size()
+    for i in range(0, len(ids), batch_size):
+        collection.add(ids=ids[i:i + batch_size], embeddings=embeddings[i:i + batch_size].tolist())
+    return collection
+
+
+def recall(results, truth, k):
+    return float(np.mean([len(set(r[:k]) & set(t[:k])) / k for r, t in zip(results, truth)]))
+
+
+def run_backend(search, queries, k):
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        search(query[None], k)
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    results = search(queries, k)
+    batch_time = time.perf_counter() - start_time
+
+    return results, {
+        **{f"p{p} latency (ms)": float(np.percentile(latencies, p)) * 1000 for p in PERCENTILES},
+        "batch QPS": len(queries) / batch_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy vector store against Chroma.")
+    parser.add_argument("--size", type=int, default=50_000, help="Number of embeddings.")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension (768 for text-embedding-004).")
+    parser.add_argument("--clusters", type=int, default=500, help="Number of topics of the synthetic embeddings.")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries.")
+    parser.add_argument("--top-k", type=int, default=10, help="Number of results of each query.")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32], help="IVF partitions scored by each query.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic embeddings.")
+    parser.add_argument("--output", help="JSON file the results are written to.")
+    args = parser.parse_args()
+
+    embeddings, rng = synthetic_embeddings(args.size, args.dim, args.clusters, args.seed)
+    ids = [str(i) for i in range(args.size)]
+    queries = embeddings[rng.integers(args.size, size=args.queries)] + 0.3 * rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    n_lists = int(np.sqrt(args.size))
+
+    start_time = time.perf_counter()
+    matrices = {
+        "numpy exact float32": VectorMatrix.build(ids, embeddings),
+        "numpy exact int8": VectorMatrix.build(ids, embeddings, quantization="int8"),
+        "numpy ivf float32": VectorMatrix.build(ids, embeddings, n_lists=n_lists),
+        "numpy ivf int8": VectorMatrix.build(ids, embeddings, quantization="int8", n_lists=n_lists),
+    }
+    numpy_build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    chroma_collection = build_chroma(embeddings, ids, tempfile.mkdtemp(prefix="chroma_benchmark_"))
+    chroma_build_time = time.perf_counter() - start_time
+
+    truth = matrices["numpy exact float32"].search(queries, args.top_k)[0]
+
+    backends = {"chroma hnsw": lambda q, k: chroma_collection.query(query_embeddings=q.tolist(), n_results=k, include=["distances"])["ids"]}
+    for name, matrix in matrices.items():
+        if "ivf" in name:
+            for nprobe in args.nprobe:
+                backends[f"{name} (nprobe {nprobe})"] = lambda q, k, matrix=matrix, nprobe=nprobe: matrix.search(q, k, nprobe=nprobe)[0]
+        else:
+            backends[name] = lambda q, k, matrix=matrix: matrix.search(q, k)[0]
+
+    results = {"size": args.size, "dim": args.dim, "numpy build (s)": numpy_build_time, "chroma build (s)": chroma_build_time, "backends": {}}
+    for name, search in backends.items():
+        found, timings = run_backend(search, queries, args.top_k)
+        matrix = next((m for n, m in matrices.items() if name.startswith(n)), None)
+        results["backends"][name] = {
+            f"recall@{args.top_k}": recall(found, truth, args.top_k),
+            **timings,
+            "matrix (MB)": matrix.embeddings.nbytes / 2 ** 20 if matrix is not None else None,
+        }
+
+    print(f"{'backend':<32} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'batch QPS':>10} {'MB':>8}")
+    for name, r in results["backends"].items():
+        size = f"{r['matrix (MB)']:.1f}" if r["matrix (MB)"] is not None else "-"
+        print(f"{name:<32} {r[f'recall@{args.top_k}']:>7.3f} {r['p50 latency (ms)']:>8.2f} {r['p95 latency (ms)']:>8.2f} {r['batch QPS']:>10.0f} {size:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+from llama_index.core.chat_engine import CondenseQuestionChatEngine
+from llama_index.core.base.llms.types import ChatMessage
+from bm25s.stopwords import STOPWORDS_ITALIAN
+from typing import List, Tuple
+import Stemmer
+import re
+from chat_engine.LogHandler.shell import shell_colors
+from chat_engine.LoadIndex.bm25_utils import BM25_LANGUAGE
+
+# Words referring to something said in the previous turns
+REFERENCE_WORDS = {
+    "questo", "questa", "questi", "queste", "quest",
+    "quello", "quella", "quelli", "quelle", "quell",
+    "esso", "essa", "essi", "esse", "suo", "sua", "suoi", "sue",
+    "stesso", "stessa", "stessi", "stesse", "ne",
+    "precedente", "precedenti", "sopra", "citato", "citata", "citati", "citate",
+    "menzionato", "menzionata", "menzionati", "menzionate",
+}
+# Words opening an elliptical follow-up, like "e la tabella prodotti?"
+CONTINUATION_WORDS = {"e", "ed", "ma", "invece", "anche", "oppure", "poi", "allora", "inoltre"}
+# Messages with at most this many content words are considered elliptical when they share a term with the previous turn
+SHORT_QUESTION_WORDS = 3
+
+
+def needs_condense(chat_history: List[ChatMessage], message: str) -> Tuple[bool, str]:
+    """
+    Cheap local check of whether a follow-up message needs the conversation context to be understood.
+
+    Args:
+        chat_history: the previous messages of the session.
+        message: the new message.
+
+    Returns:
+        - whether the message should be condensed.
+        - the reason of the decision.
+    """
+    words = re.findall(r"[^\W_]+", message.lower())
+    if not words:
+        return False, "empty message"
+    if any(w in REFERENCE_WORDS for w in words):
+        return True, "reference to the previous turns"
+    if words[0] in CONTINUATION_WORDS or message.strip().startswith("..."):
+        return True, "elliptical follow-up"
+
+    # Stemmers are not thread safe, so each call uses its own
+    stemmer = Stemmer.Stemmer(BM25_LANGUAGE)
+    terms = set(stemmer.stemWords([w for w in words if w not in STOPWORDS_ITALIAN]))
+    previous_turn = " ".join([m.content or "" for m in chat_history[-2:]])
+    previous_terms = set(stemmer.stemWords([w for w in re.findall(r"[^\W_]+", previous_turn.lower()) if w not in STOPWORDS_ITALIAN]))
+
+    if len(terms) <= SHORT_QUESTION_WORDS and terms & previous_terms:
+        return True, "short follow-up of the previous turn"
+
+    return False, "standalone question"
+
+
+class FastCondenseChatEngine(CondenseQuestionChatEngine):
+    """
+    Condense question chat engine calling the LLM only when the message needs the conversation context.
+    The follow-up messages go through `needs_condense`; the first turn of a session is left to LlamaIndex,
+    which never condenses it. The engine counts the condensation calls made and saved over the follow-ups,
+    so that the first turns do not count as savings.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.condense_calls = 0
+        self.condense_skipped = 0
+
+    def _skip_condense(self, chat_history: List[ChatMessage], last_message: str) -> bool:
+        condense, reason = needs_condense(chat_history, last_message)
+        if condense:
+            self.condense_calls += 1
+            print(f"{shell_colors['OKCYAN']}==> Condensing the question ({reason}){shell_colors['ENDC']}")
+        else:
+            self.condense_skipped += 1
+            print(f"{shell_colors['OKCYAN']}==> Condensation skipped ({reason}), {self.condense_skipped} of {self.condense_calls + self.condense_skipped} LLM calls saved in this session{shell_colors['ENDC']}")
+        return not condense
+
+    def _condense_question(self, chat_history: List[ChatMessage], last_message: str) -> str:
+        if chat_history and self._skip_condense(chat_history, last_message):
+            return last_message
+        return super()._condense_question(chat_history, last_message)
+
+    async def _acondense_question(self, chat_history: List[ChatMessage], last_message: str) -> str:
+        if chat_history and self._skip_condense(chat_history, last_message):
+            return last_message
+        return await super()._acondense_question(chat_history, last_message)
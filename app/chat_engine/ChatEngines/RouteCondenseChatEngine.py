@@ -0,0 +1,107 @@
+from llama_index.core.chat_engine import CondenseQuestionChatEngine
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.base.llms.generic_utils import messages_to_history_str
+from llama_index.core.output_parsers.utils import parse_json_markdown
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.selectors.llm_selectors import _build_choices_text
+from llama_index.core.tools.types import ToolMetadata
+from typing import List, Optional, Sequence
+from chat_engine.LogHandler.shell import shell_colors
+from chat_engine.Router.PreselectedSelector import preselected_tool
+from common.prompts_templates.PromptTemplates import ROUTE_CONDENSE_PROMPT
+
+
+class RouteCondenseChatEngine(CondenseQuestionChatEngine):
+    """
+    Condense question chat engine that also selects the tool in the same LLM call.
+    The structured answer holds the standalone question and the tool number; the tool is handed to the
+    router through `preselected_tool`, so that the router does not call its own selector.
+    The first turn of a session has nothing to condense, so its tool is selected by the router as usual.
+    If the answer cannot be parsed, the message is condensed and routed by the two usual calls.
+    """
+
+    def __init__(self, *args, tool_metadatas: Sequence[ToolMetadata] = (), **kwargs) -> None:
+        """
+        Args:
+            tool_metadatas: the tools of the router, in the same order.
+        """
+        super().__init__(*args, **kwargs)
+        self._tool_metadatas = list(tool_metadatas)
+        self._route_condense_prompt = PromptTemplate(ROUTE_CONDENSE_PROMPT)
+
+    @classmethod
+    def from_defaults(cls, *args, tool_metadatas: Sequence[ToolMetadata] = (), **kwargs) -> "RouteCondenseChatEngine":
+        chat_engine = super().from_defaults(*args, **kwargs)
+        chat_engine._tool_metadatas = list(tool_metadatas)
+        return chat_engine
+
+    def _parse(self, answer: str) -> Optional[tuple]:
+        try:
+            parsed = parse_json_markdown(answer)
+            question, choice = str(parsed["question"]).strip(), int(parsed["choice"])
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"{shell_colors['WARNING']}Cannot parse the route-and-condense answer ({e}), falling back to the separate calls{shell_colors['ENDC']}")
+            return None
+
+        if not question or not 1 <= choice <= len(self._tool_metadatas):
+            return None
+        return question, choice - 1
+
+    def _prompt_args(self, chat_history: List[ChatMessage], last_message: str) -> dict:
+        return dict(
+            num_choices=len(self._tool_metadatas),
+            context_list=_build_choices_text(self._tool_metadatas),
+            chat_history=messages_to_history_str(chat_history),
+            question=last_message,
+        )
+
+    def _preselect(self, parsed: Optional[tuple]) -> Optional[str]:
+        if parsed is None:
+            return None
+        question, index = parsed
+        preselected_tool.set(index)
+        print(f"{shell_colors['OKCYAN']}==> Condensed and routed to {self._tool_metadatas[index].name} with a single call{shell_colors['ENDC']}")
+        return question
+
+    def _condense_question(self, chat_history: List[ChatMessage], last_message: str) -> str:
+        if not chat_history or not self._tool_metadatas:
+            return super()._condense_question(chat_history, last_message)
+
+        answer = self._llm.predict(self._route_condense_prompt, **self._prompt_args(chat_history, last_message))
+        return self._preselect(self._parse(answer)) or super()._condense_question(chat_history, last_message)
+
+    async def _acondense_question(self, chat_history: List[ChatMessage], last_message: str) -> str:
+        if not chat_history or not self._tool_metadatas:
+            return await super()._acondense_question(chat_history, last_message)
+
+        answer = await self._llm.apredict(self._route_condense_prompt, **self._prompt_args(chat_history, last_message))
+        return self._preselect(self._parse(answer)) or await super()._acondense_question(chat_history, last_message)
+
+    # The preselection only holds for the current turn
+    def chat(self, *args, **kwargs):
+        token = preselected_tool.set(None)
+        try:
+            return super().chat(*args, **kwargs)
+        finally:
+            preselected_tool.reset(token)
+
+    def stream_chat(self, *args, **kwargs):
+        token = preselected_tool.set(None)
+        try:
+            return super().stream_chat(*args, **kwargs)
+        finally:
+            preselected_tool.reset(token)
+
+    async def achat(self, *args, **kwargs):
+        token = preselected_tool.set(None)
+        try:
+            return await super().achat(*args, **kwargs)
+        finally:
+            preselected_tool.reset(token)
+
+    async def astream_chat(self, *args, **kwargs):
+        token = preselected_tool.set(None)
+        try:
+            return await super().astream_chat(*args, **kwargs)
+        finally:
+            preselected_tool.reset(token)
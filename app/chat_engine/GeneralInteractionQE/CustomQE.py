@@ -1,13 +1,36 @@
 from llama_index.core.query_engine import CustomQueryEngine
 from llama_index.core.retrievers import BaseRetriever
 from llama_index.core.response_synthesizers import BaseSynthesizer
-from llama_index.core.base.response.schema import StreamingResponse
-from typing import Optional
+from llama_index.core.base.response.schema import StreamingResponse, AsyncStreamingResponse
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Callable, List, Optional, TYPE_CHECKING
+import asyncio
+import re
+from chat_engine.LogHandler.shell import shell_colors
 from common.prompts_templates.PromptTemplates import (
     MAPPING_SEARCH_RESPONSE, 
-    SYSTEM_PROMPT_ASSISTANT
+    CHATBOT_INFO_QUESTION
 )
-from models.models import gemini_flash
+
+if TYPE_CHECKING:
+    # The Vertex SDK is slow to import, so it is only imported when the answers are generated
+    from vertexai.generative_models import GenerativeModel
+
+
+def text_chunks(text: str):
+    """
+    Split a canned answer into word-sized chunks, each one streamed as a single token.
+    """
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+async def agen_from_text(text: str):
+    """
+    Async generator over the chunks of a text.
+    """
+    for chunk in text_chunks(text):
+        yield chunk
 
 
 class ProblemsReportingQueryEngine(CustomQueryEngine):
@@ -17,8 +40,13 @@ class ProblemsReportingQueryEngine(CustomQueryEngine):
     retriever: Optional[BaseRetriever]
     response_synthesizer: Optional[BaseSynthesizer]
 
+    response_text: str = "Grazie per la segnalazione. La problematica riscontrata verrà inviata a un assistente che provvederà alla verifica manuale."
+
     def custom_query(self, query_str: str):
-        return StreamingResponse(response_gen=(char for char in "Grazie per la segnalazione. La problematica riscontrata verrà inviata a un assistente che provvederà alla verifica manuale."))
+        return StreamingResponse(response_gen=iter(text_chunks(self.response_text)))
+
+    async def acustom_query(self, query_str: str):
+        return AsyncStreamingResponse(response_gen=agen_from_text(self.response_text))
 
 
 class GeneralInteractionQueryEngine(CustomQueryEngine):
@@ -28,20 +56,106 @@ class GeneralInteractionQueryEngine(CustomQueryEngine):
     retriever: Optional[BaseRetriever]
     response_synthesizer: Optional[BaseSynthesizer]
 
+    response_text: str = "Mi dispiace, la tua domanda non sembra riguardare alcun asset nel vecchio o nel nuovo DWH."
+
     def custom_query(self, query_str: str):
-        return StreamingResponse(response_gen=(char for char in "Mi dispiace, la tua domanda non sembra riguardare alcun asset nel vecchio o nel nuovo DWH."))
+        return StreamingResponse(response_gen=iter(text_chunks(self.response_text)))
+
+    async def acustom_query(self, query_str: str):
+        return AsyncStreamingResponse(response_gen=agen_from_text(self.response_text))
+
+
+class ChatbotInfoAnswers:
+    """
+    Pool of precomputed answers to the capabilities question, which only depend on the assistant system prompt.
+    Each variant is generated once, by the first request or by `prewarm`, whichever needs it first, and the other
+    callers wait for the same LLM call; the other variants are generated by `prewarm`, and the requests rotate over the pool.
+    """
+
+    def __init__(self, model: "GenerativeModel", generation_config: Callable[..., Any], size: int = 3, temperature: float = 1.0) -> None:
+        """
+        Args:
+            model: the Gemini instance with the assistant system instruction.
+            generation_config: the factory of the generation config, called with the temperature (see models.get_generation_config).
+            size: the number of variants.
+            temperature: the temperature of the variants after the first one, so that they differ.
+        """
+        self.model = model
+        self.generation_config = generation_config
+        self.size = size
+        self.temperature = temperature
+        self.answers = []
+        # The future of each variant, created by the first caller that needs it, which is the only one generating it
+        self._variants: List[Optional[Future]] = [None] * size
+        self._next = 0
+        self._lock = Lock()
+
+    def _generate(self, variant: int) -> str:
+        generation_config = self.generation_config(temperature=self.temperature) if variant > 0 else None
+        return self.model.generate_content(CHATBOT_INFO_QUESTION, generation_config=generation_config).text.strip()
+
+    def _variant(self, variant: int) -> str:
+        """
+        Get a variant, generating it once: the concurrent callers wait for the same generation.
+        A failed generation is not kept, so that the next caller tries again.
+        """
+        with self._lock:
+            future = self._variants[variant]
+            owner = future is None
+            if owner:
+                future = self._variants[variant] = Future()
+
+        if owner:
+            try:
+                answer = self._generate(variant)
+            except BaseException as e:
+                with self._lock:
+                    self._variants[variant] = None
+                future.set_exception(e)
+                raise
+            with self._lock:
+                self.answers.append(answer)
+            future.set_result(answer)
+        return future.result()
+
+    def prewarm(self) -> None:
+        """
+        Generate the missing variants, e.g., in a background thread at startup.
+        A failure is only reported: the missing answers are generated by the requests instead.
+        """
+        try:
+            for variant in range(self.size):
+                self._variant(variant)
+        except Exception as e:
+            print(f"{shell_colors['WARNING']}Chatbot info prewarm failed, the answers will be generated at the first request: {e}{shell_colors['ENDC']}")
+            return
+        print(f"{shell_colors['OKCYAN']}==> {len(self.answers)} chatbot info answers precomputed{shell_colors['ENDC']}")
+
+    def get(self) -> str:
+        if not self.answers:
+            self._variant(0)
+        with self._lock:
+            answer = self.answers[self._next % len(self.answers)]
+            self._next += 1
+            return answer
+
+    async def aget(self) -> str:
+        if not self.answers:
+            # Only the first requests of the process wait for the LLM
+            return await asyncio.to_thread(self.get)
+        return self.get()
 
 
 class ChatbotInfoQueryEngine(CustomQueryEngine):
     """
-    Tool for information about the chatbot.
+    Tool for information about the chatbot, answering from the precomputed pool without calling the LLM.
     """
     retriever: Optional[BaseRetriever]
     response_synthesizer: Optional[BaseSynthesizer]
+    answers: ChatbotInfoAnswers
 
     def custom_query(self, query_str: str):
-        model = gemini_flash
-        model._system_instruction = SYSTEM_PROMPT_ASSISTANT
-        response = model.generate_content(query_str)
-        response = response.text.strip()
-        return StreamingResponse(response_gen=(char for char in response))
+        return StreamingResponse(response_gen=iter(text_chunks(self.answers.get())))
+
+    async def acustom_query(self, query_str: str):
+        return AsyncStreamingResponse(response_gen=agen_from_text(await self.answers.aget()))
@@ -1,10 +1,14 @@
 from llama_index.core.tools import QueryEngineTool
+from threading import Thread
+import os
 from common.prompts_templates.PromptTemplates import TOOL_DESCRIPTIONS
 from chat_engine.GeneralInteractionQE.CustomQE import ( 
     ProblemsReportingQueryEngine,
     GeneralInteractionQueryEngine,
-    ChatbotInfoQueryEngine
+    ChatbotInfoQueryEngine,
+    ChatbotInfoAnswers
 ) 
+from models.models import get_gemini_assistant, get_generation_config
 
 
 
@@ -35,9 +39,14 @@ def build_GeneralInteractionQueryEngine():
 
 
 def build_ChatbotInfoQueryEngine():    
+    # The answers are precomputed in the background, so the capabilities question does not wait for the LLM
+    answers = ChatbotInfoAnswers(get_gemini_assistant(), get_generation_config, size=int(os.getenv("CHATBOT_INFO_VARIANTS") or 3))
+    Thread(target=answers.prewarm, daemon=True, name="ChatbotInfoPrewarm").start()
+
     qe = ChatbotInfoQueryEngine(
         retriever=None,
         response_synthesizer=None,
+        answers=answers,
     )
 
     return QueryEngineTool.from_defaults(
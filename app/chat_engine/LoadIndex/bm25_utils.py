@@ -0,0 +1,152 @@
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+from chat_engine.LoadIndex.chroma_utils import iter_chroma_pages, read_catalog_version
+from chat_engine.LogHandler.shell import shell_colors
+import bm25s
+import Stemmer
+import json
+import os
+
+BM25_LANGUAGE = "italian"
+BM25_TOP_K = 10
+
+
+def get_bm25_path(collection_name):
+    """
+    Get the folder of the persisted BM25 index of a collection.
+    By default, the indices are stored in the "bm25" folder next to the Chroma collections.
+    """
+    bm25_root = os.getenv("BM25_PATH") or os.path.join(os.getenv("CHROMA_PATH"), "bm25")
+    return os.path.join(bm25_root, collection_name)
+
+
+class LazyBM25Retriever(BaseRetriever):
+    """
+    BM25 retriever over an index whose corpus only holds the node ids.
+    The nodes are hydrated from the node store only for the top k results of each query.
+    Reference: https://docs.llamaindex.ai/en/stable/examples/retrievers/bm25_retriever/
+    """
+
+    def __init__(self, bm25, node_store, similarity_top_k=BM25_TOP_K, verbose=True):
+        """
+        Args:
+            bm25: the BM25 index, with the node ids as corpus.
+            node_store: the ChromaNodeStore of the collection.
+            similarity_top_k: the number of nodes to retrieve.
+            verbose: whether to print the retrieval progress.
+        """
+        self.bm25 = bm25
+        self.node_store = node_store
+        self.similarity_top_k = min(similarity_top_k, bm25.scores["num_docs"])
+        super().__init__(verbose=verbose)
+
+    def retrieve_batch(self, query_strs):
+        """
+        Retrieve the nodes of several queries, scoring all of them with a single bm25s call
+        and hydrating their nodes with a single node store read.
+
+        Returns:
+            - the nodes of each query.
+        """
+        # Stemmers are not thread safe, so each call uses its own
+        query_tokens = bm25s.tokenize(query_strs, stopwords=BM25_LANGUAGE, stemmer=Stemmer.Stemmer(BM25_LANGUAGE), show_progress=False)
+        documents, scores = self.bm25.retrieve(query_tokens, k=self.similarity_top_k, show_progress=False)
+
+        node_ids = [[document["node_id"] for document in row] for row in documents]
+        flat_ids = [node_id for row in node_ids for node_id in row]
+        nodes = dict(zip(flat_ids, self.node_store.get_nodes(flat_ids)))
+        missing = sum(node is None for node in nodes.values())
+        if missing:
+            print(f"{shell_colors['WARNING']}{missing} BM25 results are no longer in the collection, the BM25 index is out of date{shell_colors['ENDC']}")
+        return [
+            [NodeWithScore(node=nodes[node_id], score=float(score)) for node_id, score in zip(row, row_scores) if nodes[node_id] is not None]
+            for row, row_scores in zip(node_ids, scores)
+            ]
+
+    def _retrieve(self, query_bundle):
+        return self.retrieve_batch([query_bundle.query_str])[0]
+
+
+def build_bm25_index(chroma_collection):
+    """
+    Build the BM25 index of a collection, paging through the stored documents.
+    Only the text of the documents is read: the corpus of the index holds the node id of each of them.
+    """
+    node_ids, corpus_tokens = [], []
+    stemmer = Stemmer.Stemmer(BM25_LANGUAGE) # Removes stop words and stems each word
+    for page in iter_chroma_pages(chroma_collection, include=["documents"]):
+        node_ids.extend(page["ids"])
+        corpus_tokens.extend(bm25s.tokenize(page["documents"], stopwords=BM25_LANGUAGE, stemmer=stemmer, return_ids=False, show_progress=False))
+
+    bm25 = bm25s.BM25()
+    bm25.index(corpus_tokens, show_progress=False)
+    bm25.corpus = [{"node_id": node_id} for node_id in node_ids]
+    return bm25
+
+
+def read_bm25_catalog_version(collection_name):
+    """
+    Read the catalog version of the Chroma store the persisted BM25 index was built from (None if there is none).
+    """
+    try:
+        with open(os.path.join(get_bm25_path(collection_name), "catalog_version.json")) as f:
+            return json.load(f)["catalog_version"]
+    except FileNotFoundError:
+        return None
+
+
+def persist_bm25_index(chroma_collection, collection_name, catalog_version):
+    """
+    Build and persist the BM25 index of a collection.
+    The vocabulary, the postings and the node ids are written as array-backed files.
+
+    Args:
+        chroma_collection: the Chroma collection.
+        collection_name: the name of the collection.
+        catalog_version: the catalog version of the Chroma store (see write_catalog_version), stamped on the index.
+
+    Returns:
+        - the folder of the persisted index.
+    """
+    path = get_bm25_path(collection_name)
+    os.makedirs(path, exist_ok=True)
+    stamp_path = os.path.join(path, "catalog_version.json")
+    # Removed first and written last, so that an interrupted save is never loaded
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    bm25 = build_bm25_index(chroma_collection)
+    bm25.save(path, corpus=bm25.corpus)
+    with open(stamp_path, "w") as f:
+        json.dump({"catalog_version": catalog_version}, f)
+    return path
+
+
+def load_bm25_retriever(collection_name, node_store):
+    """
+    Load the BM25 retriever of a collection.
+    The persisted index is memory-mapped, so that the worker processes share the same pages.
+    If it is missing or out of date, the index is built in memory from the collection.
+    The index is up to date if it was built from the current catalog version of the Chroma store:
+    an ingestion changing the content without changing the number of nodes, or interrupted before
+    persisting the index, leaves a different version.
+
+    Args:
+        collection_name: the name of the collection.
+        node_store: the ChromaNodeStore of the collection, used to check the index and to hydrate the nodes.
+
+    Returns:
+        - the BM25 retriever.
+    """
+    path = get_bm25_path(collection_name)
+
+    if os.path.exists(os.path.join(path, "params.index.json")):
+        bm25 = bm25s.BM25.load(path, load_corpus=True, mmap=True)
+
+        # Indices written before the corpus held the node ids only are rebuilt as well
+        if os.path.exists(os.path.join(path, "catalog_version.json")) and read_bm25_catalog_version(collection_name) == read_catalog_version() \
+                and bm25.scores["num_docs"] == len(node_store) and (not len(node_store) or "node_id" in bm25.corpus[0]):
+            return LazyBM25Retriever(bm25, node_store)
+
+        print(f"BM25 index in {path} is out of date, run the ingestion again to rebuild it.")
+
+    return LazyBM25Retriever(build_bm25_index(node_store.chroma_collection), node_store)
@@ -1,5 +1,14 @@
-from llama_index.core.schema import TextNode
+from llama_index.core.schema import TextNode, MetadataMode, NodeWithScore
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from collections import OrderedDict
+from threading import Lock
 import json 
+import math
+import uuid
+import os
+
+# Number of records read by each Chroma call when paging through a collection
+CHROMA_PAGE_SIZE = 5000
 
 def parse_chroma_node(chroma_record):
     node = json.loads(chroma_record[0]["_node_content"])
@@ -8,6 +17,123 @@ def parse_chroma_node(chroma_record):
     node["text"] = text
     return TextNode(**node)
 
-def get_chroma_nodes(chroma_collection):
-    collection_nodes = chroma_collection.get()
-    return [parse_chroma_node(x) for x in zip(collection_nodes["metadatas"], collection_nodes["documents"])]
\ No newline at end of file
+def iter_chroma_pages(chroma_collection, include, page_size=CHROMA_PAGE_SIZE):
+    """
+    Page through the records of a collection, yielding the result of each Chroma call.
+    """
+    for offset in range(0, chroma_collection.count(), page_size):
+        yield chroma_collection.get(include=include, limit=page_size, offset=offset)
+
+class ChromaNodeStore:
+    """
+    Lazy view over the nodes of a Chroma collection.
+    Only the node ids are read at startup, into a compact id -> offset map; the full TextNode objects
+    are hydrated on demand, for the few nodes returned by a query, and kept in an LRU cache.
+    """
+
+    def __init__(self, chroma_collection, cache_size=1024, page_size=CHROMA_PAGE_SIZE):
+        """
+        Args:
+            chroma_collection: the Chroma collection.
+            cache_size: the maximum number of hydrated nodes kept in memory.
+            page_size: the number of ids read by each Chroma call.
+        """
+        self.chroma_collection = chroma_collection
+        self.cache_size = cache_size
+        self.offsets = {}
+        for page in iter_chroma_pages(chroma_collection, include=[], page_size=page_size):
+            self.offsets.update({node_id: offset for offset, node_id in enumerate(page["ids"], start=len(self.offsets))})
+
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, node_id):
+        return node_id in self.offsets
+
+    def get_nodes(self, node_ids):
+        """
+        Hydrate the nodes with the given ids, reading the ones missing from the cache with a single Chroma call.
+
+        Returns:
+            - the nodes, in the same order as the ids (None for the ids not in the collection).
+        """
+        with self._lock:
+            found = {node_id: self._cache[node_id] for node_id in node_ids if node_id in self._cache}
+            for node_id in found:
+                self._cache.move_to_end(node_id)
+
+        missing = [node_id for node_id in dict.fromkeys(node_ids) if node_id not in found and node_id in self.offsets]
+        if missing:
+            records = self.chroma_collection.get(ids=missing, include=["metadatas", "documents"])
+            hydrated = {node_id: parse_chroma_node(record) for node_id, record in zip(records["ids"], zip(records["metadatas"], records["documents"]))}
+            found.update(hydrated)
+
+            with self._lock:
+                self._cache.update(hydrated)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return [found.get(node_id) for node_id in node_ids]
+
+    def search(self, query_embeddings, top_k):
+        """
+        Vector search of several query embeddings with a single Chroma query, hydrating the nodes through the cache.
+        The scores are the similarities of the LlamaIndex Chroma vector store, exp(-distance).
+
+        Returns:
+            - the top_k nodes of each query embedding.
+        """
+        if not query_embeddings or not len(self):
+            return [[] for _ in query_embeddings]
+
+        results = self.chroma_collection.query(query_embeddings=query_embeddings, n_results=min(top_k, len(self)), include=["distances"])
+        flat_ids = [node_id for ids in results["ids"] for node_id in ids]
+        nodes = dict(zip(flat_ids, self.get_nodes(flat_ids)))
+        return [
+            [NodeWithScore(node=nodes[node_id], score=math.exp(-distance)) for node_id, distance in zip(ids, distances) if nodes[node_id] is not None]
+            for ids, distances in zip(results["ids"], results["distances"])
+            ]
+
+def get_catalog_version_path():
+    return os.path.join(os.getenv("CHROMA_PATH"), "catalog_version")
+
+def write_catalog_version():
+    """
+    Mark the content of the Chroma store as changed, called by the ingestion before and after each update.
+
+    Returns:
+        - the new version.
+    """
+    catalog_version = str(uuid.uuid4())
+    with open(get_catalog_version_path(), "w") as f:
+        f.write(catalog_version)
+    return catalog_version
+
+def read_catalog_version():
+    """
+    Read the version written by the last ingestion that changed the Chroma store (None if there is none).
+    """
+    try:
+        with open(get_catalog_version_path()) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def to_chroma_metadata(node):
+    # Same format written by ChromaVectorStore.add, so that the nodes can be parsed back
+    metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=True)
+    return {k: ("" if v is None else v) for k, v in metadata.items()}
+
+def upsert_chroma_nodes(chroma_collection, nodes):
+    """
+    Write a batch of embedded nodes to the collection with a single Chroma call.
+    """
+    chroma_collection.upsert(
+        ids=[node.node_id for node in nodes],
+        embeddings=[node.get_embedding() for node in nodes],
+        metadatas=[to_chroma_metadata(node) for node in nodes],
+        documents=[node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes],
+    )
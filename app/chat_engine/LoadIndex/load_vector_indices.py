@@ -1,26 +1,40 @@
-from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core import StorageContext, VectorStoreIndex, Settings as IndexSettings
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from chat_engine.LoadIndex.chroma_utils import get_chroma_nodes
+from chat_engine.LoadIndex.chroma_utils import ChromaNodeStore
+from chat_engine.LoadIndex.numpy_vector_store import load_numpy_vector_store
 from chat_engine.LogHandler.shell import shell_colors
 import chromadb
 from chromadb.config import Settings
 import os
 
+VECTOR_STORE_BACKENDS = ("chroma", "numpy")
+
 def load_vector_indices():
     """
     Load the Chroma vector database.
+    The vectors are searched by the Chroma HNSW index, or by the NumPy vector store if VECTOR_STORE_BACKEND is "numpy".
 
     Returns:
-        - the list of nodes for each collection.
+        - the lazy node store of each collection.
         - the vector indices for each collection.
     """
     chroma_client = chromadb.PersistentClient(path=os.getenv("CHROMA_PATH"), settings = Settings(anonymized_telemetry=True))
+    vector_store_backend = os.getenv("VECTOR_STORE_BACKEND") or "chroma"
+    if vector_store_backend not in VECTOR_STORE_BACKENDS:
+        raise ValueError(f"Unknown vector store backend {vector_store_backend}, expected one of {VECTOR_STORE_BACKENDS}.")
 
     vector_indices = {}
     nodes = {}
     for collection in chroma_client.list_collections():
         chroma_collection = chroma_client.get_or_create_collection(collection.name, metadata={"hnsw:space": "cosine"})
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+
+        # Only the node ids are loaded here, the nodes are hydrated when a query returns them
+        nodes[collection.name] = ChromaNodeStore(chroma_collection, cache_size=int(os.getenv("NODE_CACHE_SIZE") or 1024))
+
+        if vector_store_backend == "numpy":
+            vector_store = load_numpy_vector_store(collection.name, nodes[collection.name], embed_model=IndexSettings.embed_model.model_name)
+        else:
+            vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
             
         storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
@@ -29,8 +43,6 @@ def load_vector_indices():
             storage_context=storage_context,
         )
 
-        nodes[collection.name] = get_chroma_nodes(chroma_collection)
-
     print(f"\n{shell_colors['BOLD']}{shell_colors['HEADER']}Available Documents: {shell_colors['ENDC']}{shell_colors['ENDC']}", "\n".join([f"\t- {shell_colors['OKBLUE']}\"{key}\"{shell_colors['ENDC']} - {len(val)} nodes" for key,val in nodes.items()]), sep="\n")
         
     return nodes, vector_indices
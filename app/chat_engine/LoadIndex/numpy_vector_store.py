@@ -0,0 +1,351 @@
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+from chat_engine.LoadIndex.chroma_utils import iter_chroma_pages, read_catalog_version
+from typing import Any, List, Optional, Sequence, Tuple
+import numpy as np
+import json
+import os
+
+QUANTIZATIONS = ("float32", "int8")
+# Collections with at least this many nodes are searched through the IVF partitions instead of exhaustively
+IVF_MIN_SIZE = 50_000
+IVF_NPROBE = 16
+# Rows scored by each matrix product, so that the int8 rows converted to float32 fit in the CPU caches
+SCORE_CHUNK_SIZE = 16_384
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, in decreasing order.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    indices = np.argpartition(-scores, k - 1)[:k]
+    return indices[np.argsort(-scores[indices], kind="stable")]
+
+
+def spherical_kmeans(embeddings: np.ndarray, n_lists: int, iterations: int = 10, sample_size: Optional[int] = None, seed: int = 0) -> np.ndarray:
+    """
+    Centroids of the IVF partitions, trained on a sample of the normalized embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(embeddings), sample_size or n_lists * 64)
+    sample = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        # The empty partitions keep their centroid
+        filled = np.bincount(assignments, minlength=n_lists) > 0
+        centroids[filled] = normalize(sums[filled])
+    return centroids
+
+
+class VectorMatrix:
+    """
+    Normalized embeddings of a collection in a contiguous matrix, searched by cosine similarity with NumPy.
+    The rows are float32, or int8 with a scale per row. With IVF partitions, the rows are sorted by partition,
+    and a query only scores the rows of the `nprobe` partitions whose centroids are the most similar to it.
+    """
+
+    def __init__(self, ids: List[str], embeddings: np.ndarray, scales: Optional[np.ndarray] = None, centroids: Optional[np.ndarray] = None, list_offsets: Optional[np.ndarray] = None) -> None:
+        """
+        Args:
+            ids: the node id of each row.
+            embeddings: the normalized embeddings, float32 or int8.
+            scales: the scale of each int8 row (None for float32 rows).
+            centroids: the centroids of the IVF partitions (None for the exhaustive search).
+            list_offsets: the first row of each partition, followed by the number of rows.
+        """
+        self.ids = ids
+        self.embeddings = embeddings
+        self.scales = scales
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def quantization(self) -> str:
+        return "int8" if self.scales is not None else "float32"
+
+    @classmethod
+    def build(cls, ids: List[str], embeddings: np.ndarray, quantization: str = "float32", n_lists: Optional[int] = None) -> "VectorMatrix":
+        """
+        Build the matrix of a collection.
+
+        Args:
+            ids: the node id of each embedding.
+            embeddings: the embeddings.
+            quantization: "float32" or "int8".
+            n_lists: the number of IVF partitions (None or 0 for the exhaustive search).
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}.")
+
+        embeddings = normalize(np.asarray(embeddings, dtype=np.float32))
+        centroids = list_offsets = None
+        if n_lists and len(ids) > n_lists:
+            centroids = spherical_kmeans(embeddings, n_lists)
+            assignments = np.concatenate([np.argmax(embeddings[i:i + SCORE_CHUNK_SIZE] @ centroids.T, axis=1) for i in range(0, len(embeddings), SCORE_CHUNK_SIZE)])
+            order = np.argsort(assignments, kind="stable")
+            embeddings, ids = embeddings[order], [ids[i] for i in order]
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+
+        scales = None
+        if quantization == "int8" and len(ids):
+            scales = np.abs(embeddings).max(axis=1) / 127
+            embeddings = np.round(embeddings / np.where(scales > 0, scales, 1)[:, None]).astype(np.int8)
+            scales = scales.astype(np.float32)
+
+        return cls(list(ids), np.ascontiguousarray(embeddings), scales, centroids, list_offsets)
+
+    def save(self, path: str, catalog_version: Optional[str] = None, embed_model: Optional[str] = None) -> None:
+        """
+        Save the matrix, recording the catalog version of the Chroma store and the embedding model it was built from.
+        """
+        os.makedirs(path, exist_ok=True)
+        # Removed first and written last, so that an interrupted save is never loaded
+        if os.path.exists(os.path.join(path, "params.json")):
+            os.remove(os.path.join(path, "params.json"))
+        np.save(os.path.join(path, "embeddings.npy"), self.embeddings)
+        for name in ("scales", "centroids", "list_offsets"):
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump(self.ids, f)
+        with open(os.path.join(path, "params.json"), "w") as f:
+            json.dump({
+                "num_docs": len(self.ids),
+                "quantization": self.quantization,
+                "n_lists": len(self.centroids) if self.centroids is not None else 0,
+                "catalog_version": catalog_version,
+                "embed_model": embed_model,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "VectorMatrix":
+        """
+        Load a saved matrix; with mmap, the rows are memory-mapped, so that the worker processes share the same pages.
+        """
+        def load_array(name):
+            filename = os.path.join(path, f"{name}.npy")
+            return np.load(filename, mmap_mode="r" if mmap else None) if os.path.exists(filename) else None
+
+        with open(os.path.join(path, "ids.json")) as f:
+            ids = json.load(f)
+        return cls(ids, load_array("embeddings"), load_array("scales"), load_array("centroids"), load_array("list_offsets"))
+
+    def _scores(self, start: int, end: int, queries: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarities between the rows from start to end and the normalized queries, as a (rows, queries) matrix.
+        """
+        scores = np.empty((end - start, len(queries)), dtype=np.float32)
+        for i in range(start, end, SCORE_CHUNK_SIZE):
+            j = min(i + SCORE_CHUNK_SIZE, end)
+            rows = self.embeddings[i:j]
+            if self.scales is None:
+                scores[i - start:j - start] = rows @ queries.T
+            else:
+                scores[i - start:j - start] = (rows.astype(np.float32) @ queries.T) * self.scales[i:j, None]
+        return scores
+
+    def search(self, query_embeddings, k: int, nprobe: int = IVF_NPROBE) -> Tuple[List[List[str]], List[List[float]]]:
+        """
+        Batched cosine top-k search.
+
+        Args:
+            query_embeddings: the query embeddings.
+            k: the number of results of each query.
+            nprobe: the number of IVF partitions scored by each query.
+
+        Returns:
+            - the node ids of each query.
+            - their cosine similarities.
+        """
+        queries = normalize(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        if not len(self) or not len(queries):
+            return [[] for _ in queries], [[] for _ in queries]
+
+        ids, similarities = [], []
+        if self.centroids is None:
+            scores = self._scores(0, len(self), queries)
+            for column in range(len(queries)):
+                best = top_k(scores[:, column], k)
+                ids.append([self.ids[i] for i in best])
+                similarities.append(scores[best, column].tolist())
+            return ids, similarities
+
+        probed_lists = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        for query, lists in zip(queries, probed_lists):
+            ranges = [(int(self.list_offsets[l]), int(self.list_offsets[l + 1])) for l in sorted(lists)]
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+            scores = np.concatenate([self._scores(start, end, query[None])[:, 0] for start, end in ranges])
+            best = top_k(scores, k)
+            ids.append([self.ids[rows[i]] for i in best])
+            similarities.append(scores[best].tolist())
+        return ids, similarities
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Read-only LlamaIndex vector store over the VectorMatrix of a collection, in place of the Chroma HNSW index.
+    The nodes are hydrated from the node store of the collection, and the scores are on the same scale as
+    the Chroma vector store with cosine distance, exp(cosine similarity - 1).
+    The matrix is written by the ingestion, so the nodes cannot be added or deleted here.
+    """
+    stores_text: bool = True
+    nprobe: int = IVF_NPROBE
+
+    _matrix: VectorMatrix = PrivateAttr()
+    _node_store: Any = PrivateAttr()
+
+    def __init__(self, matrix: VectorMatrix, node_store, nprobe: int = IVF_NPROBE) -> None:
+        """
+        Args:
+            matrix: the embedding matrix of the collection.
+            node_store: the ChromaNodeStore of the collection.
+            nprobe: the number of IVF partitions scored by each query.
+        """
+        super().__init__(stores_text=True, nprobe=nprobe)
+        self._matrix = matrix
+        self._node_store = node_store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> VectorMatrix:
+        return self._matrix
+
+    def add(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[str]:
+        raise NotImplementedError("The embedding matrix is written by the ingestion, see persist_vector_matrix.")
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        raise NotImplementedError("The embedding matrix is written by the ingestion, see persist_vector_matrix.")
+
+    def search(self, query_embeddings, top_k: int) -> List[List[NodeWithScore]]:
+        """
+        Vector search of several query embeddings with a single matrix product, with the interface of ChromaNodeStore.search.
+
+        Returns:
+            - the top_k nodes of each query embedding.
+        """
+        ids, similarities = self._matrix.search(query_embeddings, top_k, nprobe=self.nprobe)
+        flat_ids = [node_id for row in ids for node_id in row]
+        nodes = dict(zip(flat_ids, self._node_store.get_nodes(flat_ids)))
+        return [
+            [NodeWithScore(node=nodes[node_id], score=float(np.exp(similarity - 1))) for node_id, similarity in zip(row, row_similarities) if nodes[node_id] is not None]
+            for row, row_similarities in zip(ids, similarities)
+            ]
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise NotImplementedError("Metadata filters are not supported by the NumPy vector store.")
+
+        results = self.search([query.query_embedding], query.similarity_top_k)[0]
+        return VectorStoreQueryResult(
+            nodes=[n.node for n in results],
+            similarities=[n.score for n in results],
+            ids=[n.node.node_id for n in results],
+        )
+
+
+def get_vector_matrix_path(collection_name):
+    """
+    Get the folder of the persisted embedding matrix of a collection.
+    By default, the matrices are stored in the "vectors" folder next to the Chroma collections.
+    """
+    vectors_root = os.getenv("VECTOR_MATRIX_PATH") or os.path.join(os.getenv("CHROMA_PATH"), "vectors")
+    return os.path.join(vectors_root, collection_name)
+
+
+def build_vector_matrix(chroma_collection, quantization: Optional[str] = None, ivf_min_size: Optional[int] = None) -> VectorMatrix:
+    """
+    Build the embedding matrix of a collection, paging through the stored embeddings.
+    Collections with at least `ivf_min_size` nodes get sqrt(n) IVF partitions.
+
+    Args:
+        chroma_collection: the Chroma collection.
+        quantization: "float32" or "int8", defaults to VECTOR_QUANTIZATION or "float32".
+        ivf_min_size: the minimum size of a partitioned collection, defaults to VECTOR_IVF_MIN_SIZE or 50000.
+    """
+    quantization = quantization or os.getenv("VECTOR_QUANTIZATION") or "float32"
+    ivf_min_size = ivf_min_size or int(os.getenv("VECTOR_IVF_MIN_SIZE") or IVF_MIN_SIZE)
+
+    node_ids, embeddings = [], []
+    for page in iter_chroma_pages(chroma_collection, include=["embeddings"]):
+        node_ids.extend(page["ids"])
+        embeddings.append(np.asarray(page["embeddings"], dtype=np.float32))
+    embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+    n_lists = int(np.sqrt(len(node_ids))) if len(node_ids) >= ivf_min_size else 0
+    return VectorMatrix.build(node_ids, embeddings, quantization=quantization, n_lists=n_lists)
+
+
+def read_vector_matrix_params(collection_name):
+    """
+    Read the parameters of the persisted embedding matrix of a collection (None if there is none).
+    """
+    try:
+        with open(os.path.join(get_vector_matrix_path(collection_name), "params.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def persist_vector_matrix(chroma_collection, collection_name, catalog_version, embed_model):
+    """
+    Build and persist the embedding matrix of a collection.
+
+    Args:
+        chroma_collection: the Chroma collection.
+        collection_name: the name of the collection.
+        catalog_version: the catalog version of the Chroma store (see write_catalog_version), stamped on the matrix.
+        embed_model: the name of the model that embedded the collection.
+
+    Returns:
+        - the folder of the persisted matrix.
+    """
+    path = get_vector_matrix_path(collection_name)
+    build_vector_matrix(chroma_collection).save(path, catalog_version=catalog_version, embed_model=embed_model)
+    return path
+
+
+def load_numpy_vector_store(collection_name, node_store, embed_model=None):
+    """
+    Load the NumPy vector store of a collection, memory-mapping its persisted matrix.
+    If it is missing or out of date, the matrix is built in memory from the collection.
+    The matrix is up to date if it was built from the current catalog version of the Chroma store,
+    with the embedding model of the queries.
+
+    Args:
+        collection_name: the name of the collection.
+        node_store: the ChromaNodeStore of the collection, used to check the matrix and to hydrate the nodes.
+        embed_model: the name of the model embedding the queries.
+
+    Returns:
+        - the vector store.
+    """
+    path = get_vector_matrix_path(collection_name)
+    nprobe = int(os.getenv("VECTOR_IVF_NPROBE") or IVF_NPROBE)
+
+    params = read_vector_matrix_params(collection_name)
+    if params is not None:
+        if params.get("catalog_version") == read_catalog_version() and params.get("embed_model") == embed_model and params["num_docs"] == len(node_store):
+            return NumpyVectorStore(VectorMatrix.load(path), node_store, nprobe=nprobe)
+
+        print(f"Embedding matrix in {path} is out of date, run the ingestion again to rebuild it.")
+
+    return NumpyVectorStore(build_vector_matrix(node_store.chroma_collection), node_store, nprobe=nprobe)
@@ -1,5 +1,8 @@
+from contextvars import ContextVar
 from datetime import datetime
+from threading import Lock
 from typing import Any, Dict, List, Optional
+import asyncio
 import json
 
 from chainlit.context import context_var
@@ -7,6 +10,7 @@ from chainlit.element import Text
 from chainlit.step import Step, StepType
 
 from llama_index.core.callbacks import TokenCountingHandler
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
 from llama_index.core.callbacks.schema import CBEventType, EventPayload
 
 DEFAULT_IGNORE = [
@@ -25,7 +29,15 @@ DEFAULT_IGNORE = [
 
 
 class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
-    """Base callback handler that can be used to track event starts and ends."""
+    """
+    Base callback handler that can be used to track event starts and ends.
+
+    The callbacks only build the steps, which are sent to Chainlit by the event loop of the session:
+        - each step is sent once, when its event ends, with both its start and end;
+        - the finished steps are queued from any thread, and flushed in batches at most every `flush_interval` seconds;
+        - the text of the inputs, outputs and elements is truncated to `max_chars` characters.
+    Since the steps are sent when they end, a step whose parent is still running is attached to the current step of the session.
+    """
 
     steps: Dict[str, Step]
 
@@ -33,18 +45,32 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
         self,
         event_starts_to_ignore: List[CBEventType] = DEFAULT_IGNORE,
         event_ends_to_ignore: List[CBEventType] = DEFAULT_IGNORE,
+        max_chars: int = 2000,
+        flush_interval: float = 0.1,
     ) -> None:
-        """Initialize the base callback handler."""
+        """
+        Initialize the base callback handler.
+
+        Args:
+            max_chars: the maximum length of the text of a step (0 disables the truncation).
+            flush_interval: the minimum time between two batches of steps sent to Chainlit, in seconds.
+        """
         super().__init__(
             event_starts_to_ignore=event_starts_to_ignore,
             event_ends_to_ignore=event_ends_to_ignore,
         )
         self.context = context_var.get()
+        self.max_chars = max_chars
+        self.flush_interval = flush_interval
 
         self.steps = {}
+        self._sent_step_ids = set()
+        self._queue = []
+        self._flush_scheduled = False
+        self._lock = Lock()
 
     def _get_parent_id(self, event_parent_id: Optional[str] = None) -> Optional[str]:
-        if event_parent_id and event_parent_id in self.steps:
+        if event_parent_id and event_parent_id in self._sent_step_ids:
             return event_parent_id
         elif self.context.current_step:
             return self.context.current_step.id
@@ -66,6 +92,36 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
         """
         context_var.set(self.context)
 
+    def _truncate(self, text: Any) -> Any:
+        if not isinstance(text, str) or not self.max_chars or len(text) <= self.max_chars:
+            return text
+        return text[:self.max_chars] + f"\n\n[... {len(text) - self.max_chars} caratteri omessi]"
+
+    def _text(self, name: str, content: str, **kwargs: Any) -> Text:
+        return Text(name=name, content=self._truncate(content), **kwargs)
+
+    def _enqueue(self, step: Step) -> None:
+        # Thread-safe: the steps are sent by a single flush task on the loop of the session
+        with self._lock:
+            self._queue.append(step)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        asyncio.run_coroutine_threadsafe(self._flush(), self.context.loop)
+
+    async def _flush(self) -> None:
+        context_var.set(self.context)
+        await asyncio.sleep(self.flush_interval)
+        with self._lock:
+            batch, self._queue = self._queue, []
+            self._flush_scheduled = False
+
+        for step in batch:
+            try:
+                await step.send()
+            except Exception as e:
+                print(f"[LLamaIndexCallbackHandler] - Cannot send step {step.name}: {e}")
+
     def on_event_start(
         self,
         event_type: CBEventType,
@@ -107,11 +163,9 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
             disable_feedback=False,
             show_input=True
         )
-        print(f"START STEP --> {step.to_dict()}")
         self.steps[event_id] = step
         step.start = datetime.utcnow().isoformat()
         step.input = payload.get(EventPayload.QUERY_STR) if (event_type == CBEventType.RERANKING or event_type == CBEventType.RETRIEVE) else (payload or {})
-        self.context.loop.create_task(step.send())
         return event_id
 
     def on_event_end(
@@ -122,7 +176,7 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
         **kwargs: Any,
     ) -> None:
         """Run when an event ends."""
-        step = self.steps.get(event_id, None)
+        step = self.steps.pop(event_id, None)
 
         if payload is None or step is None:
             return
@@ -140,7 +194,7 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
                     step.name = "Vector Retrieval"
                 source_refs = "\, ".join([f"Fonte {idx}" for idx, _ in enumerate(sources)])
 
-                step.elements = [Text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node",) for idx, source in enumerate(sources)]
+                step.elements = [self._text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node",) for idx, source in enumerate(sources)]
                 step.input = "**Input query**: " + (step.input or "Empty Input")
                 step.output = f"**Recuperate le seguenti fonti**: {source_refs}"
         
@@ -154,7 +208,7 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
                 step.name = "Tool Selection"
             elif response.source_nodes:
                 source_refs = "\, ".join([f"Fonte {idx}" for idx, _ in enumerate(response.source_nodes)])
-                step.elements = [Text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node",) for idx, source in enumerate(response.source_nodes)]
+                step.elements = [self._text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node",) for idx, source in enumerate(response.source_nodes)]
 
                 step.input = "**Input query for selected Tool**: " + json.loads(step.input)['query_str']
                 step.output = f"**Tool Sources**: {source_refs}"
@@ -175,8 +229,8 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
                 step.input = "Input query: " + json.loads(step.input)['query_str']
                 step.output = f"Generata la seguente SubQuestion" + "\nIntermediate answer"
                 step.elements = [
-                    Text(name=f"SubQuestion", content=subquestion.sub_q or "Empty SubQuestion"), 
-                    Text(name=f"Intermediate Answer", content=subquestion.answer or "Empty Answer")
+                    self._text(name=f"SubQuestion", content=subquestion.sub_q or "Empty SubQuestion"), 
+                    self._text(name=f"Intermediate Answer", content=subquestion.answer or "Empty Answer")
                     ]
 
         elif event_type == CBEventType.LLM:
@@ -198,8 +252,8 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
                 step.input = "Input Prompt"
                 step.output = "LLM Output"
                 step.elements = [
-                    Text(name=f"Input Prompt", content= f"```\n{formatted_prompt}\n```" if formatted_prompt else "Empty Prompt"), 
-                    Text(name=f"LLM Output", content=f"```\n{completion.text}\n```" if completion.text else "No Content")
+                    self._text(name=f"Input Prompt", content= f"```\n{formatted_prompt}\n```" if formatted_prompt else "Empty Prompt"), 
+                    self._text(name=f"LLM Output", content=f"```\n{completion.text}\n```" if completion.text else "No Content")
                     ]
                         
         elif event_type == CBEventType.RERANKING:
@@ -208,7 +262,7 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
             if sources:
                 source_refs = "\, ".join([f"Fonte {idx}" for idx, source in enumerate(sources)])
 
-                step.elements = [Text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node", display="side") for idx, source in enumerate(sources)]
+                step.elements = [self._text(name=f"Fonte {idx}", content=self.format_source(source.node) or "Empty node", display="side") for idx, source in enumerate(sources)]
                 step.input = "**Input query**: " + (step.input or "Empty Input")
                 step.output = f"**Recuperate le seguenti fonti**: {source_refs}"
                 step.name = "Relevant Source Reranking"
@@ -216,12 +270,13 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
         else:
             step.output = payload
 
-        print(f"END STEP --> {step.to_dict()}")
+        # These steps were removed right after their end, so they are not sent at all
         if (step.name == "LLM Intermediate Answer") or (step.name == "LLM Generation"):
-            self.context.loop.create_task(step.remove())
-        else:
-            self.context.loop.create_task(step.update())
-        self.steps.pop(event_id, None)
+            return
+
+        step.input, step.output = self._truncate(step.input), self._truncate(step.output)
+        self._sent_step_ids.add(step.id)
+        self._enqueue(step)
 
     def _noop(self, *args, **kwargs):
         pass
@@ -235,4 +290,58 @@ class CustomLlamaIndexCallbackHandler(TokenCountingHandler):
 
 
     start_trace = _noop
-    end_trace = _noop
\ No newline at end of file
+    end_trace = _noop
+
+
+# Callback handler of the Chainlit session currently being served.
+# It is set by the message handler and propagated to worker threads together with the context.
+session_callback_handler: ContextVar[Optional[BaseCallbackHandler]] = ContextVar("session_callback_handler", default=None)
+
+
+class SessionCallbackDispatcher(BaseCallbackHandler):
+    """
+    Process-wide callback handler, registered once in the global callback manager.
+    The chat engine components are shared by all the sessions, so every event is forwarded
+    to the handler bound to the current session (if any).
+    """
+
+    def __init__(self) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        handler = session_callback_handler.get()
+        if handler is not None and event_type not in handler.event_starts_to_ignore:
+            handler.on_event_start(event_type, payload, event_id=event_id, parent_id=parent_id, **kwargs)
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        handler = session_callback_handler.get()
+        if handler is not None and event_type not in handler.event_ends_to_ignore:
+            handler.on_event_end(event_type, payload, event_id=event_id, **kwargs)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        handler = session_callback_handler.get()
+        if handler is not None:
+            handler.start_trace(trace_id)
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        handler = session_callback_handler.get()
+        if handler is not None:
+            handler.end_trace(trace_id, trace_map)
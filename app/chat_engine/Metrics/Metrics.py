@@ -0,0 +1,243 @@
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.callbacks.token_counting import TokenCounter, get_llm_token_counts
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+import bisect
+import json
+import time
+import os
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds of the retrieval candidates buckets
+CANDIDATES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Stage of each LLM call, recognized by the beginning of its prompt
+LLM_STAGES = {
+    "Given a conversation (between Human and Assistant) and a follow up message from Human, do two things": "llm_route_condense",
+    "Given a conversation": "llm_condense",
+    "Some choices are given below": "llm_select",
+    "A list of documents is shown below": "llm_rerank",
+    "Context information is below": "llm_synthesize",
+}
+EVENT_STAGES = {
+    CBEventType.RETRIEVE: "retrieve",
+    CBEventType.RERANKING: "rerank",
+    CBEventType.SYNTHESIZE: "synthesize",
+    CBEventType.QUERY: "query",
+    CBEventType.EMBEDDING: "embedding",
+}
+
+# Tool selected by the router for the current turn, set by the selector and used to label the LLM tokens
+current_tool: ContextVar[Optional[str]] = ContextVar("current_tool", default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, as exported by Prometheus.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        total, result = 0, []
+        for bound, count in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics of the chat engine:
+        - the latency of each stage (retrieval, reranking, synthesis, each kind of LLM call...);
+        - the prompt and completion tokens of the LLM calls, per tool and stage;
+        - the number of candidates returned by the retrieval and reranking stages.
+    Each observation can also be appended to a JSONL trace file.
+    """
+
+    def __init__(self, trace_path: Optional[str] = None) -> None:
+        """
+        Args:
+            trace_path: the JSONL file the observations are appended to (None disables the trace).
+        """
+        self.latencies = {}
+        self.candidates = {}
+        self.tokens = {}
+        self._lock = Lock()
+        self._trace_file = open(trace_path, "a", buffering=1) if trace_path else None
+
+    def observe(self, stage: str, latency: float, tool: Optional[str] = None, prompt_tokens: int = 0, completion_tokens: int = 0, candidates: Optional[int] = None) -> None:
+        """
+        Record a finished event.
+
+        Args:
+            stage: the stage of the event.
+            latency: the duration of the event, in seconds.
+            tool: the tool of the current turn, if already selected.
+            prompt_tokens: the prompt tokens of an LLM call.
+            completion_tokens: the completion tokens of an LLM call.
+            candidates: the number of nodes returned by a retrieval or reranking stage.
+        """
+        tool = tool or "none"
+        with self._lock:
+            self.latencies.setdefault(stage, Histogram(LATENCY_BUCKETS)).observe(latency)
+            if prompt_tokens or completion_tokens:
+                counts = self.tokens.setdefault((tool, stage), [0, 0])
+                counts[0] += prompt_tokens
+                counts[1] += completion_tokens
+            if candidates is not None:
+                self.candidates.setdefault(stage, Histogram(CANDIDATES_BUCKETS)).observe(candidates)
+
+            if self._trace_file is not None:
+                record = {"time": time.time(), "stage": stage, "tool": tool, "latency": round(latency, 6)}
+                if prompt_tokens or completion_tokens:
+                    record.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                if candidates is not None:
+                    record["candidates"] = candidates
+                self._trace_file.write(json.dumps(record) + "\n")
+
+    def render_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP chatbot_stage_latency_seconds Latency of each stage of the chat engine.",
+                "# TYPE chatbot_stage_latency_seconds histogram",
+            ]
+            for stage, histogram in sorted(self.latencies.items()):
+                lines += self._render_histogram("chatbot_stage_latency_seconds", f'stage="{stage}"', histogram)
+
+            lines += [
+                "# HELP chatbot_llm_tokens_total Tokens of the LLM calls, per tool and stage.",
+                "# TYPE chatbot_llm_tokens_total counter",
+            ]
+            for (tool, stage), (prompt_tokens, completion_tokens) in sorted(self.tokens.items()):
+                lines.append(f'chatbot_llm_tokens_total{{tool="{tool}",stage="{stage}",kind="prompt"}} {prompt_tokens}')
+                lines.append(f'chatbot_llm_tokens_total{{tool="{tool}",stage="{stage}",kind="completion"}} {completion_tokens}')
+
+            lines += [
+                "# HELP chatbot_retrieval_candidates Nodes returned by the retrieval and reranking stages.",
+                "# TYPE chatbot_retrieval_candidates histogram",
+            ]
+            for stage, histogram in sorted(self.candidates.items()):
+                lines += self._render_histogram("chatbot_retrieval_candidates", f'stage="{stage}"', histogram)
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histogram(name: str, labels: str, histogram: Histogram) -> List[str]:
+        lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}' for bound, count in histogram.cumulative_counts()]
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return lines
+
+
+_metrics_registry = None
+_metrics_registry_lock = Lock()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """
+    The metrics registry of the process, tracing to METRICS_TRACE_PATH if set.
+    """
+    global _metrics_registry
+    with _metrics_registry_lock:
+        if _metrics_registry is None:
+            _metrics_registry = MetricsRegistry(trace_path=os.getenv("METRICS_TRACE_PATH") or None)
+        return _metrics_registry
+
+
+def llm_stage(payload: Dict[str, Any]) -> str:
+    """
+    Stage of an LLM call, from the prompt or the last chat message.
+    """
+    if EventPayload.PROMPT in payload:
+        prompt = str(payload.get(EventPayload.PROMPT))
+    else:
+        messages = payload.get(EventPayload.MESSAGES) or []
+        prompt = (messages[-1].content or "") if messages else ""
+    prompt = prompt.strip()
+    return next((stage for start, stage in LLM_STAGES.items() if prompt.startswith(start)), "llm")
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Process-wide callback handler feeding the metrics registry from the LlamaIndex events.
+    """
+
+    def __init__(self, registry: MetricsRegistry, token_counter: Optional[TokenCounter] = None) -> None:
+        """
+        Args:
+            registry: the metrics registry.
+            token_counter: the counter of the tokens not reported by the LLM (defaults to the LlamaIndex tokenizer).
+        """
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.registry = registry
+        self._token_counter = token_counter
+        self._starts = {}
+        self._lock = Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type == CBEventType.LLM or event_type in EVENT_STAGES:
+            with self._lock:
+                self._starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            start_time = self._starts.pop(event_id, None)
+        if start_time is None:
+            return
+
+        latency = time.perf_counter() - start_time
+        payload = payload or {}
+
+        if event_type == CBEventType.LLM:
+            if self._token_counter is None:
+                self._token_counter = TokenCounter()
+            counts = get_llm_token_counts(self._token_counter, payload)
+            self.registry.observe(llm_stage(payload), latency, tool=current_tool.get(), prompt_tokens=counts.prompt_token_count, completion_tokens=counts.completion_token_count)
+
+        elif event_type in (CBEventType.RETRIEVE, CBEventType.RERANKING):
+            nodes = payload.get(EventPayload.NODES)
+            self.registry.observe(EVENT_STAGES[event_type], latency, tool=current_tool.get(), candidates=len(nodes) if nodes is not None else None)
+
+        else:
+            self.registry.observe(EVENT_STAGES[event_type], latency, tool=current_tool.get())
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
@@ -0,0 +1,256 @@
+from llama_index.core import Settings
+from llama_index.core.query_engine import CustomQueryEngine
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import Response, StreamingResponse, AsyncStreamingResponse
+from llama_index.core.schema import NodeWithScore
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional
+import numpy as np
+import asyncio
+import time
+import re
+import os
+from chat_engine.LogHandler.shell import shell_colors
+from chat_engine.LoadIndex.chroma_utils import get_catalog_version_path, read_catalog_version
+from chat_engine.Metrics.Metrics import current_tool
+from chat_engine.Router.TieredSelector import tool_kind
+
+
+class ResponseCache:
+    """
+    In-process cache of the answers, shared by all the chat sessions and keyed by the standalone question.
+    A question matches an entry either exactly (after normalizing case and spaces) or, if a similarity
+    threshold is set, when the cosine similarity of their embeddings is at least the threshold and
+    they share enough of their words, so that questions about different assets are not confused.
+    Entries expire after `ttl` seconds, the least recently used ones are evicted beyond `max_entries`,
+    and the whole cache is cleared when an ingestion changes the Chroma store.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: Optional[float] = None, similarity_threshold: Optional[float] = None, min_token_overlap: float = 0.8) -> None:
+        """
+        Args:
+            max_entries: the maximum number of cached answers.
+            ttl: the lifetime of an answer, in seconds (None keeps it until evicted).
+            similarity_threshold: the minimum cosine similarity of a near-duplicate question (None matches exact questions only).
+            min_token_overlap: the minimum Jaccard overlap of the words of a near-duplicate question.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.min_token_overlap = min_token_overlap
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._catalog_mtime = self._catalog_version_mtime()
+        self._catalog_version = read_catalog_version()
+        self._lock = Lock()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return re.sub(r"\s+", " ", question).strip().lower()
+
+    @staticmethod
+    def tokens(question: str) -> frozenset:
+        return frozenset(re.findall(r"\w+", question.lower()))
+
+    @staticmethod
+    def _catalog_version_mtime() -> Optional[int]:
+        try:
+            return os.stat(get_catalog_version_path()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _check_catalog_version(self) -> None:
+        # Called with the lock held; the version file is read again only when its modification time changes
+        catalog_mtime = self._catalog_version_mtime()
+        if catalog_mtime == self._catalog_mtime:
+            return
+        self._catalog_mtime = catalog_mtime
+        catalog_version = read_catalog_version()
+        if catalog_version != self._catalog_version:
+            print(f"{shell_colors['OKCYAN']}==> The catalog changed, clearing {len(self._entries)} cached answers{shell_colors['ENDC']}")
+            self._entries.clear()
+            self._catalog_version = catalog_version
+
+    def _evict_expired(self) -> None:
+        # Called with the lock held
+        if self.ttl is None:
+            return
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if now - entry["created"] > self.ttl]:
+            del self._entries[key]
+
+    def lookup(self, question: str, embedding: Optional[List[float]] = None) -> Optional[Dict]:
+        """
+        Find the cached answer of a question, exact or near-duplicate.
+
+        Args:
+            question: the standalone question.
+            embedding: the embedding of the question, required for the near-duplicate matches.
+
+        Returns:
+            - the cached entry, with the answer and the source nodes ids, or None.
+        """
+        key = self.normalize(question)
+
+        with self._lock:
+            self._check_catalog_version()
+            self._evict_expired()
+
+            entry = self._entries.get(key)
+            if entry is None and embedding is not None and self.similarity_threshold is not None:
+                keys = [k for k, e in self._entries.items() if e["embedding"] is not None]
+                if keys:
+                    similarities = np.stack([self._entries[k]["embedding"] for k in keys]) @ self._unit(embedding)
+                    tokens = self.tokens(question)
+                    # The most similar questions above the threshold, until one shares enough words
+                    for best in np.argsort(-similarities):
+                        if similarities[best] < self.similarity_threshold:
+                            break
+                        candidate_tokens = self._entries[keys[best]]["tokens"]
+                        if len(tokens & candidate_tokens) >= self.min_token_overlap * len(tokens | candidate_tokens):
+                            key, entry = keys[best], self._entries[keys[best]]
+                            break
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, question: str, answer: str, sources: List[NodeWithScore], embedding: Optional[List[float]] = None) -> None:
+        """
+        Store the answer of a question, with the ids and scores of its source nodes.
+        """
+        key = self.normalize(question)
+
+        with self._lock:
+            self._check_catalog_version()
+            self._entries[key] = {
+                "question": question,
+                "tokens": self.tokens(question),
+                "answer": answer,
+                "sources": [(n.node.node_id, n.score) for n in sources],
+                "embedding": self._unit(embedding) if embedding is not None else None,
+                "created": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit and miss counters since the cache was created.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self._entries)}
+
+
+class CachedQueryEngine(CustomQueryEngine):
+    """
+    Query engine answering from the response cache when possible, and from the wrapped engine otherwise.
+    Cached answers are streamed word by word, like the ones generated by the LLM, and their source nodes
+    are hydrated again from the node stores.
+    Only the answers of the semantic search tools are cached: the chatbot info answers rotate over several variants,
+    the other tools answer with canned replies, and a misrouted question must not keep its answer.
+    """
+    query_engine: BaseQueryEngine
+    response_cache: ResponseCache
+    node_stores: Dict
+
+    def _embed(self, query_str: str) -> Optional[List[float]]:
+        # The query embedding is cached, so the semantic search reuses it on a miss
+        if self.response_cache.similarity_threshold is None:
+            return None
+        return Settings.embed_model.get_query_embedding(query_str)
+
+    async def _aembed(self, query_str: str) -> Optional[List[float]]:
+        if self.response_cache.similarity_threshold is None:
+            return None
+        return await Settings.embed_model.aget_query_embedding(query_str)
+
+    def _cached_sources(self, entry: Dict) -> List[NodeWithScore]:
+        scores = dict(entry["sources"])
+        nodes = {}
+        for node_store in self.node_stores.values():
+            nodes.update({node.node_id: node for node in node_store.get_nodes(list(scores)) if node is not None})
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in entry["sources"] if node_id in nodes]
+
+    @staticmethod
+    def _cached_tokens(entry: Dict) -> List[str]:
+        return re.findall(r"\S+\s*|\s+", entry["answer"])
+
+    def _lookup(self, query_str: str, embedding) -> Optional[Dict]:
+        entry = self.response_cache.lookup(query_str, embedding)
+        if entry is not None:
+            print(f"{shell_colors['OKCYAN']}==> Cached answer for \"{entry['question']}\" ({self.response_cache.stats()}){shell_colors['ENDC']}")
+        return entry
+
+    def _store(self, query_str: str, embedding, answer: str, source_nodes: List[NodeWithScore]) -> None:
+        if answer.strip() and answer != "Empty Response":
+            self.response_cache.put(query_str, answer, source_nodes, embedding)
+
+    def _store_stream(self, query_str: str, embedding, response: StreamingResponse, response_gen):
+        # The answer is cached only once it has been streamed completely
+        tokens = []
+        for token in response_gen:
+            tokens.append(token)
+            yield token
+        self._store(query_str, embedding, "".join(tokens), response.source_nodes)
+
+    async def _astore_stream(self, query_str: str, embedding, response: AsyncStreamingResponse, response_gen):
+        tokens = []
+        async for token in response_gen:
+            tokens.append(token)
+            yield token
+        self._store(query_str, embedding, "".join(tokens), response.source_nodes)
+
+    @staticmethod
+    def _cacheable() -> bool:
+        # The router records the tool it selected for the question
+        tool = current_tool.get()
+        return tool is not None and tool_kind(tool) == "semantic_search"
+
+    def _wrap_response(self, query_str: str, embedding, response):
+        if not self._cacheable():
+            return response
+        if isinstance(response, StreamingResponse):
+            response.response_gen = self._store_stream(query_str, embedding, response, response.response_gen)
+        elif isinstance(response, AsyncStreamingResponse):
+            response.response_gen = self._astore_stream(query_str, embedding, response, response.response_gen)
+        elif isinstance(response, Response) and response.response:
+            self._store(query_str, embedding, response.response, response.source_nodes)
+        return response
+
+    def custom_query(self, query_str: str):
+        embedding = self._embed(query_str)
+        entry = self._lookup(query_str, embedding)
+        if entry is not None:
+            return StreamingResponse(response_gen=iter(self._cached_tokens(entry)), source_nodes=self._cached_sources(entry))
+
+        current_tool.set(None)
+        return self._wrap_response(query_str, embedding, self.query_engine.query(query_str))
+
+    async def acustom_query(self, query_str: str):
+        embedding = await self._aembed(query_str)
+        entry = self._lookup(query_str, embedding)
+        if entry is not None:
+            async def response_gen():
+                for token in self._cached_tokens(entry):
+                    yield token
+
+            # Hydrating the sources reads Chroma, which has no async client
+            source_nodes = await asyncio.to_thread(self._cached_sources, entry)
+            return AsyncStreamingResponse(response_gen=response_gen(), source_nodes=source_nodes)
+
+        current_tool.set(None)
+        return self._wrap_response(query_str, embedding, await self.query_engine.aquery(query_str))
@@ -0,0 +1,53 @@
+from llama_index.core.base.base_selector import BaseSelector, SelectorResult, SingleSelection
+from llama_index.core.schema import QueryBundle
+from llama_index.core.tools.types import ToolMetadata
+from llama_index.core.prompts.mixin import PromptDictType, PromptMixinType
+from contextvars import ContextVar
+from typing import Optional, Sequence
+from chat_engine.Metrics.Metrics import current_tool
+
+# Tool already selected for the current turn (0-based index), e.g., by the combined route-and-condense call
+preselected_tool: ContextVar[Optional[int]] = ContextVar("preselected_tool", default=None)
+
+
+class PreselectedSelector(BaseSelector):
+    """
+    Returns the tool preselected for the current turn, if any, and defers to the wrapped selector otherwise.
+    The router is shared by all the sessions, so the preselection lives in a context variable.
+    """
+
+    def __init__(self, selector: BaseSelector) -> None:
+        """
+        Args:
+            selector: the selector used when no tool was preselected.
+        """
+        self._selector = selector
+
+    def _get_prompts(self) -> PromptDictType:
+        return {}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        pass
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"selector": self._selector}
+
+    @staticmethod
+    def _preselection(choices: Sequence[ToolMetadata]) -> Optional[SelectorResult]:
+        index = preselected_tool.get()
+        if index is None or not 0 <= index < len(choices):
+            return None
+        return SelectorResult(selections=[SingleSelection(index=index, reason="Selected together with the standalone question")])
+
+    @staticmethod
+    def _record(choices: Sequence[ToolMetadata], result: SelectorResult) -> SelectorResult:
+        # The tool of the current turn labels the metrics of the following events
+        if result.selections and 0 <= result.ind < len(choices):
+            current_tool.set(choices[result.ind].name)
+        return result
+
+    def _select(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        return self._record(choices, self._preselection(choices) or self._selector.select(choices, query))
+
+    async def _aselect(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        return self._record(choices, self._preselection(choices) or await self._selector.aselect(choices, query))
@@ -0,0 +1,205 @@
+from llama_index.core import Settings
+from llama_index.core.base.base_selector import BaseSelector, SelectorResult, SingleSelection
+from llama_index.core.schema import QueryBundle
+from llama_index.core.tools.types import ToolMetadata
+from llama_index.core.prompts.mixin import PromptDictType, PromptMixinType
+from threading import Lock
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+import re
+from chat_engine.LogHandler.shell import shell_colors
+
+# Minimum similarity gap between the two nearest centroids for a local selection: the centroids of the
+# tools share the domain vocabulary, so a smaller gap routes too many ambiguous queries without the LLM
+LOCAL_MARGIN = 0.1
+
+# Keyword rules of each kind of tool, matched on the lowercase query
+TOOL_KEYWORDS = {
+    "semantic_search": r"\b(tabell|colonn|schem|camp[oi]\b|asset|dwh|data ?warehouse|ods\b|ocs\b|codic|attribut|metadat|dove trovo|dove si trova)",
+    "problems_reporting": r"\b(segnal|problem|error|bug\b|anomali|non funzion|sbagliat|incongruen|mancant)",
+    "chatbot_info": r"(cosa puoi fare|cosa sai fare|chi sei|come funzioni|cosa posso chiederti|come puoi aiutarmi|^\W*(ciao|salve|buongiorno|buonasera)\W*$)",
+}
+
+# Example queries of each kind of tool, embedded together with the tool description
+TOOL_EXAMPLES = {
+    "semantic_search": [
+        "Dove trovo il codice fiscale del cliente?",
+        "Quali colonne contiene la tabella dei prodotti?",
+        "In quale tabella è salvata la data di nascita?",
+        "Qual è il significato del campo tasso di interesse?",
+    ],
+    "problems_reporting": [
+        "Ho trovato un errore nella descrizione di una colonna.",
+        "Voglio segnalare un problema con i dati delle filiali.",
+        "I dati della tabella clienti non sono aggiornati.",
+    ],
+    "general_interaction": [
+        "Che tempo fa oggi a Milano?",
+        "Scrivimi una poesia.",
+        "Chi ha vinto la partita ieri sera?",
+    ],
+    "chatbot_info": [
+        "Ciao, cosa puoi fare?",
+        "Cosa posso chiederti?",
+        "Come funzioni?",
+    ],
+}
+
+
+def tool_kind(tool_name: str) -> str:
+    """
+    Kind of a tool, e.g., all the "semantic_search_<collection>" tools are of the "semantic_search" kind.
+    """
+    return next((kind for kind in TOOL_EXAMPLES if tool_name.startswith(kind)), tool_name)
+
+
+class TieredSelector(BaseSelector):
+    """
+    Selects the tool locally when the query is unambiguous, and with the LLM selector otherwise.
+        1. Keyword rules: the query matches the rules of a single kind of tool.
+        2. Nearest centroid: the query embedding is closest to the centroid of a kind of tool, built from
+           the sentences of its description and from a few example queries, by at least `margin`.
+    The local tiers only pick a kind of tool with a single tool among the choices; for instance, with
+    several semantic search collections, the choice among them is left to the LLM.
+    """
+
+    def __init__(self, llm_selector: BaseSelector, margin: float = LOCAL_MARGIN) -> None:
+        """
+        Args:
+            llm_selector: the selector of the ambiguous queries.
+            margin: the minimum similarity gap between the nearest and the second nearest centroid.
+        """
+        self._llm_selector = llm_selector
+        self.margin = margin
+        self.local_selections = 0
+        self.llm_selections = 0
+        self._centroids = {}
+        self._lock = Lock()
+        # Separate from the lock of the centroids, so that counting a selection never waits for them to be embedded
+        self._counters_lock = Lock()
+
+    def _get_prompts(self) -> PromptDictType:
+        return {}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        pass
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"llm_selector": self._llm_selector}
+
+    @staticmethod
+    def _centroid_texts(choices: Sequence[ToolMetadata]) -> Dict[str, List[str]]:
+        texts = {}
+        for choice in choices:
+            sentences = [s for s in re.split(r"(?<=[.;?!])\s+", choice.description) if s.strip()]
+            texts.setdefault(tool_kind(choice.name), []).extend(sentences)
+        for kind in texts:
+            texts[kind].extend(TOOL_EXAMPLES.get(kind, []))
+        return texts
+
+    @staticmethod
+    def _build_centroids(texts: Dict[str, List[str]], embeddings: List[List[float]]) -> Dict[str, np.ndarray]:
+        embeddings = iter(embeddings)
+        centroids = {}
+        for kind, kind_texts in texts.items():
+            centroid = np.mean([next(embeddings) for _ in kind_texts], axis=0)
+            centroids[kind] = centroid / np.linalg.norm(centroid)
+        return centroids
+
+    def _get_centroids(self, choices: Sequence[ToolMetadata]) -> Dict[str, np.ndarray]:
+        # Built at the first query, then reused as long as the tools do not change
+        key = tuple(choice.name for choice in choices)
+        with self._lock:
+            if key not in self._centroids:
+                texts = self._centroid_texts(choices)
+                all_texts = [text for kind_texts in texts.values() for text in kind_texts]
+                self._centroids[key] = self._build_centroids(texts, Settings.embed_model.get_text_embedding_batch(all_texts))
+            return self._centroids[key]
+
+    async def _aget_centroids(self, choices: Sequence[ToolMetadata]) -> Dict[str, np.ndarray]:
+        # Concurrent first queries may both build the centroids, the last one wins
+        key = tuple(choice.name for choice in choices)
+        if key not in self._centroids:
+            texts = self._centroid_texts(choices)
+            all_texts = [text for kind_texts in texts.values() for text in kind_texts]
+            centroids = self._build_centroids(texts, await Settings.embed_model.aget_text_embedding_batch(all_texts))
+            with self._lock:
+                self._centroids[key] = centroids
+        return self._centroids[key]
+
+    def _select_by_keywords(self, kinds: List[str], query: QueryBundle) -> Optional[SingleSelection]:
+        # Tier 1: keyword rules
+        query_str = query.query_str.lower()
+        matched = [kind for kind, pattern in TOOL_KEYWORDS.items() if kind in kinds and re.search(pattern, query_str)]
+        if len(matched) == 1:
+            return self._single_choice(kinds, matched[0], f"Keyword rules matched {matched[0]}")
+        return None
+
+    def _select_by_centroid(self, kinds: List[str], centroids: Dict[str, np.ndarray], query_embedding: List[float]) -> Optional[SingleSelection]:
+        # Tier 2: nearest centroid
+        query_embedding = np.asarray(query_embedding)
+        query_embedding = query_embedding / np.linalg.norm(query_embedding)
+        similarities = sorted([(float(centroid @ query_embedding), kind) for kind, centroid in centroids.items()], reverse=True)
+        (best_similarity, best_kind), (second_similarity, _) = similarities[:2]
+        if best_similarity - second_similarity >= self.margin:
+            return self._single_choice(kinds, best_kind, f"Nearest centroid {best_kind} (similarity {best_similarity:.2f}, margin {best_similarity - second_similarity:.2f})")
+        return None
+
+    @staticmethod
+    def _single_choice(kinds: List[str], kind: str, reason: str) -> Optional[SingleSelection]:
+        if kinds.count(kind) != 1:
+            return None
+        return SingleSelection(index=kinds.index(kind), reason=reason)
+
+    def _select_locally(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> Optional[SingleSelection]:
+        kinds = [tool_kind(choice.name) for choice in choices]
+        selection = self._select_by_keywords(kinds, query)
+        if selection is not None:
+            return selection
+
+        centroids = self._get_centroids(choices)
+        if len(centroids) < 2:
+            return None
+        return self._select_by_centroid(kinds, centroids, Settings.embed_model.get_query_embedding(query.query_str))
+
+    async def _aselect_locally(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> Optional[SingleSelection]:
+        kinds = [tool_kind(choice.name) for choice in choices]
+        selection = self._select_by_keywords(kinds, query)
+        if selection is not None:
+            return selection
+
+        centroids = await self._aget_centroids(choices)
+        if len(centroids) < 2:
+            return None
+        return self._select_by_centroid(kinds, centroids, await Settings.embed_model.aget_query_embedding(query.query_str))
+
+    def _count(self, selection: Optional[SingleSelection]) -> None:
+        # The selector is shared by all the sessions, so the counters are updated and read under a lock
+        with self._counters_lock:
+            if selection is not None:
+                self.local_selections += 1
+            else:
+                self.llm_selections += 1
+            local_selections = self.local_selections
+            total = self.local_selections + self.llm_selections
+
+        if selection is not None:
+            print(f"{shell_colors['OKCYAN']}==> Local routing: {selection.reason} ({local_selections} of {total} queries routed locally){shell_colors['ENDC']}")
+        else:
+            print(f"{shell_colors['OKCYAN']}==> Ambiguous query, routing with the LLM ({local_selections} of {total} queries routed locally){shell_colors['ENDC']}")
+
+    def _select(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        selection = self._select_locally(choices, query)
+        self._count(selection)
+        if selection is not None:
+            return SelectorResult(selections=[selection])
+
+        return self._llm_selector.select(choices, query)
+
+    async def _aselect(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        selection = await self._aselect_locally(choices, query)
+        self._count(selection)
+        if selection is not None:
+            return SelectorResult(selections=[selection])
+
+        return await self._llm_selector.aselect(choices, query)
@@ -1,25 +1,218 @@
 from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+import asyncio
+import contextvars
+import time
+import os
+from chat_engine.LogHandler.shell import shell_colors
+
+FUSION_MODES = ("none", "rrf", "weighted")
+# Worker threads of each retriever kind
+RETRIEVER_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+class HybridNodeWithScore(NodeWithScore):
+    """
+    Node with its fused score, keeping the raw scores returned by the two retrievers (None if not retrieved).
+    """
+    bm25_score: Optional[float] = None
+    vector_score: Optional[float] = None
+
 
 class HybridRetriever(BaseRetriever):
     """
     Builds an hybrid retriever, which uses both a vector similarity metric (e.g., cosine) and the BM25 algorithm to retrieve docs.
+    The two retrievers run concurrently; if one of them exceeds its timeout, its results are dropped
+    and the search degrades to the other one.
+
+    The two rankings are merged according to the fusion mode:
+        - "none": concatenate the BM25 and the vector nodes, keeping the first score of each node.
+        - "rrf": reciprocal rank fusion, sum over the rankings of weight / (rrf_k + rank).
+        - "weighted": weighted sum of the scores, min-max normalized within each ranking.
+    With "rrf" and "weighted", the score of each returned node is the fused score. In every mode, the raw
+    scores of the two retrievers are kept as well (see HybridNodeWithScore).
     """
-    def __init__(self, vector_retriever, bm25_retriever):
+    # Worker threads shared by all the hybrid retrievers of the process, one pool per retriever kind:
+    # a running call cannot be cancelled, so the vector searches that hang past their timeout keep their worker,
+    # and they must not hold the workers of the BM25 scoring, to which the search degrades
+    _bm25_executor = ThreadPoolExecutor(max_workers=RETRIEVER_WORKERS, thread_name_prefix="HybridRetriever-BM25")
+    _vector_executor = ThreadPoolExecutor(max_workers=RETRIEVER_WORKERS, thread_name_prefix="HybridRetriever-Vector")
+
+    def __init__(
+        self, 
+        vector_retriever, 
+        bm25_retriever, 
+        vector_timeout: Optional[float] = None, 
+        bm25_timeout: Optional[float] = None,
+        fusion_mode: str = "none",
+        fusion_top_k: Optional[int] = None,
+        vector_weight: float = 0.5,
+        rrf_k: int = 60,
+        vector_search=None,
+    ):
+        """
+        Args:
+            vector_retriever: the vector similarity retriever.
+            bm25_retriever: the BM25 retriever.
+            vector_timeout: seconds to wait for the vector retriever (None waits indefinitely).
+            bm25_timeout: seconds to wait for the BM25 retriever (None waits indefinitely).
+            fusion_mode: how to merge the two rankings, one of "none", "rrf" and "weighted".
+            fusion_top_k: number of fused nodes to return (None returns all of them).
+            vector_weight: weight of the vector ranking, the BM25 ranking gets 1 - vector_weight.
+            rrf_k: rank offset of the reciprocal rank fusion.
+            vector_search: the batched vector search of the collection (e.g., ChromaNodeStore.search), used by retrieve_batch.
+        """
+        if fusion_mode not in FUSION_MODES:
+            raise ValueError(f"Unknown fusion mode {fusion_mode}, expected one of {FUSION_MODES}.")
+
         self.vector_retriever = vector_retriever
         self.bm25_retriever = bm25_retriever
+        self.vector_timeout = vector_timeout
+        self.bm25_timeout = bm25_timeout
+        self.fusion_mode = fusion_mode
+        self.fusion_top_k = fusion_top_k
+        self.vector_weight = vector_weight
+        self.rrf_k = rrf_k
+        self.vector_search = vector_search
         super().__init__(None)
 
-    def _retrieve(self, query, **kwargs):
-        # Retrieve the top nodes for each algorithm
-        bm25_nodes = self.bm25_retriever.retrieve(query.query_str, **kwargs)
-        vector_nodes = self.vector_retriever.retrieve(query, **kwargs)
+    @staticmethod
+    def _submit(executor, fn, *args):
+        # Run in the caller context, so that the callbacks reach the handler of the current session
+        return executor.submit(contextvars.copy_context().run, fn, *args)
+
+    @staticmethod
+    def _timed_out(name, timeout):
+        print(f"{shell_colors['WARNING']}{name} retrieval exceeded the timeout of {timeout}s, its results are ignored{shell_colors['ENDC']}")
+        return []
+
+    def _result(self, future, name, timeout, start_time):
+        if timeout is None:
+            return future.result()
+        try:
+            return future.result(timeout=max(0, timeout - (time.perf_counter() - start_time)))
+        except FutureTimeoutError:
+            # Only a call still queued is cancelled, a running one is left to finish in its worker
+            future.cancel()
+            return self._timed_out(name, timeout)
+
+    async def _aresult(self, awaitable, name, timeout):
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out(name, timeout)
+
+    def _combine(self, bm25_nodes, vector_nodes):
+        if self.fusion_mode == "none":
+            # Combine the two lists of nodes excluding duplicates, keeping the raw scores of both retrievers
+            raw_scores = {"bm25": {n.node.node_id: n.score for n in bm25_nodes}, "vector": {n.node.node_id: n.score for n in vector_nodes}}
+            all_nodes = []
+            node_ids = set()
+            for n in bm25_nodes + vector_nodes:
+                if n.node.node_id not in node_ids:
+                    all_nodes.append(HybridNodeWithScore(
+                        node=n.node,
+                        score=n.score,
+                        bm25_score=raw_scores["bm25"].get(n.node.node_id),
+                        vector_score=raw_scores["vector"].get(n.node.node_id),
+                        ))
+                    node_ids.add(n.node.node_id)
+
+            return all_nodes[:self.fusion_top_k]
+
+        # BM25 returns the top k nodes even when no query term matches them
+        bm25_nodes = [n for n in bm25_nodes if n.score]
+
+        fused_scores = {}
+        raw_scores = {"bm25": {n.node.node_id: n.score for n in bm25_nodes}, "vector": {n.node.node_id: n.score for n in vector_nodes}}
+        nodes = {}
+        for weight, ranking in ((1 - self.vector_weight, bm25_nodes), (self.vector_weight, vector_nodes)):
+            if self.fusion_mode == "rrf":
+                scores = [1 / (self.rrf_k + rank) for rank in range(1, len(ranking) + 1)]
+            else:
+                scores = self._normalize([n.score or 0.0 for n in ranking])
+
+            for n, score in zip(ranking, scores):
+                nodes.setdefault(n.node.node_id, n.node)
+                fused_scores[n.node.node_id] = fused_scores.get(n.node.node_id, 0.0) + weight * score
+
+        ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:self.fusion_top_k]
+        return [
+            HybridNodeWithScore(
+                node=nodes[node_id], 
+                score=fused_scores[node_id], 
+                bm25_score=raw_scores["bm25"].get(node_id), 
+                vector_score=raw_scores["vector"].get(node_id),
+                ) 
+            for node_id in ranked_ids
+            ]
+
+    @staticmethod
+    def _normalize(scores):
+        # Min-max normalization, so that BM25 and cosine scores share the same [0, 1] range
+        if not scores:
+            return []
+        min_score, max_score = min(scores), max(scores)
+        if max_score == min_score:
+            return [1.0 for _ in scores]
+        return [(score - min_score) / (max_score - min_score) for score in scores]
+
+    def _retrieve(self, query_bundle):
+        # Retrieve the top nodes for each algorithm in parallel
+        start_time = time.perf_counter()
+        bm25_future = self._submit(self._bm25_executor, self.bm25_retriever.retrieve, query_bundle.query_str)
+        vector_future = self._submit(self._vector_executor, self.vector_retriever.retrieve, query_bundle)
+
+        bm25_nodes = self._result(bm25_future, "BM25", self.bm25_timeout, start_time)
+        vector_nodes = self._result(vector_future, "Vector", self.vector_timeout, start_time)
+
+        return self._combine(bm25_nodes, vector_nodes)
+
+    def retrieve_batch(self, query_strs, query_embeddings):
+        """
+        Retrieve the nodes of several queries at once, e.g., for the retrieval service.
+        The BM25 scoring of all the queries runs in a single bm25s call and their vector search in a single
+        Chroma query or matrix product, with the same timeouts and fusion as a single query.
+
+        Args:
+            query_strs: the queries.
+            query_embeddings: the embedding of each query, None for the queries only searched by BM25.
+
+        Returns:
+            - the nodes of each query.
+        """
+        start_time = time.perf_counter()
+        embedded = [i for i, embedding in enumerate(query_embeddings) if embedding is not None]
+        bm25_future = self._submit(self._bm25_executor, self.bm25_retriever.retrieve_batch, query_strs)
+        if embedded:
+            vector_future = self._submit(self._vector_executor, self.vector_search, [query_embeddings[i] for i in embedded], self.vector_retriever.similarity_top_k)
+
+        # A timed out retriever contributes no nodes to any of the queries
+        bm25_nodes = self._result(bm25_future, "BM25", self.bm25_timeout, start_time) or [[] for _ in query_strs]
+        vector_nodes = [[] for _ in query_strs]
+        if embedded:
+            for i, nodes in zip(embedded, self._result(vector_future, "Vector", self.vector_timeout, start_time) or [[] for _ in embedded]):
+                vector_nodes[i] = nodes
+
+        return [self._combine(bm25, vector) for bm25, vector in zip(bm25_nodes, vector_nodes)]
+
+    async def _avector_retrieve(self, query_bundle):
+        # Chroma and the NumPy vector store have no native async query, and LlamaIndex would run their blocking query
+        # on the event loop: only the query embedding is awaited, then the query runs in the vector worker threads
+        embedding = query_bundle.embedding
+        if embedding is None and query_bundle.embedding_strs:
+            embedding = await self.vector_retriever._embed_model.aget_agg_embedding_from_queries(query_bundle.embedding_strs)
+        embedded_query = QueryBundle(query_str=query_bundle.query_str, embedding=embedding)
+        return await asyncio.wrap_future(self._submit(self._vector_executor, self.vector_retriever.retrieve, embedded_query))
 
-        # Combine the two lists of nodes excluding duplicates
-        all_nodes = []
-        node_ids = set()
-        for n in bm25_nodes + vector_nodes:
-            if n.node.node_id not in node_ids:
-                all_nodes.append(n)
-                node_ids.add(n.node.node_id)
+    async def _aretrieve(self, query_bundle):
+        # BM25 scoring is CPU-bound, so it runs in a worker thread while the query embedding is awaited;
+        # the event loop is never blocked, so that the timeouts can fire
+        bm25_nodes, vector_nodes = await asyncio.gather(
+            self._aresult(asyncio.wrap_future(self._submit(self._bm25_executor, self.bm25_retriever.retrieve, query_bundle.query_str)), "BM25", self.bm25_timeout),
+            self._aresult(self._avector_retrieve(query_bundle), "Vector", self.vector_timeout),
+        )
 
-        return all_nodes
+        return self._combine(bm25_nodes, vector_nodes)
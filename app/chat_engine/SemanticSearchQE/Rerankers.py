@@ -0,0 +1,108 @@
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.bridge.pydantic import Field, SerializeAsAny
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from typing import List, Optional
+from bm25s.stopwords import STOPWORDS_ITALIAN
+import Stemmer
+import re
+from chat_engine.LogHandler.shell import shell_colors
+from chat_engine.LoadIndex.bm25_utils import BM25_LANGUAGE
+
+# Metadata holding the identity of an asset, matched against the query terms
+ASSET_METADATA_KEYS = ["nome asset", "tabella di appartenenza", "schema di appartenenza"]
+
+
+def ranking_margin(nodes: List[NodeWithScore]) -> float:
+    """
+    Relative gap between the first and the second score of a ranking, in [0, 1].
+    A single node is a fully confident ranking, while an empty or unscored one is not confident at all.
+    """
+    scores = sorted([n.score or 0.0 for n in nodes], reverse=True)
+    if not scores or scores[0] <= 0:
+        return 0.0
+    if len(scores) == 1:
+        return 1.0
+    return (scores[0] - scores[1]) / scores[0]
+
+
+class MarginGatedRerank(BaseNodePostprocessor):
+    """
+    Calls the wrapped reranker only when the incoming ranking is ambiguous.
+    If the relative margin between the first two nodes is at least `margin`, the ranking is
+    considered confident and its top n nodes are returned as they are.
+    """
+    reranker: SerializeAsAny[BaseNodePostprocessor] = Field(description="Reranker used for ambiguous rankings.")
+    margin: float = Field(description="Minimum relative margin of a confident ranking.")
+    top_n: int = Field(default=10, description="Top N nodes to return for confident rankings.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MarginGatedRerank"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        nodes = sorted(nodes, key=lambda n: n.score or 0.0, reverse=True)
+        margin = ranking_margin(nodes)
+
+        if margin >= self.margin:
+            print(f"{shell_colors['OKCYAN']}==> Confident ranking (margin {margin:.2f}), skipping {self.reranker.class_name()}{shell_colors['ENDC']}")
+            return nodes[:self.top_n]
+
+        return self.reranker.postprocess_nodes(nodes, query_bundle=query_bundle)
+
+
+class LocalRerank(BaseNodePostprocessor):
+    """
+    CPU-only reranker running offline. Each candidate is scored by a weighted sum of:
+        - vector: the cosine similarity returned by the vector retriever;
+        - bm25: the BM25 score, divided by the best BM25 score among the candidates;
+        - metadata: the share of query terms found in the asset, table and schema names.
+    The raw scores are the ones kept by HybridRetriever, whatever its fusion mode: a candidate not returned
+    by one of the retrievers, or not retrieved by HybridRetriever, scores 0 for it, so that a BM25 score is
+    never taken for a cosine similarity.
+    """
+    top_n: int = Field(default=10, description="Top N nodes to return.")
+    vector_weight: float = Field(default=0.4, description="Weight of the cosine similarity.")
+    bm25_weight: float = Field(default=0.3, description="Weight of the normalized BM25 score.")
+    metadata_weight: float = Field(default=0.3, description="Weight of the metadata matches.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalRerank"
+
+    @staticmethod
+    def _tokenize(text: str, stemmer: Stemmer.Stemmer) -> set:
+        words = [w for w in re.findall(r"[^\W_]+", text.lower()) if w not in STOPWORDS_ITALIAN]
+        return set(stemmer.stemWords(words))
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if not nodes:
+            return []
+
+        # Stemmers are not thread safe, so each call uses its own
+        stemmer = Stemmer.Stemmer(BM25_LANGUAGE)
+        query_terms = self._tokenize(query_bundle.query_str, stemmer) if query_bundle else set()
+
+        vector_scores = [getattr(n, "vector_score", None) or 0.0 for n in nodes]
+        bm25_scores = [getattr(n, "bm25_score", None) or 0.0 for n in nodes]
+        max_bm25_score = max(bm25_scores)
+
+        reranked_nodes = []
+        for n, vector_score, bm25_score in zip(nodes, vector_scores, bm25_scores):
+            asset_terms = self._tokenize(" ".join([str(n.node.metadata.get(k, "")) for k in ASSET_METADATA_KEYS]), stemmer)
+            metadata_score = len(query_terms & asset_terms) / len(query_terms) if query_terms else 0.0
+
+            score = self.vector_weight * vector_score + \
+                    self.bm25_weight * (bm25_score / max_bm25_score if max_bm25_score > 0 else 0.0) + \
+                    self.metadata_weight * metadata_score
+            reranked_nodes.append(NodeWithScore(node=n.node, score=score))
+
+        reranked_nodes.sort(key=lambda n: n.score, reverse=True)
+        return reranked_nodes[:self.top_n]
@@ -1,16 +1,33 @@
 from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.retrievers.bm25 import BM25Retriever
 from llama_index.core.vector_stores.types import VectorStoreQueryMode
 from llama_index.core import get_response_synthesizer
 from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.tools import QueryEngineTool
-from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.postprocessor import LLMRerank, SentenceTransformerRerank
 from llama_index.core.indices.utils import default_parse_choice_select_answer_fn
-import Stemmer
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from typing import List
 from chat_engine.LogHandler.shell import shell_colors
 from common.prompts_templates.PromptTemplates import TOOL_DESCRIPTIONS
 from chat_engine.SemanticSearchQE.HybridRetriever import HybridRetriever
+from chat_engine.SemanticSearchQE.Rerankers import MarginGatedRerank, LocalRerank
+from chat_engine.LoadIndex.bm25_utils import load_bm25_retriever
+from chat_engine.LoadIndex.numpy_vector_store import NumpyVectorStore
+import importlib.util
+import asyncio
+import os
+
+
+class AsyncRetrieverQueryEngine(RetrieverQueryEngine):
+    """
+    Retriever query engine whose async path never blocks the event loop.
+    The node postprocessors (e.g., the LLM reranker) only have a sync interface, so they run in a worker thread.
+    """
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self._retriever.aretrieve(query_bundle)
+        return await asyncio.to_thread(self._apply_node_postprocessors, nodes, query_bundle=query_bundle)
 
 
 def custom_print_choice_select_answer_fn(answer: str, num_choices: int):
@@ -26,56 +43,138 @@ def custom_print_choice_select_answer_fn(answer: str, num_choices: int):
     return default_parse_choice_select_answer_fn(answer, num_choices)
 
 
-def build_SemanticSearchQETool(nodes, vector_indices):
+def get_env_number(env_name, cast=float, default=None):
+    """
+    Read a numeric setting from the environment; an unset or empty variable returns the default.
+    """
+    value = os.getenv(env_name)
+    return cast(value) if value else default
+
+
+RERANK_MODES = ("llm", "local", "cross_encoder", "cascade", "none")
+
+
+def build_reranker(rerank_mode):
+    """
+    Builds the re-ranking stage of the semantic search.
+
+    Args:
+        rerank_mode: one of
+            - "llm": LLM reranker, skipped for confident rankings if RERANK_SKIP_MARGIN is set.
+            - "local": CPU-only reranker over retrieval scores and metadata matches.
+            - "cross_encoder": local cross-encoder model (CROSS_ENCODER_MODEL), requires the "cross-encoder" extra (sentence-transformers).
+            - "cascade": local reranker, followed by the LLM reranker only when its ranking is ambiguous.
+            - "none": no re-ranking.
+
+    Returns:
+        - the list of node postprocessors.
+    """
+    if rerank_mode not in RERANK_MODES:
+        raise ValueError(f"Unknown rerank mode {rerank_mode}, expected one of {RERANK_MODES}.")
+
+    def build_llm_reranker():
+        return LLMRerank(
+            choice_batch_size=20, 
+            top_n=10,
+            parse_choice_select_answer_fn=custom_print_choice_select_answer_fn,
+            )
+
+    rerank_skip_margin = get_env_number("RERANK_SKIP_MARGIN")
+
+    if rerank_mode == "llm":
+        # Skipped when the fused ranking is already confident
+        if rerank_skip_margin is None:
+            return [build_llm_reranker()]
+        return [MarginGatedRerank(reranker=build_llm_reranker(), margin=rerank_skip_margin, top_n=10)]
+    
+    elif rerank_mode == "local":
+        return [LocalRerank(top_n=10)]
+    
+    elif rerank_mode == "cross_encoder":
+        if importlib.util.find_spec("sentence_transformers") is None:
+            raise ImportError('RERANK_MODE "cross_encoder" requires sentence-transformers, install it with `poetry install --extras cross-encoder`.')
+        return [SentenceTransformerRerank(model=os.getenv("CROSS_ENCODER_MODEL") or "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1", top_n=10, device="cpu")]
+    
+    elif rerank_mode == "cascade":
+        return [
+            LocalRerank(top_n=10), 
+            MarginGatedRerank(reranker=build_llm_reranker(), margin=rerank_skip_margin if rerank_skip_margin is not None else 0.2, top_n=10)
+            ]
+    
+    return []
+
+
+def build_hybrid_retriever(collection_name, node_store, vector_index):
+    """
+    Builds the hybrid retriever of a collection, from the settings in the environment.
+
+    Args:
+        collection_name: the name of the collection.
+        node_store: the node store of the collection.
+        vector_index: the vector index of the collection.
+
+    Returns:
+        - the hybrid retriever.
+    """
+    # Initialize a vector similarity retriever
+    vector_retriever = VectorIndexRetriever(
+        index=vector_index,
+        similarity_top_k=10,
+        vector_store_query_mode=VectorStoreQueryMode.DEFAULT,
+        )
+    
+    # Initialize a BM25 retriever, memory-mapping the index persisted by the ingestion
+    # The nodes are read from Chroma only for the top results of each query
+    bm25_retriever = load_bm25_retriever(collection_name, node_store)
+    
+    # Combine two retrieval methods into an hybrid retriever
+    # A slow embedding endpoint degrades the search to BM25 only
+    return HybridRetriever(
+        vector_retriever, 
+        bm25_retriever,
+        vector_timeout=get_env_number("VECTOR_RETRIEVER_TIMEOUT"),
+        bm25_timeout=get_env_number("BM25_RETRIEVER_TIMEOUT"),
+        fusion_mode=os.getenv("HYBRID_FUSION_MODE") or "none",
+        fusion_top_k=get_env_number("HYBRID_FUSION_TOP_K", int),
+        vector_weight=get_env_number("HYBRID_VECTOR_WEIGHT", default=0.5),
+        # The NumPy vector store searches a batch with a single matrix product, Chroma with a single query
+        vector_search=vector_index.vector_store.search if isinstance(vector_index.vector_store, NumpyVectorStore) else node_store.search,
+        )
+
+
+def build_SemanticSearchQETool(nodes, vector_indices, rerank_modes=None, retrievers=None):
     """
     Builds the tool to perform semantic search within the vector database.
 
     Args:
-        nodes: the list of nodes.
+        nodes: the node store of each collection.
         vector_indices: the vector database.
+        rerank_modes: the rerank mode of each collection (see build_reranker), defaults to RERANK_MODE or "llm".
+        retrievers: the retriever of each collection, e.g., the clients of the retrieval service;
+            defaults to the hybrid retrievers over the vector database.
 
     Returns:
         - LlamaIndex query engine function.
     """
+    if retrievers is None:
+        retrievers = {key_name: build_hybrid_retriever(key_name, nodes[key_name], vector_index) for key_name, vector_index in vector_indices.items()}
+
     semantic_search_query_engine = {}
 
-    for key_name in vector_indices.keys():
+    for key_name, retriever in retrievers.items():
 
-        # Initialize a vector similarity retriever
-        vector_retriever = VectorIndexRetriever(
-            index=vector_indices[key_name],
-            similarity_top_k=10,
-            vector_store_query_mode=VectorStoreQueryMode.DEFAULT,
-            )
-        
-        # Initialize a BM25 retriever
-        # Reference: https://docs.llamaindex.ai/en/stable/examples/retrievers/bm25_retriever/
-        bm25_retriever = BM25Retriever(
-            nodes=nodes[key_name], 
-            stemmer=Stemmer.Stemmer("italian"), # Removes stop words and stems each word
-            verbose=True,
-            similarity_top_k=10,
-            language="italian"
-            )    
-        
-        # Combine two retrieval methods into an hybrid retriever
-        hybrid_retriever = HybridRetriever(vector_retriever, bm25_retriever)
+        # Initialize the re-ranking stage selected for the collection
+        node_postprocessors = build_reranker((rerank_modes or {}).get(key_name) or os.getenv("RERANK_MODE") or "llm")
 
         # Initialize a query engine using the hybrid retriever and a re-ranker
-        query_engine = RetrieverQueryEngine(
-            retriever=hybrid_retriever,
-            node_postprocessors=[
-                LLMRerank(
-                   choice_batch_size=20, 
-                   top_n=10,
-                   parse_choice_select_answer_fn=custom_print_choice_select_answer_fn,
-                   )
-                ],
+        query_engine = AsyncRetrieverQueryEngine(
+            retriever=retriever,
+            node_postprocessors=node_postprocessors,
             response_synthesizer=get_response_synthesizer(
                 response_mode=ResponseMode.COMPACT, 
                 verbose=True, 
                 streaming=True, 
-                use_async=False),
+                use_async=True),
         )
 
         semantic_search_query_engine[key_name] = QueryEngineTool.from_defaults(
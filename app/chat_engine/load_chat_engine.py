@@ -11,6 +11,10 @@ from llama_index.core.callbacks import CallbackManager
 from llama_index.core.query_engine.router_query_engine import RouterQueryEngine
 from llama_index.core.response_synthesizers import ResponseMode
 from llama_index.core.selectors.llm_selectors import LLMSingleSelector
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from threading import Lock
+import time
+import os
 
 from common.prompts_templates.PromptTemplates import (
     SINGLE_SELECT_PROMPT, 
@@ -18,69 +22,153 @@ from common.prompts_templates.PromptTemplates import (
 )
 
 from chat_engine.LogHandler.shell import shell_colors
-from chat_engine.LogHandler.LogHandler import CustomLlamaIndexCallbackHandler
+from chat_engine.LogHandler.LogHandler import SessionCallbackDispatcher
 from chat_engine.SemanticSearchQE.SemanticSearchQETool import build_SemanticSearchQETool
 from chat_engine.GeneralInteractionQE.GeneralInteractionQETool import (
-    build_AssetMappingQueryEngine, 
     build_ProblemsReportingQueryEngine,
     build_GeneralInteractionQueryEngine,
     build_ChatbotInfoQueryEngine
 )
 from chat_engine.LoadIndex.load_vector_indices import load_vector_indices
+from chat_engine.ResponseCache.ResponseCache import ResponseCache, CachedQueryEngine
+from chat_engine.ChatEngines.FastCondenseChatEngine import FastCondenseChatEngine
+from chat_engine.ChatEngines.RouteCondenseChatEngine import RouteCondenseChatEngine
+from chat_engine.Router.TieredSelector import TieredSelector, LOCAL_MARGIN
+from chat_engine.Router.PreselectedSelector import PreselectedSelector
+from chat_engine.Metrics.Metrics import MetricsCallbackHandler, get_metrics_registry
+from models.models import load_index_models
+from serving.retrieval_client import load_remote_collections
 
 
-def load_chat_engine() -> CondenseQuestionChatEngine:
+CHAT_ENGINE_MODES = ("condense", "fast", "route_condense")
+
+# Read-only components shared by all the chat sessions of the process
+_shared_query_engine = None
+_shared_query_engine_lock = Lock()
+
+
+def load_shared_query_engine() -> BaseQueryEngine:
+    """
+    Build the heavy, read-only part of the chat engine: vector indices, node stores, BM25 indexes,
+    retrievers, tools, router and response cache. They are built once per process and shared by all the sessions.
+    The global LLM and embedding models are loaded first, unless already loaded (e.g., by the prewarm at startup).
+
+    Returns:
+        - the router query engine instance, behind the response cache if enabled.
+    """
+    global _shared_query_engine
+
+    if _shared_query_engine is not None:
+        return _shared_query_engine
+
+    with _shared_query_engine_lock:
+        if _shared_query_engine is not None:
+            return _shared_query_engine
+
+        start_time = time.perf_counter()
+
+        load_index_models()
+
+        # Set them as global tools
+        # Events are forwarded by the dispatcher to the callback handler of the current session
+        Settings.node_parser = SentenceSplitter(
+            separator=" ",
+            chunk_size=256,
+            chunk_overlap=0,
+            paragraph_separator="\n",
+            secondary_chunking_regex="[^.]+[.]?",
+            include_metadata=True, 
+            include_prev_next_rel=True,
+        )
+        # The metrics handler records the latency and tokens of every stage, for all the sessions
+        callback_handlers = [SessionCallbackDispatcher()]
+        if (os.getenv("METRICS_ENABLED") or "true").lower() == "true":
+            callback_handlers.append(MetricsCallbackHandler(get_metrics_registry()))
+        Settings.callback_manager = CallbackManager(callback_handlers)
+
+        # Build the tools
+        # With a retrieval service, the collections are searched by the service instead of being loaded here
+        retrieval_service_url = os.getenv("RETRIEVAL_SERVICE_URL")
+        if retrieval_service_url:
+            nodes, retrievers = load_remote_collections(retrieval_service_url, timeout=float(os.getenv("RETRIEVAL_SERVICE_TIMEOUT")) if os.getenv("RETRIEVAL_SERVICE_TIMEOUT") else None)
+            semantic_search_query_engine_tools = build_SemanticSearchQETool(nodes, None, retrievers=retrievers)
+        else:
+            nodes, vector_indices = load_vector_indices()        
+            semantic_search_query_engine_tools = build_SemanticSearchQETool(nodes, vector_indices)
+        problems_reporting_query_engine_tool = build_ProblemsReportingQueryEngine()
+        general_interaction_query_engine_tool = build_GeneralInteractionQueryEngine()
+        chatbot_info_query_engine_tool = build_ChatbotInfoQueryEngine()
+
+        # Define the router, using one route for each of the tools defined above
+        # In "tiered" mode, only the queries that the local rules and centroids cannot route reach the LLM selector
+        selector = LLMSingleSelector.from_defaults(prompt_template_str=SINGLE_SELECT_PROMPT)
+        if (os.getenv("ROUTER_MODE") or "llm") == "tiered":
+            selector = TieredSelector(selector, margin=float(os.getenv("ROUTER_LOCAL_MARGIN") or LOCAL_MARGIN))
+
+        # The route-and-condense chat engine selects the tool itself, and hands it to the router for the current turn
+        router_query_engine = RouterQueryEngine.from_defaults(
+            selector=PreselectedSelector(selector),
+            summarizer=get_response_synthesizer(response_mode=ResponseMode.COMPACT, verbose=True, streaming=True, use_async=True),
+            query_engine_tools=list(semantic_search_query_engine_tools.values()) + \
+                                [problems_reporting_query_engine_tool] + \
+                                [general_interaction_query_engine_tool] + \
+                                [chatbot_info_query_engine_tool],
+            )
+
+        print(f"\n{shell_colors['BOLD']}{shell_colors['HEADER']}QueryEngine Metadatas: {shell_colors['ENDC']}{shell_colors['ENDC']}", "\n".join([f"\t- {shell_colors['BOLD']}TOOL {idx}{shell_colors['ENDC']}: {shell_colors['OKBLUE']}\"{x.name}\"{shell_colors['ENDC']} - {x.description}" for idx,x in enumerate(router_query_engine._metadatas)]), sep="\n")
+        print(f"{shell_colors['OKGREEN']}Shared query engine built in {time.perf_counter() - start_time:.2f}s{shell_colors['ENDC']}")
+
+        # Answer the repeated questions from the cache, cleared when the ingestion changes the catalog
+        response_cache_max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES") or 0)
+        if response_cache_max_entries > 0:
+            response_cache = ResponseCache(
+                max_entries=response_cache_max_entries,
+                ttl=float(os.getenv("RESPONSE_CACHE_TTL")) if os.getenv("RESPONSE_CACHE_TTL") else None,
+                similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY")) if os.getenv("RESPONSE_CACHE_SIMILARITY") else None,
+                min_token_overlap=float(os.getenv("RESPONSE_CACHE_TOKEN_OVERLAP") or 0.8),
+            )
+            _shared_query_engine = CachedQueryEngine(query_engine=router_query_engine, response_cache=response_cache, node_stores=nodes)
+        else:
+            _shared_query_engine = router_query_engine
+
+    return _shared_query_engine
+
+
+def load_chat_engine(mode: str = None) -> CondenseQuestionChatEngine:
     """
     Initialize the core component of the whole RAG application.
-    The chat engine manages the router, the vector indices, and the tools.
-    This uses the global LLM and embedding models set previously.
+    The chat engine wraps the shared router with the per-session chat memory.
+
+    Args:
+        mode: one of
+            - "condense": every follow-up message is condensed with the chat history by the LLM.
+            - "fast": the LLM condenses only the follow-up messages that a local heuristic finds incomplete.
+            - "route_condense": a single LLM call condenses each follow-up message and selects its tool.
+        Defaults to CHAT_ENGINE_MODE or "condense".
 
     Returns:
         - the chat engine instance.
     """
-    callback_manager = CallbackManager([CustomLlamaIndexCallbackHandler()])
-    node_parser = SentenceSplitter(
-        separator=" ",
-        chunk_size=256,
-        chunk_overlap=0,
-        paragraph_separator="\n",
-        secondary_chunking_regex="[^.]+[.]?",
-        include_metadata=True, 
-        include_prev_next_rel=True,
-    )
-
-    # Set them as global tools
-    Settings.node_parser = node_parser
-    Settings.callback_manager = callback_manager
-
-    # Build the tools
-    nodes, vector_indices = load_vector_indices()        
-    semantic_search_query_engine_tools = build_SemanticSearchQETool(nodes, vector_indices)
-    asset_mapping_query_engine_tool = build_AssetMappingQueryEngine()
-    problems_reporting_query_engine_tool = build_ProblemsReportingQueryEngine()
-    general_interaction_query_engine_tool = build_GeneralInteractionQueryEngine()
-    chatbot_info_query_engine_tool = build_ChatbotInfoQueryEngine()
-
-    # Define the router, using one route for each of the tools defined above
-    router_query_engine = RouterQueryEngine.from_defaults(
-        selector=LLMSingleSelector.from_defaults(prompt_template_str=SINGLE_SELECT_PROMPT),
-        summarizer=get_response_synthesizer(response_mode=ResponseMode.COMPACT, verbose=True, streaming=True, use_async=False),
-        query_engine_tools=list(semantic_search_query_engine_tools.values()) + \
-                            [asset_mapping_query_engine_tool] + \
-                            [problems_reporting_query_engine_tool] + \
-                            [general_interaction_query_engine_tool] + \
-                            [chatbot_info_query_engine_tool],
-        )
+    mode = mode or os.getenv("CHAT_ENGINE_MODE") or "condense"
+    if mode not in CHAT_ENGINE_MODES:
+        raise ValueError(f"Unknown chat engine mode {mode}, expected one of {CHAT_ENGINE_MODES}.")
+
+    query_engine = load_shared_query_engine()
 
-    print(f"\n{shell_colors['BOLD']}{shell_colors['HEADER']}QueryEngine Metadatas: {shell_colors['ENDC']}{shell_colors['ENDC']}", "\n".join([f"\t- {shell_colors['BOLD']}TOOL {idx}{shell_colors['ENDC']}: {shell_colors['OKBLUE']}\"{x.name}\"{shell_colors['ENDC']} - {x.description}" for idx,x in enumerate(router_query_engine._metadatas)]), sep="\n")
+    chat_engine_kwargs = {}
+    if mode == "route_condense":
+        router_query_engine = query_engine.query_engine if isinstance(query_engine, CachedQueryEngine) else query_engine
+        chat_engine_kwargs["tool_metadatas"] = router_query_engine._metadatas
+    chat_engine_cls = {"condense": CondenseQuestionChatEngine, "fast": FastCondenseChatEngine, "route_condense": RouteCondenseChatEngine}[mode]
 
     # Return the chat engine
     # See https://docs.llamaindex.ai/en/stable/api_reference/chat_engines/condense_question/ for reference
-    return CondenseQuestionChatEngine.from_defaults(
-        query_engine=router_query_engine,
+    return chat_engine_cls.from_defaults(
+        query_engine=query_engine,
         condense_question_prompt=PromptTemplate(CONDENSE_QUESTION_PROMPT),
-        memory=ChatMemoryBuffer.from_defaults(chat_history=[], token_limit=1024, tokenizer_fn=node_parser._tokenizer),
+        memory=ChatMemoryBuffer.from_defaults(chat_history=[], token_limit=1024, tokenizer_fn=Settings.node_parser._tokenizer),
         streaming=True,
-        use_async=False,
-        verbose=True
+        use_async=True,
+        verbose=True,
+        **chat_engine_kwargs
         )
@@ -10,6 +10,10 @@ Make a bullet list to show what they can ask.
 """.strip()
 
 
+# Question answered by the chatbot info tool, whose answer is precomputed
+CHATBOT_INFO_QUESTION = "Ciao, cosa puoi fare?"
+
+
 SINGLE_SELECT_PROMPT = """
 Some choices are given below. It is provided in a numbered list (1 to {num_choices}), where each item in the list corresponds to a summary.\n
 You are allowed to select only 1 of the following tools. It is absolutely forbidden to output more than one selection.
@@ -30,6 +34,23 @@ Given a conversation (between Human and Assistant) and a follow up message from
 """.strip()
 
 
+ROUTE_CONDENSE_PROMPT = """
+Given a conversation (between Human and Assistant) and a follow up message from Human, do two things.
+First, rewrite the message including a brief summary of the context of the conversation. If you find asset names, include them in the summary. Be very specific about the followup question, the assistant's answer will need to be based on this.
+Then, choose the tool to answer the rewritten message. The tools are given below in a numbered list (1 to {num_choices}), where each item corresponds to a summary.
+You are allowed to select only 1 of the tools. It is absolutely forbidden to output more than one selection.
+\n---------------------\n
+{context_list}
+\n---------------------\n
+<Chat History>
+{chat_history}
+<Follow Up Message>
+{question}
+<Output>
+Return only a JSON object with the rewritten message and the number of the selected tool (1 to {num_choices}), in the format {"question": "<rewritten message>", "choice": <number of the tool>}
+""".strip()
+
+
 TOOL_DESCRIPTIONS = {
     "semantic_search" : """Use this query engine if you need to lookup specific information about the data assets contained in the data warehouse {key_name}. Never use this query engine if you are asked to actually do something other than answering a question. Consider that "ODS" is the default data warehouse; consider "OCS" only if the question explicitly mentions it.""".strip(),
     "asset_mapping" : "Use this query engine if and only if the question explicitly asks about the mapping for an asset between two data warehouses. Never use this query engine if the question does not mention the SAS data warehouse and or a set of given assets.".strip(),
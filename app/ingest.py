@@ -1,12 +1,22 @@
 import chromadb
-from llama_index.embeddings.vertex import VertexTextEmbedding
-from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
 import pandas as pd
-from llama_index.core.schema import Document
-from llama_index.vector_stores.chroma import ChromaVectorStore
+from llama_index.core.schema import Document, MetadataMode
 from dotenv import load_dotenv
-from models.gcp_client import init_gcp_client
+from models.gcp_client import get_credentials
+from models.embedding_cache import get_embedding_cache
+from chat_engine.LoadIndex.chroma_utils import upsert_chroma_nodes, read_catalog_version, write_catalog_version
+from chat_engine.LoadIndex.bm25_utils import persist_bm25_index, read_bm25_catalog_version
+from chat_engine.LoadIndex.numpy_vector_store import persist_vector_matrix, read_vector_matrix_params
+from ingestion.catalog_sources import CatalogSource, DataFrameSource, get_catalog_source
+from ingestion.concurrent_embedder import ConcurrentEmbedder, get_embedding_checkpoint
 import os
+import json
+import uuid
+import hashlib
+import time
+import argparse
 from tqdm import tqdm
 
 import sys
@@ -14,21 +24,29 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 
 load_dotenv()
-credentials = init_gcp_client()
+
+# Columns identifying an asset, used to derive its document id
+ASSET_KEY_COLUMNS = ['schema di appartenenza', 'tabella di appartenenza', 'nome asset']
 
 class BuildNodes:
     """
     Class for building the Chroma vector database.
     """
 
-    def __init__(self) -> None:
-        self.df_assets = self.prepare_dataframe()
+    def __init__(self, source: CatalogSource = None, embed_model: BaseEmbedding = None) -> None:
+        """
+        Args:
+            source: the catalog source, defaults to the example catalog.
+            embed_model: the embedding model, defaults to the Vertex one (e.g., the benchmarks use a local stand-in).
+        """
+        self.source = source or DataFrameSource(self.prepare_dataframe())
+        self.embed_model = embed_model
         self.collection_name = "demo"
 
     
     def prepare_dataframe(self) -> pd.DataFrame:
         """
-        Pipeline for creating the final assets DataFrame
+        Pipeline for creating the example assets DataFrame
 
         Returns:
             pd.DataFrame: A merged DataFrame containing asset information
@@ -282,83 +300,255 @@ class BuildNodes:
         ]
 
         # Creazione del dataframe
-        df = pd.DataFrame(data)
-        df['descrizione asset'] = df.apply(self.concatenate_row, axis=1)
-
-        return df
+        return pd.DataFrame(data)
 
 
-    def concatenate_row(self, row: pd.Series) -> pd.Series:
+    def concatenate_columns(self, df: pd.DataFrame) -> pd.Series:
         """
-        Concatenate attribute of each row into its description.
+        Concatenate the attributes of each row into its description, with vectorized string operations.
  
         Args:
-            row (pd.Series): a row of the initial dataframe.
+            df (pd.DataFrame): a chunk of the catalog.
         """
         # Getting original description
-        result = 'Descrizione: ' + row['descrizione asset']
+        return 'Descrizione: ' + df['descrizione asset'] + \
+            '\nNome asset: ' + df['nome asset'] + \
+            '\nTipo asset: ' + df['tipo asset'] + \
+            '\nNome tabella: ' + df['tabella di appartenenza'] + \
+            '\nDescrizione tabella: ' + df['descrizione tabella di appartenenza'] + \
+            '\nSchema tabella: ' + df['schema di appartenenza'] + \
+            '\nDescrizione schema tabella: ' + df['descrizione schema']
 
-        result += '\nNome asset: ' + row['nome asset']
-        result += '\nTipo asset: ' + row['tipo asset']
-        result += '\nNome tabella: ' + row['tabella di appartenenza']
-        result += '\nDescrizione tabella: ' + row['descrizione tabella di appartenenza']
-        result += '\nSchema tabella: ' + row['schema di appartenenza']
-        result += '\nDescrizione schema tabella: ' + row['descrizione schema']
+    @staticmethod
+    def asset_id(metadata: dict) -> str:
+        """
+        Deterministic document id, derived from the schema, table and name of the asset.
+        """
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, "/".join([metadata[col] for col in ASSET_KEY_COLUMNS])))
 
-        return result
+    @staticmethod
+    def fingerprint(text: str, metadata: dict) -> str:
+        """
+        Hash of the content of an asset, used to detect the changed ones.
+        """
+        return hashlib.sha256(json.dumps([text, metadata], sort_keys=True).encode("utf-8")).hexdigest()
 
-    def run_builder(self) -> None:
+    def build_documents(self, df: pd.DataFrame) -> list:
         """
-        Build the Chroma vector store and index.
+        Build the documents of a chunk of the catalog.
+        Ids are derived from the asset identity, so that running the ingestion again updates the same documents.
+
+        Args:
+            df (pd.DataFrame): a chunk of the catalog.
         """
-        Settings.embed_model = VertexTextEmbedding(
-            model_name=os.getenv("EMBEDDING_MODEL"),
-            project=os.getenv('GCP_PROJECT_ID'),
-            location=os.getenv('GCP_REGION'),
-            credentials=credentials,
-        )
+        df['descrizione asset'] = self.concatenate_columns(df)
 
-        # Build a list of documents from the processed dataframe
-        docs = list(
+        return list(
             map(
                 lambda x: Document(
+                    id_=self.asset_id(x[1]),
                     text=x[0],
-                    metadata=x[1],
-                    excluded_embed_metadata_keys=[x for x in self.df_assets.columns if x != 'Descrizione'],
-                    excluded_llm_metadata_keys=[],
+                    metadata={**x[1], 'fingerprint': self.fingerprint(x[0], x[1])},
+                    excluded_embed_metadata_keys=[x for x in df.columns if x != 'Descrizione'] + ['fingerprint'],
+                    excluded_llm_metadata_keys=['fingerprint'],
                     text_template="{metadata_str}\nDescrizione asset: {content}",
                     metadata_template='{key}: "{value}"',
                     metadata_seperator="\n",
                 ),
                 zip(
-                    self.df_assets['descrizione asset'].values,
-                    self.df_assets[[col for col in self.df_assets if col != 'descrizione asset']].to_dict(orient='records')
+                    df['descrizione asset'].values,
+                    df[[col for col in df if col != 'descrizione asset']].to_dict(orient='records')
                 )
             )
         )
 
-        # Instantiate the Chroma client
-        db = chromadb.PersistentClient(path=os.getenv("CHROMA_PATH"))
-        all_texts = [doc.text for doc in docs]
+    def diff_documents(self, chroma_collection, docs: list) -> tuple:
+        """
+        Compare the documents of a chunk with the content of the collection.
+
+        Args:
+            chroma_collection: the Chroma collection.
+            docs: the list of documents of the chunk.
+
+        Returns:
+            - the new documents.
+            - the changed documents.
+        """
+        stored = chroma_collection.get(where={"document_id": {"$in": [doc.doc_id for doc in docs]}}, include=["metadatas"])["metadatas"]
+        fingerprints = {}
+        for m in stored:
+            fingerprints.setdefault(m.get("document_id"), set()).add(m.get("fingerprint"))
+
+        # A document with nodes of several versions, left by an interrupted run, is changed as well
+        new_docs = [doc for doc in docs if doc.doc_id not in fingerprints]
+        changed_docs = [doc for doc in docs if doc.doc_id in fingerprints and fingerprints[doc.doc_id] != {doc.metadata['fingerprint']}]
+        return new_docs, changed_docs
 
-        # Embed the descriptions in batches
-        batch_embeddings = Settings.embed_model.get_text_embedding_batch(texts=all_texts, show_progress=True)
-        for i, doc in enumerate(docs):
-            # Assign to each document its corresponding embedding
-            doc.embedding = batch_embeddings[i]
+    def find_removed_ids(self, chroma_collection, catalog_ids: set, page_size: int = 10_000) -> list:
+        """
+        Page through the collection to find the documents no longer in the catalog.
+
+        Args:
+            chroma_collection: the Chroma collection.
+            catalog_ids: the ids of the documents of the current catalog.
+            page_size: the number of records read by each Chroma call.
+        """
+        removed_ids = set()
+        for offset in range(0, chroma_collection.count(), page_size):
+            metadatas = chroma_collection.get(include=["metadatas"], limit=page_size, offset=offset)["metadatas"]
+            removed_ids.update([m.get("document_id") for m in metadatas if m.get("document_id") not in catalog_ids])
+        return list(removed_ids)
 
-        # Create a collection
+    def delete_stale_nodes(self, chroma_collection, docs: list, node_ids: set, batch_size: int = 5000) -> None:
+        """
+        Delete the nodes of the previous version of changed documents.
+
+        Args:
+            chroma_collection: the Chroma collection.
+            docs: the changed documents.
+            node_ids: the ids of the nodes of their new version, which are kept.
+            batch_size: the number of nodes deleted by each Chroma call.
+        """
+        stored_ids = chroma_collection.get(where={"document_id": {"$in": [doc.doc_id for doc in docs]}}, include=[])["ids"]
+        stale_ids = [node_id for node_id in stored_ids if node_id not in node_ids]
+        for i in range(0, len(stale_ids), batch_size):
+            chroma_collection.delete(ids=stale_ids[i:i + batch_size])
+
+    def bulk_upsert(self, chroma_collection, nodes: list, batch_size: int = 5000) -> None:
+        """
+        Write the embedded nodes to the Chroma collection in large batches,
+        instead of inserting the documents one at a time through the index.
+
+        Args:
+            chroma_collection: the Chroma collection.
+            nodes: the list of nodes with their embeddings.
+            batch_size: the number of nodes written by each Chroma call.
+        """
+        start_time = time.perf_counter()
+        for i in tqdm(range(0, len(nodes), batch_size)):
+            upsert_chroma_nodes(chroma_collection, nodes[i:i + batch_size])
+
+        elapsed_time = time.perf_counter() - start_time
+        print(f"Upserted {len(nodes)} nodes in {elapsed_time:.2f}s ({len(nodes) / max(elapsed_time, 1e-9):.0f} docs/s)")
+
+    @staticmethod
+    def _vertex_embed_model() -> BaseEmbedding:
+        # The Vertex SDK and the credentials are only loaded when the catalog is embedded with Vertex
+        from llama_index.embeddings.vertex import VertexTextEmbedding
+
+        return VertexTextEmbedding(
+            model_name=os.getenv("EMBEDDING_MODEL"),
+            project=os.getenv('GCP_PROJECT_ID'),
+            location=os.getenv('GCP_REGION'),
+            credentials=get_credentials(),
+        )
+
+    def run_builder(self) -> None:
+        """
+        Build the Chroma vector store and index.
+        The catalog is streamed in chunks: only the new or changed assets are embedded and upserted,
+        and the removed ones are deleted at the end.
+        """
+        # Only the descriptions changed since the last run are sent to Vertex, several batches at a time
+        # Every embedded batch is saved in the checkpoint, which is never evicted, so an interrupted run resumes where it stopped
+        embedding_cache = get_embedding_cache()
+        checkpoint = get_embedding_checkpoint(self.collection_name)
+        embed_model = self.embed_model or self._vertex_embed_model()
+        embedder = ConcurrentEmbedder(
+            embed_model,
+            cache=embedding_cache,
+            checkpoint=checkpoint,
+            max_in_flight=int(os.getenv("EMBEDDING_MAX_IN_FLIGHT") or 4),
+            requests_per_minute=float(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE") or 0) or None,
+            tokens_per_minute=float(os.getenv("EMBEDDING_TOKENS_PER_MINUTE") or 0) or None,
+        )
+
+        # Instantiate the Chroma client and create a collection
+        db = chromadb.PersistentClient(path=os.getenv("CHROMA_PATH"))
         chroma_collection = db.get_or_create_collection(f'{self.collection_name}')
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, embed_model=Settings.embed_model)
+        batch_size = min(int(os.getenv("CHROMA_BATCH_SIZE") or 5000), db.get_max_batch_size())
+
+        # Each chunk of the catalog is embedded and written as it arrives
+        # The catalog version changes before the first write to the collection, so that the persisted indices
+        # no longer match it until they are rebuilt, even if the run is interrupted
+        catalog_ids = set()
+        catalog_changed = False
+        counts = {"new": 0, "changed": 0, "unchanged": 0}
+        for chunk in self.source.iter_chunks():
+            docs = self.build_documents(chunk)
+            catalog_ids.update([doc.doc_id for doc in docs])
+
+            # Compare the documents with the collection content
+            new_docs, changed_docs = self.diff_documents(chroma_collection, docs)
+            counts["new"] += len(new_docs)
+            counts["changed"] += len(changed_docs)
+            counts["unchanged"] += len(docs) - len(new_docs) - len(changed_docs)
+            if not new_docs and not changed_docs:
+                continue
+            if not catalog_changed:
+                write_catalog_version()
+                catalog_changed = True
+
+            # Split the documents into nodes once, and embed the same text indexed by the retrievers
+            nodes = Settings.node_parser.get_nodes_from_documents(new_docs + changed_docs)
+            all_texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+
+            # Embed the descriptions in batches
+            batch_embeddings = embedder.embed(all_texts)
+            for i, node in enumerate(nodes):
+                # Assign to each node its corresponding embedding
+                node.embedding = batch_embeddings[i]
 
-        for doc in tqdm(docs):
-            # Insert each document in the index
-            index.insert(doc)
+            # Write the nodes to the collection in bulk
+            self.bulk_upsert(chroma_collection, nodes, batch_size=batch_size)
+
+            # Delete the previous version of the changed assets only once the new one is written,
+            # so that a failed or interrupted run never leaves them out of the collection
+            if changed_docs:
+                self.delete_stale_nodes(chroma_collection, changed_docs, {node.node_id for node in nodes}, batch_size=batch_size)
+
+        # Delete the assets no longer in the catalog
+        removed_ids = self.find_removed_ids(chroma_collection, catalog_ids)
+        if removed_ids and not catalog_changed:
+            write_catalog_version()
+        for i in range(0, len(removed_ids), batch_size):
+            chroma_collection.delete(where={"document_id": {"$in": removed_ids[i:i + batch_size]}})
+
+        # Every node is in the collection, so the run no longer needs its checkpoint
+        checkpoint.clear()
+
+        print(f"Assets: {counts['new']} new, {counts['changed']} changed, {len(removed_ids)} removed, {counts['unchanged']} unchanged")
+        print(f"Embedding cache: {embedding_cache.stats()}")
+        numpy_backend = (os.getenv("VECTOR_STORE_BACKEND") or "chroma") == "numpy"
+        # The indices of an interrupted run do not match the catalog version, and are rebuilt even if nothing changed since
+        catalog_version = read_catalog_version()
+        matrix_params = read_vector_matrix_params(self.collection_name) or {}
+        persisted = catalog_version is not None and read_bm25_catalog_version(self.collection_name) == catalog_version \
+            and (not numpy_backend or (matrix_params.get("catalog_version"), matrix_params.get("embed_model")) == (catalog_version, embed_model.model_name))
+        if not counts["new"] and not counts["changed"] and not removed_ids and persisted:
+            return
+
+        # Invalidate the answers cached by the running chat engines, and stamp the indices with the new version
+        catalog_version = write_catalog_version()
+
+        # Persist the BM25 index next to the Chroma store, so that the chat engine can memory-map it
+        bm25_path = persist_bm25_index(chroma_collection, self.collection_name, catalog_version)
+        print(f"BM25 index saved in {bm25_path}")
+
+        # Persist the embedding matrix of the NumPy vector store as well
+        if numpy_backend:
+            matrix_path = persist_vector_matrix(chroma_collection, self.collection_name, catalog_version, embed_model.model_name)
+            print(f"Embedding matrix saved in {matrix_path}")
 
 
 def main():
-    node_builder = BuildNodes()
+    parser = argparse.ArgumentParser(description="Build the Chroma vector database from the assets catalog.")
+    parser.add_argument("catalog", nargs="?", default=os.getenv("CATALOG_PATH"), help="Catalog export (.csv, .jsonl or .parquet), defaults to CATALOG_PATH or to the example catalog.")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="Number of assets read, embedded and written at a time.")
+    args = parser.parse_args()
+
+    source = get_catalog_source(args.catalog, chunk_size=args.chunk_size) if args.catalog else None
+    node_builder = BuildNodes(source)
     node_builder.run_builder()
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+from typing import Iterator
+import pandas as pd
+import importlib.util
+import os
+
+
+class CatalogSource:
+    """
+    Base class of the catalog sources.
+    A source yields the assets in DataFrame chunks of at most `chunk_size` rows, so that the memory
+    used by the ingestion does not depend on the size of the catalog. All the values are strings.
+    """
+
+    def __init__(self, chunk_size: int = 10_000) -> None:
+        self.chunk_size = chunk_size
+
+    def _read_chunks(self) -> Iterator[pd.DataFrame]:
+        raise NotImplementedError
+
+    def iter_chunks(self) -> Iterator[pd.DataFrame]:
+        for chunk in self._read_chunks():
+            yield chunk.fillna("").astype(str)
+
+
+class DataFrameSource(CatalogSource):
+    """
+    Catalog already loaded in memory.
+    """
+
+    def __init__(self, df: pd.DataFrame, chunk_size: int = 10_000) -> None:
+        super().__init__(chunk_size)
+        self.df = df
+
+    def _read_chunks(self) -> Iterator[pd.DataFrame]:
+        for i in range(0, len(self.df), self.chunk_size):
+            yield self.df.iloc[i:i + self.chunk_size].copy()
+
+
+class CSVSource(CatalogSource):
+    """
+    Catalog exported as a CSV file.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 10_000, **read_kwargs) -> None:
+        super().__init__(chunk_size)
+        self.path = path
+        self.read_kwargs = read_kwargs
+
+    def _read_chunks(self) -> Iterator[pd.DataFrame]:
+        with pd.read_csv(self.path, chunksize=self.chunk_size, dtype=str, keep_default_na=False, **self.read_kwargs) as reader:
+            yield from reader
+
+
+class JSONLSource(CatalogSource):
+    """
+    Catalog exported as a JSON Lines file, one asset per line.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 10_000) -> None:
+        super().__init__(chunk_size)
+        self.path = path
+
+    def _read_chunks(self) -> Iterator[pd.DataFrame]:
+        with pd.read_json(self.path, lines=True, chunksize=self.chunk_size, dtype=False) as reader:
+            yield from reader
+
+
+class ParquetSource(CatalogSource):
+    """
+    Catalog exported as a Parquet file, read one record batch at a time (requires pyarrow).
+    """
+
+    def __init__(self, path: str, chunk_size: int = 10_000) -> None:
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ImportError("Reading a Parquet catalog requires pyarrow, install it with `poetry install --extras parquet`.")
+        super().__init__(chunk_size)
+        self.path = path
+
+    def _read_chunks(self) -> Iterator[pd.DataFrame]:
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(self.path).iter_batches(batch_size=self.chunk_size):
+            yield batch.to_pandas()
+
+
+CATALOG_SOURCES = {
+    ".csv": CSVSource,
+    ".jsonl": JSONLSource,
+    ".parquet": ParquetSource,
+}
+
+
+def get_catalog_source(path: str, chunk_size: int = 10_000) -> CatalogSource:
+    """
+    Get the source reading a catalog export, according to its extension.
+
+    Args:
+        path: the catalog export (.csv, .jsonl or .parquet).
+        chunk_size: the number of assets of each chunk.
+
+    Returns:
+        - the catalog source.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in CATALOG_SOURCES:
+        raise ValueError(f"Unsupported catalog format {extension}, expected one of {list(CATALOG_SOURCES)}.")
+    return CATALOG_SOURCES[extension](path, chunk_size=chunk_size)
@@ -0,0 +1,218 @@
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from typing import Dict, List, Optional
+from array import array
+from tqdm import tqdm
+import sqlite3
+import random
+import time
+import os
+from models.embedding_cache import EmbeddingCache, cache_model_key
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, refilled continuously at `rate_per_minute`.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, amount: float = 1) -> None:
+        """
+        Block until `amount` tokens are available, then consume them.
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class EmbeddingCheckpoint:
+    """
+    Embeddings computed by an ingestion run, kept until the run completes, so that an interrupted run resumes from them.
+    Unlike the embedding cache, the entries are never evicted: a catalog larger than the cache, or queries embedded
+    by the running chat engines in the meantime, do not push them out. Backed by SQLite, one run per collection.
+    """
+
+    def __init__(self, path: str, run: str) -> None:
+        """
+        Args:
+            path: the SQLite database file.
+            run: the name of the run, e.g., the collection being ingested.
+        """
+        self.path = path
+        self.run = run
+        self._lock = Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                run TEXT NOT NULL,
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (run, model, text_hash)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[Embedding]]:
+        """
+        Look up the embeddings of the texts, returning None for the missing ones.
+        """
+        hashes = [EmbeddingCache.text_hash(text) for text in texts]
+        found: Dict[str, Embedding] = {}
+
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, embedding FROM checkpoints WHERE run = ? AND model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [self.run, model, *batch],
+                ).fetchall()
+                found.update({text_hash: array("f", embedding).tolist() for text_hash, embedding in rows})
+
+        return [found.get(text_hash) for text_hash in hashes]
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[Embedding]) -> None:
+        rows = [(self.run, model, EmbeddingCache.text_hash(text), array("f", embedding).tobytes()) for text, embedding in zip(texts, embeddings)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def clear(self) -> None:
+        """
+        Drop the embeddings of the run, once it has completed.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE run = ?", (self.run,))
+            self._conn.commit()
+
+
+def get_embedding_checkpoint(run: str) -> EmbeddingCheckpoint:
+    """
+    Open the checkpoint of an ingestion run, in EMBEDDING_CHECKPOINT_PATH or by default next to the Chroma collections.
+    """
+    path = os.getenv("EMBEDDING_CHECKPOINT_PATH") or os.path.join(os.getenv("CHROMA_PATH") or ".", "embedding_checkpoint.sqlite3")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return EmbeddingCheckpoint(path, run)
+
+
+class ConcurrentEmbedder:
+    """
+    Embeds the ingested texts keeping several batches in flight at once.
+    Requests are throttled by token buckets on requests and tokens per minute, failed batches are
+    retried with jittered exponential backoff, and each completed batch is written to the checkpoint
+    right away: an interrupted run resumes from the batches already embedded.
+    Any LlamaIndex embedding model works, so it can run against a local fake server or an in-process stub.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache: Optional[EmbeddingCache] = None,
+        checkpoint: Optional[EmbeddingCheckpoint] = None,
+        batch_size: Optional[int] = None,
+        max_in_flight: int = 4,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        """
+        Args:
+            embed_model: the embedding model.
+            cache: the embedding cache, shared with the chat engine (None disables it).
+            checkpoint: the checkpoint of the run (None disables it).
+            batch_size: the number of texts of each request, defaults to the batch size of the model.
+            max_in_flight: the number of concurrent requests.
+            requests_per_minute: the request rate limit (None disables it).
+            tokens_per_minute: the token rate limit (None disables it).
+            max_retries: the number of retries of a failed request.
+            backoff_base: the base delay of the exponential backoff, in seconds.
+            max_backoff: the maximum delay between two retries, in seconds.
+        """
+        self.embed_model = embed_model
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size or embed_model.embed_batch_size
+        self.max_in_flight = max_in_flight
+        self.request_limiter = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_limiter = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def count_tokens(texts: List[str]) -> int:
+        # Rough estimate, about 4 characters per token
+        return sum(len(text) // 4 + 1 for text in texts)
+
+    def _embed_batch(self, texts: List[str]) -> List[Embedding]:
+        for attempt in range(self.max_retries + 1):
+            if self.request_limiter:
+                self.request_limiter.acquire(1)
+            if self.token_limiter:
+                self.token_limiter.acquire(self.count_tokens(texts))
+
+            try:
+                embeddings = self.embed_model.get_text_embedding_batch(texts)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = min(self.max_backoff, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"Embedding request failed ({e}), retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+
+        model_key = cache_model_key(self.embed_model.model_name, "text")
+        if self.checkpoint is not None:
+            self.checkpoint.put_many(model_key, texts, embeddings)
+        if self.cache is not None:
+            self.cache.put_many(model_key, texts, embeddings)
+        return embeddings
+
+    def embed(self, texts: List[str], show_progress: bool = True) -> List[Embedding]:
+        """
+        Embed the texts, skipping the ones already in the cache or in the checkpoint.
+
+        Args:
+            texts: the texts to embed.
+            show_progress: whether to show a progress bar over the batches.
+
+        Returns:
+            - the embeddings, in the same order as the texts.
+        """
+        model_key = cache_model_key(self.embed_model.model_name, "text")
+        cached = self.cache.get_many(model_key, texts) if self.cache is not None else [None] * len(texts)
+        if self.checkpoint is not None and any(e is None for e in cached):
+            uncached = [i for i, e in enumerate(cached) if e is None]
+            for i, e in zip(uncached, self.checkpoint.get_many(model_key, [texts[i] for i in uncached])):
+                cached[i] = e
+        missing = list(dict.fromkeys([text for text, e in zip(texts, cached) if e is None]))
+
+        computed = {}
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = {executor.submit(self._embed_batch, batch): batch for batch in batches}
+            for future in tqdm(as_completed(futures), total=len(futures), disable=not show_progress):
+                computed.update(zip(futures[future], future.result()))
+
+        return [e if e is not None else computed[text] for text, e in zip(texts, cached)]
@@ -1,7 +1,16 @@
 import chainlit as cl
+from chainlit.server import app
+from fastapi.responses import PlainTextResponse
 from utils.user_output import format_source
+from utils.token_stream import coalesce_tokens
 from llama_index.core.base.llms.types import ChatMessage, MessageRole
 from chat_engine.load_chat_engine import load_chat_engine
+from chat_engine.LogHandler.LogHandler import (
+    CustomLlamaIndexCallbackHandler,
+    session_callback_handler
+)
+from chat_engine.Metrics.Metrics import get_metrics_registry, current_tool
+from models.models import prewarm_models
 from common.prompts_templates.PromptTemplates import (
     HELLO_MESSAGE,
     EMPTY_SOURCES_MESSAGE
@@ -14,6 +23,19 @@ import os
 # Just ignore them
 ##################################################################################
 
+# Prometheus endpoint of the chat engine metrics
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return get_metrics_registry().render_prometheus()
+
+# Chainlit serves the frontend on a catch-all route, which must come after the endpoint
+app.router.routes.insert(0, app.router.routes.pop())
+
+# The models are initialized in the background while the server starts, instead of during the first chat
+if (os.getenv("PREWARM_MODELS") or "true").lower() == "true":
+    prewarm_models()
+
+
 # Function triggered when the Chainlit application is launched
 @cl.on_chat_start
 async def start_chat():
@@ -21,7 +43,13 @@ async def start_chat():
     await response_msg.send()
     
     # Load the chat engine, the core LlamaIndex component
-    cl.user_session.set("query_engine", load_chat_engine())
+    # The heavy components are built by the first session only and then shared by the whole process
+    # The steps shown in the UI can be turned off, removing the tracing from the request path
+    if (os.getenv("SHOW_STEPS") or "true").lower() == "true":
+        cl.user_session.set("callback_handler", CustomLlamaIndexCallbackHandler(max_chars=int(os.getenv("STEP_MAX_CHARS") or 2000)))
+    else:
+        cl.user_session.set("callback_handler", None)
+    cl.user_session.set("query_engine", await cl.make_async(load_chat_engine)())
     cl.user_session.set("memory", [])
     cl.user_session.set("assets", [])
 
@@ -32,17 +60,30 @@ async def handle_msg(message: cl.Message):
     query_engine = cl.user_session.get("query_engine")
     memory = cl.user_session.get("memory")
 
+    # Route the events of the shared components to the callback handler of this session
+    session_callback_handler.set(cl.user_session.get("callback_handler"))
+    # The tool is selected again for each message, so the events before the selection are not attributed to the previous one
+    current_tool.set(None)
+
     response_msg = cl.Message(content="", author=os.getenv("AUTHOR"))
     await response_msg.send()
 
-    response = await cl.make_async(query_engine.stream_chat)(message=message.content, chat_history=memory)
+    # The whole turn runs on the event loop, streaming the tokens as the LLM returns them
+    response = await query_engine.astream_chat(message=message.content, chat_history=memory)
     response_msg.content = response.response
 
-    for token in response.response_gen:
+    # The tokens are batched, so that each websocket message carries several of them
+    tokens = coalesce_tokens(
+        response.async_response_gen(), 
+        max_chars=int(os.getenv("STREAM_COALESCE_CHARS") or 64), 
+        max_delay=float(os.getenv("STREAM_COALESCE_MS") or 30) / 1000,
+        )
+    async for token in tokens:
         await response_msg.stream_token(token)
     await response_msg.send()
 
-    sources = [n for n in response.source_nodes if n.score]
+    # LlamaIndex only copies the source nodes of sync responses, so they are read from the tool outputs
+    sources = [n for tool_output in response.sources for n in getattr(tool_output.raw_output, "source_nodes", []) if n.score]
     if sources:
         source_refs = r"\, ".join([f"Fonte {idx+1}" for idx, _ in enumerate(sources)])
         source_elem = [cl.Text(name=f"Fonte {idx+1}",
@@ -0,0 +1,62 @@
+from llama_index.llms.vertex import Vertex
+from llama_index.llms.vertex.utils import _parse_chat_history, _parse_message
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    MessageRole,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.utilities.gemini_utils import merge_neighboring_same_role_messages
+from typing import Any, Sequence
+
+
+class AsyncStreamingVertex(Vertex):
+    """
+    Vertex LLM with native async streaming for the Gemini models, which the LlamaIndex integration does not implement.
+    The tokens are read from the async Vertex client, so no thread is blocked while the answer is generated.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncStreamingVertex"
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        if not self._is_gemini:
+            raise ValueError("Async streaming is only supported by the Gemini models.")
+
+        merged_messages = merge_neighboring_same_role_messages(messages)
+        question = _parse_message(merged_messages[-1], self._is_gemini)
+        chat_history = _parse_chat_history(merged_messages[:-1], self._is_gemini)
+        params = {**self._model_kwargs, **(kwargs or {})}
+
+        generation = self._chat_client.start_chat(history=chat_history.get("message_history", []))
+        response = await generation.send_message_async(question, stream=True, generation_config=params)
+
+        async def gen() -> ChatResponseAsyncGen:
+            content = ""
+            async for r in response:
+                content += r.text
+                yield ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=content), delta=r.text, raw=r.__dict__)
+
+        return gen()
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        if not self._is_gemini:
+            raise ValueError("Async streaming is only supported by the Gemini models.")
+
+        params = {**self._model_kwargs, **(kwargs or {})}
+        generation = self._client.start_chat(history=[])
+        response = await generation.send_message_async(prompt, stream=True, generation_config=params)
+
+        async def gen() -> CompletionResponseAsyncGen:
+            content = ""
+            async for r in response:
+                content += r.text
+                yield CompletionResponse(text=content, delta=r.text, raw=r.__dict__)
+
+        return gen()
@@ -0,0 +1,245 @@
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from typing import Dict, List, Optional
+from array import array
+from threading import Lock
+import asyncio
+import hashlib
+import sqlite3
+import time
+import os
+
+
+# Seconds between two writes of the last use of the cache hits
+TOUCH_FLUSH_INTERVAL = 60
+# Fraction of the entries kept by an eviction, so that the following inserts do not evict again right away
+EVICTION_TARGET = 0.9
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache, keyed by (model name, text hash) and backed by SQLite.
+    The least recently used entries are evicted once the cache exceeds `max_entries`.
+    The database runs in WAL mode, so that it can be shared by the ingestion and by several workers.
+    The lookups do not write: the last use of the hits is buffered in memory, and written with the next
+    insert or every `touch_flush_interval` seconds.
+    """
+
+    def __init__(self, path: str = ":memory:", max_entries: int = 100_000, touch_flush_interval: float = TOUCH_FLUSH_INTERVAL) -> None:
+        """
+        Args:
+            path: the SQLite database file (":memory:" keeps the cache in memory only).
+            max_entries: the maximum number of cached embeddings.
+            touch_flush_interval: seconds between two writes of the buffered last uses.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_flush_interval = touch_flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._touched: Dict[tuple, float] = {}
+        self._flushed = time.monotonic()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # Running estimate of the number of entries, counted again only when it exceeds max_entries,
+        # since the other processes sharing the database insert and evict as well
+        (self._size,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[Embedding]]:
+        """
+        Look up the embeddings of the texts, returning None for the missing ones.
+        """
+        hashes = [self.text_hash(text) for text in texts]
+        found: Dict[str, Embedding] = {}
+
+        with self._lock:
+            # Stay well below the SQLite limit on the number of query parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                found.update({text_hash: array("f", embedding).tolist() for text_hash, embedding in rows})
+
+            now = time.time()
+            for text_hash in found:
+                self._touched[(model, text_hash)] = now
+            if self._touched and time.monotonic() - self._flushed > self.touch_flush_interval:
+                self._flush_touches()
+                self._conn.commit()
+
+            embeddings = [found.get(text_hash) for text_hash in hashes]
+            self.hits += sum(e is not None for e in embeddings)
+            self.misses += sum(e is None for e in embeddings)
+
+        return embeddings
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[Embedding]) -> None:
+        """
+        Store the embeddings of the texts, evicting the least recently used entries if needed.
+        """
+        now = time.time()
+        rows = [(model, self.text_hash(text), array("f", embedding).tobytes(), now) for text, embedding in zip(texts, embeddings)]
+
+        with self._lock:
+            self._flush_touches()
+            # Only the rows actually inserted grow the cache, the existing ones are updated in place
+            self._size += self._conn.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)", rows).rowcount
+            self._conn.executemany(
+                "UPDATE embeddings SET embedding = ?, last_used = ? WHERE model = ? AND text_hash = ?",
+                [(embedding, last_used, model, text_hash) for model, text_hash, embedding, last_used in rows],
+            )
+            if self._size > self.max_entries:
+                (self._size,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+                if self._size > self.max_entries:
+                    evicted = self._size - int(self.max_entries * EVICTION_TARGET)
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (evicted,),
+                    )
+                    self._size -= evicted
+            self._conn.commit()
+
+    def _flush_touches(self) -> None:
+        """
+        Write the buffered last uses, within the transaction of the caller (with the lock held).
+        """
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(last_used, model, text_hash) for (model, text_hash), last_used in self._touched.items()],
+            )
+            self._touched = {}
+        self._flushed = time.monotonic()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Hit and miss counters since the cache was opened.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def cache_model_key(model_name: str, kind: str) -> str:
+    """
+    Cache key of an embedding model; query and document ("text") embeddings are kept apart,
+    since Vertex embeds them with different task types.
+    """
+    return f"{model_name}:{kind}"
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Open the embedding cache configured by EMBEDDING_CACHE_PATH and EMBEDDING_CACHE_MAX_ENTRIES.
+    """
+    return EmbeddingCache(
+        path=os.getenv("EMBEDDING_CACHE_PATH") or ":memory:",
+        max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES") or 100_000),
+    )
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that only embeds the texts missing from the cache.
+    """
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache) -> None:
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size)
+        self._embed_model = embed_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _lookup(self, kind: str, texts: List[str]):
+        embeddings = self._cache.get_many(cache_model_key(self.model_name, kind), texts)
+        missing = list(dict.fromkeys([text for text, e in zip(texts, embeddings) if e is None]))
+        return embeddings, missing
+
+    def _store(self, kind: str, texts: List[str], embeddings: List[Optional[Embedding]], missing: List[str], computed: List[Embedding]) -> List[Embedding]:
+        if not missing:
+            return embeddings
+        self._cache.put_many(cache_model_key(self.model_name, kind), missing, computed)
+        computed = dict(zip(missing, computed))
+        return [e if e is not None else computed.get(text) for text, e in zip(texts, embeddings)]
+
+    def _cached(self, kind: str, texts: List[str], embed_fn) -> List[Embedding]:
+        embeddings, missing = self._lookup(kind, texts)
+        return self._store(kind, texts, embeddings, missing, embed_fn(missing) if missing else [])
+
+    async def _acached(self, kind: str, texts: List[str], aembed_fn) -> List[Embedding]:
+        # The SQLite calls are blocking, so they run in a worker thread instead of on the event loop
+        embeddings, missing = await asyncio.to_thread(self._lookup, kind, texts)
+        if not missing:
+            return embeddings
+        return await asyncio.to_thread(self._store, kind, texts, embeddings, missing, await aembed_fn(missing))
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._cached("query", [query], lambda texts: [self._embed_model.get_query_embedding(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        async def aembed(texts):
+            return [await self._embed_model.aget_query_embedding(texts[0])]
+        return (await self._acached("query", [query], aembed))[0]
+
+    async def aget_query_embedding_batch(self, queries: List[str], timeout: Optional[float] = None) -> List[Optional[Embedding]]:
+        """
+        Embed several queries with a single cache lookup.
+        Vertex has no batch request for the query task type, so the missing queries are embedded concurrently.
+
+        Args:
+            queries: the queries.
+            timeout: seconds to wait for the embedding requests (None waits indefinitely);
+                the queries not embedded in time get None, and their requests are cancelled.
+
+        The queries whose embedding request failed get None as well, so that one failed request does not fail the others.
+        """
+        embeddings, missing = await asyncio.to_thread(self._lookup, "query", queries)
+        if not missing:
+            return embeddings
+
+        tasks = {text: asyncio.ensure_future(self._embed_model.aget_query_embedding(text)) for text in missing}
+        done, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        embedded = [text for text, task in tasks.items() if task in done and task.exception() is None]
+        return await asyncio.to_thread(self._store, "query", queries, embeddings, embedded, [tasks[text].result() for text in embedded])
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._cached("text", texts, self._embed_model.get_text_embedding_batch)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._acached("text", texts, self._embed_model.aget_text_embedding_batch)
@@ -1,8 +1,9 @@
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
-import vertexai
+from threading import Lock
 import os
 
+_credentials = None
+_credentials_lock = Lock()
+
 def init_gcp_client():
     """
     Initialize the GCP client and connect to Vertex using the GCP credentials.
@@ -10,6 +11,11 @@ def init_gcp_client():
     Returns:
         credentials: the credentials to run Gemini using LlamaIndex.
     """
+    # The Google SDKs are slow to import, so they are only loaded when the client is initialized
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request
+    import vertexai
+
     filename = os.getenv('GCP_KEY_PATH')
     credentials: service_account.Credentials = (
         service_account.Credentials.from_service_account_file(filename)
@@ -19,4 +25,14 @@ def init_gcp_client():
         credentials.refresh(Request())
 
     vertexai.init(project=os.getenv('PROJECT_ID'), location=os.getenv('REGION'), credentials=credentials)
-    return credentials
\ No newline at end of file
+    return credentials
+
+def get_credentials():
+    """
+    Initialize the GCP client at the first call, and return the same credentials afterwards.
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = init_gcp_client()
+        return _credentials
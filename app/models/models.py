@@ -1,52 +1,109 @@
 import os
-from models.gcp_client import init_gcp_client
-from llama_index.llms.vertex import Vertex
-from llama_index.embeddings.vertex import VertexTextEmbedding
-from vertexai.generative_models import GenerationConfig, GenerativeModel
+import time
+from typing import Optional
+from threading import RLock, Thread
+from models.gcp_client import get_credentials
+from models.embedding_cache import CachedEmbedding, get_embedding_cache
 from llama_index.core import Settings
+from common.prompts_templates.PromptTemplates import SYSTEM_PROMPT_ASSISTANT
+from chat_engine.LogHandler.shell import shell_colors
 
-# Get the credentials to be passed to the LlamaIndex Vertex models
-credentials = init_gcp_client()
+# The models are built at their first use, or by prewarm_models in the background:
+# the Vertex SDK is slow to import, and the credentials are read (and possibly refreshed) over the network
+_models = {}
+_models_lock = RLock()
 
-def load_index_models(credentials) -> None:
+def _memoized(name, factory):
+    with _models_lock:
+        if name not in _models:
+            _models[name] = factory()
+        return _models[name]
+
+def load_index_models() -> None:
     """
     Load the LlamaIndex LLM and embedding model, and give them global scope within the codebase.
+    They are loaded once, at the first call.
     See https://docs.llamaindex.ai/en/stable/module_guides/supporting_modules/service_context_migration/ for further information.
+    """
+    def factory():
+        from models.async_vertex import AsyncStreamingVertex
+        from llama_index.embeddings.vertex import VertexTextEmbedding
 
-    Args:
-        credentials: the GCP credentials.
-    """
-    # Initialize the Gemini LLM
-    llm = Vertex(
-        model=os.getenv("LLM_MODEL"), 
-        project=credentials.project_id, 
-        credentials=credentials, 
-        temperature=os.getenv("LLM_TEMPERATURE"),
-        max_tokens=os.getenv("LLM_MAX_TOKENS"), 
-        system_prompt="Rispondi sempre in italiano." # This system prompt is the same for all the LlamaIndex components using the LLM
-    )
-    # Initialize the embedding model
-    embeddings_model = VertexTextEmbedding(
-            model_name=os.getenv("EMBEDDING_MODEL"),
+        credentials = get_credentials()
+
+        # Initialize the Gemini LLM, with async streaming support
+        llm = AsyncStreamingVertex(
+            model=os.getenv("LLM_MODEL"),
             project=credentials.project_id,
-            location=os.getenv("GCP_REGION"),
             credentials=credentials,
+            temperature=os.getenv("LLM_TEMPERATURE"),
+            max_tokens=os.getenv("LLM_MAX_TOKENS"),
+            system_prompt="Rispondi sempre in italiano." # This system prompt is the same for all the LlamaIndex components using the LLM
+        )
+        # Initialize the embedding model
+        embeddings_model = VertexTextEmbedding(
+                model_name=os.getenv("EMBEDDING_MODEL"),
+                project=credentials.project_id,
+                location=os.getenv("GCP_REGION"),
+                credentials=credentials,
+            )
+
+        Settings.llm = llm
+        # Repeated questions are embedded only once, also across restarts
+        Settings.embed_model = CachedEmbedding(embeddings_model, get_embedding_cache())
+        return True
+
+    _memoized("index_models", factory)
+
+def get_generation_config(temperature: Optional[float] = None):
+    """
+    Generation config of the Gemini instances used for secondary tasks.
+
+    Args:
+        temperature: the temperature of the generation, defaults to LLM_TEMPERATURE.
+    """
+    def factory():
+        from vertexai.generative_models import GenerationConfig
+
+        return GenerationConfig(
+            max_output_tokens=int(os.getenv("LLM_MAX_TOKENS")),
+            temperature=float(os.getenv("LLM_TEMPERATURE")) if temperature is None else temperature,
+            top_p=float(os.getenv("LLM_TOP_P"))
         )
 
-    Settings.llm = llm
-    Settings.embed_model = embeddings_model
+    return _memoized("generation_config" if temperature is None else f"generation_config_{temperature}", factory)
+
+def get_gemini_assistant():
+    """
+    Dedicated Gemini instance for the chatbot info tool, whose system instruction is set once and never changed.
+    """
+    def factory():
+        from vertexai.generative_models import GenerativeModel
+
+        get_credentials()
+        return GenerativeModel(
+            os.getenv("LLM_MODEL"),
+            generation_config=get_generation_config(),
+            system_instruction=SYSTEM_PROMPT_ASSISTANT
+        )
 
-# Load the models and give them global scope
-load_index_models(credentials)
+    return _memoized("gemini_assistant", factory)
 
-# Initialise also a separate Gemini instance for secondary tasks
-generation_config = GenerationConfig(
-    max_output_tokens=int(os.getenv("LLM_MAX_TOKENS")),
-    temperature=float(os.getenv("LLM_TEMPERATURE")),
-    top_p=float(os.getenv("LLM_TOP_P"))
-)
+def prewarm_models() -> Thread:
+    """
+    Initialize the client and all the models in a background thread, so that the first request does not wait for them.
+    The requests arriving earlier wait for the same initialization instead of repeating it.
+    """
+    def prewarm():
+        start_time = time.perf_counter()
+        try:
+            load_index_models()
+            get_gemini_assistant()
+        except Exception as e:
+            print(f"{shell_colors['WARNING']}Model prewarm failed, the models will be initialized at their first use: {e}{shell_colors['ENDC']}")
+            return
+        print(f"{shell_colors['OKGREEN']}Models initialized in {time.perf_counter() - start_time:.2f}s{shell_colors['ENDC']}")
 
-gemini_flash = GenerativeModel(
-    os.getenv("LLM_MODEL"),
-    generation_config=generation_config
-)
+    thread = Thread(target=prewarm, daemon=True, name="ModelPrewarm")
+    thread.start()
+    return thread
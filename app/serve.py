@@ -0,0 +1,144 @@
+"""
+Multi-process serving of the Chainlit application.
+The parent process imports the application and reads the persisted BM25 indices, then forks one Chainlit server
+per worker: the workers inherit the loaded modules copy-on-write and memory-map the same BM25 index pages, so that
+the retrieval and the JSON parsing run on several cores instead of behind a single GIL.
+The parent then serves the public port through a sticky proxy, which keeps each browser session on one worker.
+
+    python app/serve.py --workers 4 --port 8000
+"""
+from chat_engine.LogHandler.shell import shell_colors
+from serving.sticky_proxy import StickyProxy
+from dotenv import load_dotenv
+from pathlib import Path
+import argparse
+import asyncio
+import signal
+import socket
+import time
+import gc
+import os
+
+load_dotenv()
+
+APP_DIR = Path(__file__).resolve().parent
+
+
+def preload() -> None:
+    """
+    Load in the parent process what the workers can share.
+    The Chroma client is not created here: its SQLite connections and background threads do not survive a fork,
+    so each worker opens the collections itself.
+    """
+    import chainlit.server # noqa: F401
+    import chat_engine.load_chat_engine # noqa: F401
+
+    # The BM25 indices are memory-mapped by the workers, reading them once brings their pages in the page cache
+    bm25_root = os.getenv("BM25_PATH") or os.path.join(os.getenv("CHROMA_PATH") or "", "bm25")
+    for folder, _, filenames in os.walk(bm25_root):
+        for filename in filenames:
+            with open(os.path.join(folder, filename), "rb") as f:
+                while f.read(1 << 24):
+                    pass
+
+    # The objects loaded so far are never collected, so the garbage collector of the workers does not copy their pages
+    gc.collect()
+    gc.freeze()
+
+
+def start_worker(port: int) -> int:
+    """
+    Fork a worker running the Chainlit server on a local port.
+
+    Returns:
+        - the pid of the worker.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    # The proxy is the only public endpoint
+    os.environ["CHAINLIT_HOST"] = "127.0.0.1"
+    os.environ["CHAINLIT_PORT"] = str(port)
+    try:
+        from chainlit.cli import run_chainlit
+        run_chainlit(str(APP_DIR / "main.py"))
+    finally:
+        os._exit(0)
+
+
+def wait_for_workers(ports, timeout: float = 120) -> None:
+    """
+    Wait until every worker accepts connections.
+    """
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"The worker on port {port} did not start within {timeout}s")
+                time.sleep(0.2)
+
+
+async def serve(proxy: StickyProxy, host: str, port: int, pids) -> None:
+    """
+    Serve the proxy until a signal is received or a worker exits.
+    """
+    loop = asyncio.get_running_loop()
+    proxy_task = asyncio.ensure_future(proxy.serve(host, port))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, proxy_task.cancel)
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(1)
+            for pid in pids:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    # A worker holds the sessions of its browsers, so the whole server is stopped and restarted by its supervisor
+                    print(f"{shell_colors['FAIL']}Worker {pid} exited, stopping the server{shell_colors['ENDC']}")
+                    pids.remove(pid)
+                    proxy_task.cancel()
+                    return
+
+    watcher = asyncio.ensure_future(watch_workers())
+    try:
+        await proxy_task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Chainlit application with several worker processes.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVE_WORKERS") or os.cpu_count()), help="Number of worker processes, defaults to SERVE_WORKERS or to the number of cores.")
+    parser.add_argument("--host", default=os.getenv("CHAINLIT_HOST") or "0.0.0.0", help="Host of the public endpoint.")
+    parser.add_argument("--port", type=int, default=int(os.getenv("CHAINLIT_PORT") or 8000), help="Port of the public endpoint.")
+    parser.add_argument("--worker-port", type=int, default=None, help="Port of the first worker, the others use the following ones (defaults to the public port + 1).")
+    args = parser.parse_args()
+
+    worker_ports = [(args.worker_port or args.port + 1) + i for i in range(args.workers)]
+
+    start_time = time.perf_counter()
+    preload()
+    print(f"{shell_colors['OKCYAN']}==> Application preloaded in {time.perf_counter() - start_time:.2f}s, starting {args.workers} workers{shell_colors['ENDC']}")
+
+    pids = [start_worker(port) for port in worker_ports]
+    try:
+        wait_for_workers(worker_ports)
+        print(f"{shell_colors['OKGREEN']}Serving on http://{args.host}:{args.port} with workers on ports {', '.join(map(str, worker_ports))}{shell_colors['ENDC']}")
+        asyncio.run(serve(StickyProxy(worker_ports), args.host, args.port, pids))
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Standalone retrieval service: the hybrid retrieval of the collections, served over HTTP or a Unix socket.
+The concurrent queries are micro-batched, so that several chat front-ends share one warm index.
+The chat engine uses it when RETRIEVAL_SERVICE_URL is set (e.g., "http://127.0.0.1:8100" or "unix:///tmp/retrieval.sock").
+
+    python app/serve_retrieval.py --port 8100
+    python app/serve_retrieval.py --uds /tmp/retrieval.sock
+"""
+from serving.retrieval_service import load_retrieval_app
+from dotenv import load_dotenv
+import argparse
+import uvicorn
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the hybrid retrieval of the collections.")
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the service.")
+    parser.add_argument("--port", type=int, default=8100, help="Port of the service.")
+    parser.add_argument("--uds", help="Unix socket of the service, in place of the host and port.")
+    parser.add_argument("--batch-size", type=int, default=None, help="Maximum number of queries of a batch, defaults to RETRIEVAL_BATCH_SIZE or 32.")
+    parser.add_argument("--batch-wait-ms", type=float, default=None, help="Maximum time a query waits for the following ones, defaults to RETRIEVAL_BATCH_WAIT_MS or 5.")
+    args = parser.parse_args()
+
+    app = load_retrieval_app(max_batch_size=args.batch_size, max_wait=args.batch_wait_ms / 1000 if args.batch_wait_ms is not None else None)
+    uvicorn.run(app, host=args.host, port=args.port, uds=args.uds, log_level="warning")
+
+
+if __name__ == '__main__':
+    main()
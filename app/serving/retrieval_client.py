@@ -0,0 +1,115 @@
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+import httpx
+from chat_engine.SemanticSearchQE.HybridRetriever import HybridNodeWithScore
+
+
+def deserialize_node(data: Dict[str, Any]) -> NodeWithScore:
+    """
+    Retrieved node from its JSON form (see retrieval_service.serialize_node).
+    """
+    node = TextNode.from_dict(data["node"])
+    if data.get("bm25_score") is None and data.get("vector_score") is None:
+        return NodeWithScore(node=node, score=data["score"])
+    return HybridNodeWithScore(node=node, score=data["score"], bm25_score=data.get("bm25_score"), vector_score=data.get("vector_score"))
+
+
+class RetrievalServiceClient:
+    """
+    Client of the retrieval service, over HTTP ("http://host:port") or a Unix socket ("unix:///path/to/socket").
+    """
+
+    def __init__(self, url: str, timeout: Optional[float] = None) -> None:
+        """
+        Args:
+            url: the address of the service.
+            timeout: seconds to wait for each request (None waits indefinitely).
+        """
+        parsed = urlparse(url)
+        if parsed.scheme == "unix":
+            base_url = "http://retrieval-service"
+            transport, async_transport = httpx.HTTPTransport(uds=parsed.path), httpx.AsyncHTTPTransport(uds=parsed.path)
+        else:
+            base_url = url.rstrip("/")
+            transport, async_transport = httpx.HTTPTransport(), httpx.AsyncHTTPTransport()
+
+        self._client = httpx.Client(base_url=base_url, transport=transport, timeout=timeout)
+        self._async_client = httpx.AsyncClient(base_url=base_url, transport=async_transport, timeout=timeout)
+
+    def collections(self) -> Dict[str, int]:
+        """
+        The number of nodes of each collection.
+        """
+        response = self._client.get("/collections")
+        response.raise_for_status()
+        return response.json()
+
+    def retrieve(self, collection: str, query: str) -> List[NodeWithScore]:
+        response = self._client.post("/retrieve", json={"collection": collection, "query": query})
+        response.raise_for_status()
+        return [deserialize_node(node) for node in response.json()["nodes"]]
+
+    async def aretrieve(self, collection: str, query: str) -> List[NodeWithScore]:
+        response = await self._async_client.post("/retrieve", json={"collection": collection, "query": query})
+        response.raise_for_status()
+        return [deserialize_node(node) for node in response.json()["nodes"]]
+
+    def get_nodes(self, collection: str, node_ids: List[str]) -> List[Optional[TextNode]]:
+        response = self._client.post("/nodes", json={"collection": collection, "ids": node_ids})
+        response.raise_for_status()
+        return [TextNode.from_dict(node) if node is not None else None for node in response.json()["nodes"]]
+
+
+class RemoteRetriever(BaseRetriever):
+    """
+    Retriever of a collection served by the retrieval service, in place of the local hybrid retriever.
+    """
+
+    def __init__(self, client: RetrievalServiceClient, collection: str) -> None:
+        self.client = client
+        self.collection = collection
+        super().__init__(None)
+
+    def _retrieve(self, query_bundle):
+        return self.client.retrieve(self.collection, query_bundle.query_str)
+
+    async def _aretrieve(self, query_bundle):
+        return await self.client.aretrieve(self.collection, query_bundle.query_str)
+
+
+class RemoteNodeStore:
+    """
+    Node store of a collection served by the retrieval service, with the interface of ChromaNodeStore used by the chat engine.
+    """
+
+    def __init__(self, client: RetrievalServiceClient, collection: str, size: int) -> None:
+        self.client = client
+        self.collection = collection
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def get_nodes(self, node_ids):
+        return self.client.get_nodes(self.collection, list(node_ids)) if node_ids else []
+
+
+def load_remote_collections(url: str, timeout: Optional[float] = None):
+    """
+    Connect to the retrieval service, in place of loading the Chroma vector database.
+
+    Args:
+        url: the address of the service.
+        timeout: seconds to wait for each request (None waits indefinitely).
+
+    Returns:
+        - the node store of each collection.
+        - the retriever of each collection.
+    """
+    client = RetrievalServiceClient(url, timeout=timeout)
+    collections = client.collections()
+    nodes = {name: RemoteNodeStore(client, name, size) for name, size in collections.items()}
+    retrievers = {name: RemoteRetriever(client, name) for name in collections}
+    return nodes, retrievers
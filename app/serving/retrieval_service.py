@@ -0,0 +1,187 @@
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.schema import NodeWithScore
+from llama_index.core import Settings
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+import asyncio
+import os
+from chat_engine.SemanticSearchQE.HybridRetriever import HybridRetriever
+from chat_engine.SemanticSearchQE.SemanticSearchQETool import build_hybrid_retriever, get_env_number
+from chat_engine.LogHandler.shell import shell_colors
+from chat_engine.LoadIndex.load_vector_indices import load_vector_indices
+from models.models import load_index_models
+
+
+class RetrieveRequest(BaseModel):
+    collection: str
+    query: str
+
+
+class NodesRequest(BaseModel):
+    collection: str
+    ids: List[str]
+
+
+def serialize_node(node_with_score: NodeWithScore) -> Dict[str, Any]:
+    """
+    JSON form of a retrieved node, keeping the raw scores of the hybrid retrieval if fused.
+    """
+    return {
+        "node": node_with_score.node.to_dict(),
+        "score": node_with_score.score,
+        "bm25_score": getattr(node_with_score, "bm25_score", None),
+        "vector_score": getattr(node_with_score, "vector_score", None),
+    }
+
+
+async def aembed_queries(embed_model: BaseEmbedding, queries: List[str], timeout: Optional[float] = None) -> List[Optional[Embedding]]:
+    """
+    Embed several queries, with a single cache lookup if the embedding model is cached.
+    The queries not embedded within `timeout` seconds, or whose embedding request failed, get None.
+    """
+    if hasattr(embed_model, "aget_query_embedding_batch"):
+        return await embed_model.aget_query_embedding_batch(queries, timeout=timeout)
+
+    tasks = [asyncio.ensure_future(embed_model.aget_query_embedding(query)) for query in queries]
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    return [task.result() if task in done and task.exception() is None else None for task in tasks]
+
+
+class QueryBatcher:
+    """
+    Micro-batching of the concurrent retrieval queries.
+    The queries arriving within `max_wait` seconds of each other (up to `max_batch_size` of them) are embedded together,
+    then the BM25 scoring and the vector search of the queries of each collection run as a single batch
+    (see HybridRetriever.retrieve_batch), in a worker thread.
+    The queries not embedded within `embed_timeout` seconds, or whose embedding failed, are only searched by BM25,
+    like a timed out vector search.
+    """
+
+    def __init__(self, retrievers: Dict[str, HybridRetriever], embed_model: BaseEmbedding, max_batch_size: int = 32, max_wait: float = 0.005, embed_timeout: Optional[float] = None) -> None:
+        """
+        Args:
+            retrievers: the hybrid retriever of each collection.
+            embed_model: the embedding model of the queries.
+            max_batch_size: the maximum number of queries of a batch.
+            max_wait: the maximum time a query waits for the following ones, in seconds.
+            embed_timeout: seconds to wait for the query embeddings (None waits indefinitely).
+        """
+        self.retrievers = retrievers
+        self.embed_model = embed_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.embed_timeout = embed_timeout
+        self._pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batches = set()
+
+    async def retrieve(self, collection: str, query: str) -> List[NodeWithScore]:
+        if collection not in self.retrievers:
+            raise KeyError(collection)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((collection, query, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # The running batches are referenced, so that they are not garbage collected
+            task = asyncio.ensure_future(self._run(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch) -> None:
+        try:
+            queries = list(dict.fromkeys([query for _, query, _ in batch]))
+            embeddings = dict(zip(queries, await aembed_queries(self.embed_model, queries, timeout=self.embed_timeout)))
+            not_embedded = sum(embedding is None for embedding in embeddings.values())
+            if not_embedded:
+                timed_out = f" or not embedded within {self.embed_timeout}s" if self.embed_timeout is not None else ""
+                print(f"{shell_colors['WARNING']}{not_embedded} of {len(queries)} query embeddings failed{timed_out}, they are only searched by BM25{shell_colors['ENDC']}")
+
+            by_collection = {}
+            for collection, query, future in batch:
+                by_collection.setdefault(collection, []).append((query, future))
+
+            async def run_collection(collection, items):
+                query_strs = [query for query, _ in items]
+                results = await asyncio.to_thread(self.retrievers[collection].retrieve_batch, query_strs, [embeddings[query] for query in query_strs])
+                for (_, future), nodes in zip(items, results):
+                    if not future.done():
+                        future.set_result(nodes)
+
+            await asyncio.gather(*[run_collection(collection, items) for collection, items in by_collection.items()])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+def create_retrieval_app(batcher: QueryBatcher, node_stores: Dict) -> FastAPI:
+    """
+    HTTP interface of the retrieval service.
+
+    Args:
+        batcher: the query batcher over the hybrid retrievers.
+        node_stores: the node store of each collection.
+    """
+    app = FastAPI(title="Retrieval service")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/collections")
+    async def collections():
+        return {name: len(node_store) for name, node_store in node_stores.items()}
+
+    @app.post("/retrieve")
+    async def retrieve(request: RetrieveRequest):
+        try:
+            nodes = await batcher.retrieve(request.collection, request.query)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Unknown collection {request.collection}")
+        return {"nodes": [serialize_node(node) for node in nodes]}
+
+    @app.post("/nodes")
+    async def nodes(request: NodesRequest):
+        if request.collection not in node_stores:
+            raise HTTPException(status_code=404, detail=f"Unknown collection {request.collection}")
+        found = await asyncio.to_thread(node_stores[request.collection].get_nodes, request.ids)
+        return {"nodes": [node.to_dict() if node is not None else None for node in found]}
+
+    return app
+
+
+def load_retrieval_app(max_batch_size: Optional[int] = None, max_wait: Optional[float] = None) -> FastAPI:
+    """
+    Load the collections of the Chroma vector database and the embedding model, and build the retrieval service over them.
+
+    Args:
+        max_batch_size: the maximum number of queries of a batch, defaults to RETRIEVAL_BATCH_SIZE or 32.
+        max_wait: the maximum time a query waits for the following ones in seconds, defaults to RETRIEVAL_BATCH_WAIT_MS or 5 ms.
+    """
+    load_index_models()
+    nodes, vector_indices = load_vector_indices()
+    retrievers = {name: build_hybrid_retriever(name, nodes[name], vector_index) for name, vector_index in vector_indices.items()}
+
+    batcher = QueryBatcher(
+        retrievers,
+        Settings.embed_model,
+        max_batch_size=max_batch_size or int(os.getenv("RETRIEVAL_BATCH_SIZE") or 32),
+        max_wait=max_wait if max_wait is not None else float(os.getenv("RETRIEVAL_BATCH_WAIT_MS") or 5) / 1000,
+        # A slow embedding endpoint degrades the search to BM25 only, as in the chat engine
+        embed_timeout=get_env_number("VECTOR_RETRIEVER_TIMEOUT"),
+    )
+    return create_retrieval_app(batcher, nodes)
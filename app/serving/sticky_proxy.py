@@ -0,0 +1,118 @@
+from typing import List, Optional, Tuple
+from http.cookies import SimpleCookie
+import itertools
+import asyncio
+import re
+
+STICKY_COOKIE = "chainlit_worker"
+
+BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\ncontent-length: 0\r\nconnection: close\r\n\r\n"
+HOP_BY_HOP_HEADERS = (b"connection", b"keep-alive")
+
+
+class StickyProxy:
+    """
+    Reverse proxy pinning each browser to one worker process, as the Chainlit sessions live in the memory of a worker.
+    A browser without the sticky cookie is assigned to the next worker in turn, and the cookie is added to the response.
+    The socket.io polling requests, the websocket upgrades and the file requests of a session all carry the cookie,
+    so they reach the worker owning the session.
+    A connection whose first request has no cookie carries that request only (the websockets excepted), so that the
+    parallel connections of a new browser, assigned to different workers, are never reused once the cookie is set.
+    The connections of the browsers holding the cookie stay alive, as all their requests go to the same worker.
+    """
+
+    def __init__(self, worker_ports: List[int], worker_host: str = "127.0.0.1") -> None:
+        """
+        Args:
+            worker_ports: the port of each worker.
+            worker_host: the host the workers listen on.
+        """
+        self.worker_ports = worker_ports
+        self.worker_host = worker_host
+        self._next_worker = itertools.cycle(range(len(worker_ports)))
+
+    def _route(self, head: bytes) -> Tuple[int, bool]:
+        """
+        The worker of a request and whether it was assigned now, from the sticky cookie of the request head.
+        """
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"cookie":
+                cookie = SimpleCookie()
+                try:
+                    cookie.load(value.decode("latin-1"))
+                except Exception:
+                    continue
+                if STICKY_COOKIE in cookie and cookie[STICKY_COOKIE].value.isdigit():
+                    worker = int(cookie[STICKY_COOKIE].value)
+                    if worker < len(self.worker_ports):
+                        return worker, False
+        return next(self._next_worker), True
+
+    @staticmethod
+    def _request_head(head: bytes, assigned: bool) -> bytes:
+        """
+        The request head sent to the worker: the plain requests of the browsers just assigned a worker close the connection after the response.
+        """
+        lines = head[:-4].split(b"\r\n")
+        if not assigned or any(re.match(rb"(?i)upgrade\s*:", line) for line in lines[1:]):
+            return head
+        lines = [lines[0]] + [line for line in lines[1:] if line.partition(b":")[0].strip().lower() not in HOP_BY_HOP_HEADERS]
+        return b"\r\n".join(lines + [b"Connection: close", b"", b""])
+
+    @staticmethod
+    def _response_head(head: bytes, worker: int) -> bytes:
+        """
+        The response head sent to the browser, setting the sticky cookie.
+        """
+        cookie = f"Set-Cookie: {STICKY_COOKIE}={worker}; Path=/; HttpOnly; SameSite=Lax".encode("latin-1")
+        return head[:-4] + b"\r\n" + cookie + b"\r\n\r\n"
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
+        upstream_writer: Optional[asyncio.StreamWriter] = None
+        upload: Optional[asyncio.Future] = None
+        try:
+            head = await client_reader.readuntil(b"\r\n\r\n")
+            worker, assigned = self._route(head)
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection(self.worker_host, self.worker_ports[worker])
+            except OSError:
+                client_writer.write(BAD_GATEWAY)
+                await client_writer.drain()
+                return
+
+            upstream_writer.write(self._request_head(head, assigned))
+            if assigned:
+                # The request body, if any, is sent while waiting for the response head
+                upload = asyncio.ensure_future(self._pipe(client_reader, upstream_writer))
+                client_writer.write(self._response_head(await upstream_reader.readuntil(b"\r\n\r\n"), worker))
+                await asyncio.gather(upload, self._pipe(upstream_reader, client_writer))
+            else:
+                await asyncio.gather(self._pipe(client_reader, upstream_writer), self._pipe(upstream_reader, client_writer))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if upload is not None:
+                upload.cancel()
+            if upstream_writer is not None:
+                upstream_writer.close()
+            client_writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        """
+        Accept the connections of the browsers until cancelled.
+        """
+        server = await asyncio.start_server(self.handle, host, port, limit=2 ** 16)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,52 @@
+from typing import AsyncIterator
+import asyncio
+import time
+
+
+async def coalesce_tokens(tokens: AsyncIterator[str], max_chars: int = 64, max_delay: float = 0.03) -> AsyncIterator[str]:
+    """
+    Batch the tokens of a streamed answer, so that each websocket message carries several of them.
+    The buffered text is flushed as soon as it reaches `max_chars` characters, or `max_delay` seconds
+    after its first token, also while waiting for the next token of a slow stream.
+
+    Args:
+        tokens: the tokens of the answer.
+        max_chars: the size of a batch, in characters.
+        max_delay: the maximum time a token waits in the buffer, in seconds (0 disables the batching).
+    """
+    if max_delay <= 0:
+        async for token in tokens:
+            yield token
+        return
+
+    buffer, buffer_start = "", None
+    iterator = tokens.__aiter__()
+    next_token = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            timeout = None if buffer_start is None else max(0, buffer_start + max_delay - time.perf_counter())
+            done, _ = await asyncio.wait({next_token}, timeout=timeout)
+
+            if not done:
+                # The time window expired before the next token
+                yield buffer
+                buffer, buffer_start = "", None
+                continue
+
+            try:
+                token = next_token.result()
+            except StopAsyncIteration:
+                break
+
+            buffer += token
+            if buffer_start is None:
+                buffer_start = time.perf_counter()
+            if len(buffer) >= max_chars or time.perf_counter() - buffer_start >= max_delay:
+                yield buffer
+                buffer, buffer_start = "", None
+            next_token = asyncio.ensure_future(iterator.__anext__())
+    finally:
+        next_token.cancel()
+
+    if buffer:
+        yield buffer